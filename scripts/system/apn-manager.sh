@@ -1,5 +1,5 @@
 #!/bin/bash
-MODEM_IP="192.168.8.1"
+MODEM_IP="${MODEM_IP:-192.168.8.1}"
 CONFIG_FILE="/home/proxy-farm-system/configs/dcom/apn-profiles.conf"
 
 get_token() {
@@ -1,5 +1,6 @@
 #!/bin/bash
-MODEM_IP="192.168.8.1"
+MODEM_IP="${MODEM_IP:-192.168.8.1}"
+INTERFACE="${INTERFACE:-enx0c5b8f279a64}"
 
 get_token() {
     curl -s "http://$MODEM_IP/api/webserver/token" | grep -oP '(?<=<token>)[^<]*'
@@ -35,5 +36,5 @@ done
 
 # Method 5: Get external IP via internet services (through the 4G connection)
 echo -e "\n--- External IP check via 4G ---"
-echo "Public IP (via ipify): $(curl -s --interface enx0c5b8f279a64 ifconfig.me 2>/dev/null || echo 'Failed')"
-echo "Public IP (via httpbin): $(curl -s --interface enx0c5b8f279a64 httpbin.org/ip | grep -oP '(?<="origin": ")[^"]*' 2>/dev/null || echo 'Failed')"
+echo "Public IP (via ipify): $(curl -s --interface "$INTERFACE" ifconfig.me 2>/dev/null || echo 'Failed')"
+echo "Public IP (via httpbin): $(curl -s --interface "$INTERFACE" httpbin.org/ip | grep -oP '(?<="origin": ")[^"]*' 2>/dev/null || echo 'Failed')"
@@ -1,5 +1,5 @@
 #!/bin/bash
-MODEM_IP="192.168.8.1"
+MODEM_IP="${MODEM_IP:-192.168.8.1}"
 
 get_token() {
     curl -s "http://$MODEM_IP/api/webserver/token" | grep -oP '(?<=<token>)[^<]*'
@@ -1,8 +1,8 @@
 #!/bin/bash
 # Auto DCOM connection script
 
-INTERFACE="enx0c5b8f279a64"
-GATEWAY="192.168.8.1"
+INTERFACE="${INTERFACE:-enx0c5b8f279a64}"
+GATEWAY="${GATEWAY:-192.168.8.1}"
 
 log() {
     echo "[$(date +'%H:%M:%S')] $1"
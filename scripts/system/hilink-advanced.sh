@@ -1,5 +1,6 @@
 #!/bin/bash
-MODEM_IP="192.168.8.1"
+MODEM_IP="${MODEM_IP:-192.168.8.1}"
+INTERFACE="${INTERFACE:-enx0c5b8f279a64}"
 
 get_token() {
     curl -s "http://$MODEM_IP/api/webserver/token" | grep -oP '(?<=<token>)[^<]*'
@@ -136,8 +137,8 @@ full_dashboard() {
     gateway_ip=$(parse_xml_field "$dhcp_info" "DhcpIPAddress")
     
     echo "   Gateway: $gateway_ip"
-    echo "   Interface: enx0c5b8f279a64"
-    echo "   Local IP: $(ip addr show enx0c5b8f279a64 | grep -oP 'inet \K[^/]*' || echo 'N/A')"
+    echo "   Interface: $INTERFACE"
+    echo "   Local IP: $(ip addr show $INTERFACE | grep -oP 'inet \K[^/]*' || echo 'N/A')"
     
     echo -e "\n⏰ Last updated: $(date)"
 }
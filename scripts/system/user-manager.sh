@@ -1,94 +1,102 @@
 #!/bin/bash
 # User Management for Proxy Farm System
+# Users live in the webapp's store (proxyfarm.db); users.conf is regenerated
+# from it, so every change goes through the webapp API rather than the file.
 
+API_URL="${PROXY_FARM_API:-http://127.0.0.1:5000}"
 USERS_FILE="/home/proxy-farm-system/configs/3proxy/users.conf"
 BACKUP_DIR="/home/proxy-farm-system/configs/3proxy/backups"
 
 # Create backup
 backup_users() {
+    [ -f "$USERS_FILE" ] || return 0
     mkdir -p "$BACKUP_DIR"
     cp "$USERS_FILE" "$BACKUP_DIR/users.txt.$(date +%Y%m%d_%H%M%S)"
     echo "✅ Users backed up"
 }
 
+# JSON object from key=value pairs (values escaped properly)
+json_body() {
+    python3 -c 'import json, sys; print(json.dumps(dict(a.split("=", 1) for a in sys.argv[1:])))' "$@"
+}
+
+# POST a JSON body to the API and print its message; fails unless success is true
+api_post() {
+    local endpoint="$1"
+    shift
+    local response
+    if ! response=$(curl -s --max-time 30 -H 'Content-Type: application/json' \
+                         -d "$(json_body "$@")" "$API_URL$endpoint"); then
+        echo "❌ Webapp not reachable at $API_URL"
+        return 1
+    fi
+    echo "$response" | python3 -c '
+import json, sys
+result = json.load(sys.stdin)
+print(("✅ " if result.get("success") else "❌ ") + result.get("message", ""))
+sys.exit(0 if result.get("success") else 1)'
+}
+
 # Add user
 add_user() {
     local username="$1"
     local password="$2"
-    
+
     if [ -z "$username" ] || [ -z "$password" ]; then
         echo "❌ Usage: add_user <username> <password>"
         return 1
     fi
-    
-    # Check if user exists
-    if grep -q "^$username:" "$USERS_FILE"; then
-        echo "❌ User $username already exists!"
-        return 1
-    fi
-    
+
     backup_users
-    
-    # Add user
-    echo "$username:CL:$password" | sudo tee -a "$USERS_FILE"
-    sudo chmod 600 "$USERS_FILE"
-    
-    echo "✅ User $username added to project"
-    echo "🔄 Restart 3proxy: sudo systemctl restart 3proxy"
+    api_post /api/proxy/users/add "username=$username" "password=$password"
 }
 
 # Remove user
 remove_user() {
     local username="$1"
-    
+
     if [ -z "$username" ]; then
         echo "❌ Usage: remove_user <username>"
         return 1
     fi
-    
+
     backup_users
-    
-    sudo sed -i "/^$username:/d" "$USERS_FILE"
-    echo "✅ User $username removed from project"
-    echo "🔄 Restart 3proxy: sudo systemctl restart 3proxy"
+    api_post /api/proxy/users/remove "username=$username"
 }
 
 # List users
 list_users() {
+    local response
+    if ! response=$(curl -s --max-time 30 "$API_URL/api/proxy/users"); then
+        echo "❌ Webapp not reachable at $API_URL"
+        return 1
+    fi
     echo "👥 Proxy Farm System Users:"
     echo "┌─────────────────────┬─────────────────────┐"
     echo "│ Username            │ Password Type       │"
     echo "├─────────────────────┼─────────────────────┤"
-    
-    while IFS=':' read -r username type password; do
-        printf "│ %-19s │ %-19s │\n" "$username" "$type"
-    done < "$USERS_FILE"
-    
-    echo "└─────────────────────┴─────────────────────┘"
-    echo "Total users: $(wc -l < "$USERS_FILE")"
-    echo "File: $USERS_FILE"
+    echo "$response" | python3 -c '
+import json, sys
+users = json.load(sys.stdin).get("users", [])
+for user in users:
+    print("│ %-19s │ %-19s │" % (user.get("username"), user.get("type")))
+print("└─────────────────────┴─────────────────────┘")
+print("Total users: %d" % len(users))'
+    echo "API: $API_URL"
 }
 
 # Change password
 change_password() {
     local username="$1"
     local new_password="$2"
-    
+
     if [ -z "$username" ] || [ -z "$new_password" ]; then
         echo "❌ Usage: change_password <username> <new_password>"
         return 1
     fi
-    
-    if ! grep -q "^$username:" "$USERS_FILE"; then
-        echo "❌ User $username not found!"
-        return 1
-    fi
-    
+
     backup_users
-    
-    sudo sed -i "s/^$username:CL:.*/$username:CL:$new_password/" "$USERS_FILE"
-    echo "✅ Password changed for user $username"
-    echo "🔄 Restart 3proxy: sudo systemctl restart 3proxy"
+    api_post /api/proxy/users/password "username=$username" "new_password=$new_password"
 }
 
 case "$1" in
@@ -96,14 +104,14 @@ case "$1" in
     remove) remove_user "$2" ;;
     list) list_users ;;
     passwd) change_password "$2" "$3" ;;
-    *) 
+    *)
         echo "🔧 Proxy Farm System - User Manager"
         echo ""
         echo "Usage: $0 {add|remove|list|passwd}"
         echo ""
         echo "Commands:"
         echo "  add <user> <pass>      - Add new user"
-        echo "  remove <user>          - Remove user"  
+        echo "  remove <user>          - Remove user"
         echo "  list                   - List all users"
         echo "  passwd <user> <pass>   - Change password"
         echo ""
@@ -112,6 +120,9 @@ case "$1" in
         echo "  $0 remove john             - Remove user john"
         echo "  $0 passwd john newpass     - Change john's password"
         echo ""
+        echo "Changes go through the webapp ($API_URL, override with PROXY_FARM_API),"
+        echo "which updates the store, users.conf and reloads 3proxy."
+        echo ""
         echo "Project: /home/proxy-farm-system/"
         ;;
 esac
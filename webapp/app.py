@@ -5,13 +5,44 @@ Simple web dashboard for DCOM and 3proxy management
 """
 
 import os
+import fcntl
+import re
 import json
+import heapq
+import asyncio
+import shutil
 import subprocess
 import time
 from datetime import datetime
-from flask import Flask, render_template, jsonify, request, redirect, url_for
+from urllib.parse import quote
+from flask import Flask, Response, render_template, jsonify, request, redirect, url_for
 import threading
 
+from hilink import get_client, CONNECTION_STATUS, NETWORK_TYPES
+from telemetry import TelemetryCollector
+from poller import ModemPoller
+from discovery import DeviceDiscovery, interface_address
+from egress import EgressResolver, probe_connect
+from store import Store
+from registry import UserRegistry
+from quota import Quota, QuotaBook
+from iphistory import IPHistoryLog
+from freshness import FreshnessTracker
+from rotation import RotationOrchestrator
+from latency import PhaseTimer, PHASES, build_histograms
+from health import HealthProber
+from traffic import TrafficCollector
+from policyroute import PolicyRouter
+from timeseries import TimeSeriesStore
+from reloader import ProxyReloader
+from procnet import ProxyInspector
+from proxylog import ProxyLogStats
+from logarchive import LogArchive
+from proxyconf import (ProxyConfig, ConfigDeployer, PORT_TYPES, PROBE_USER_PREFIX, render, standard_listeners,
+                       store_users, probe_users)
+from portpool import PortPool, load_ranges, POLICIES
+from verifier import FleetVerifier, EchoTarget, probe, protocols_for
+
 app = Flask(__name__)
 app.secret_key = 'proxy-farm-system-secret-key'
 
@@ -20,76 +51,84 @@ PROJECT_ROOT = '/home/proxy-farm-system'
 SCRIPTS_PATH = f'{PROJECT_ROOT}/scripts/system'
 CONFIGS_PATH = f'{PROJECT_ROOT}/configs'
 LOGS_PATH = f'{PROJECT_ROOT}/logs'
+PROXY_LOG_FILE = f'{LOGS_PATH}/3proxy/3proxy.log'
+PROXY_COUNTER_FILE = f'{LOGS_PATH}/3proxy/traffic.3cf'
+
+# Concurrent connections 3proxy accepts per service (its own default is 100)
+PROXY_MAXCONN = int(os.environ.get('PROXY_MAXCONN', '2000'))
+
+# Fleet verification: the echo target probes fetch through the proxies (it must
+# be reachable from the modems and answer with the caller's IP, e.g. a host
+# running `verifier.py echo`) and how many probes run at once
+VERIFY_ECHO_URL = os.environ.get('VERIFY_ECHO_URL', 'http://httpbin.org/ip')
+# Other echo targets a verification request may pick (comma-separated URLs)
+VERIFY_TARGETS = {VERIFY_ECHO_URL, *filter(None, os.environ.get('VERIFY_TARGETS', '').split(','))}
+VERIFY_PARALLELISM = int(os.environ.get('VERIFY_PARALLELISM', '200'))
+
+# Bulk provisioning: users per request, and users.conf backups kept
+BULK_USERS_MAX = 5000
+USERS_BACKUP_KEEP = 30
+
+# Reachable host:port used to confirm a modem has working egress after a reconnect
+EGRESS_PROBE_TARGET = (os.environ.get('EGRESS_PROBE_HOST', '1.1.1.1'), int(os.environ.get('EGRESS_PROBE_PORT', '443')))
 
 # Ensure directories exist
 os.makedirs(LOGS_PATH, exist_ok=True)
 os.makedirs(f'{CONFIGS_PATH}/dcom', exist_ok=True)
 
+# State store - source of truth for users and assignments
+store = Store(f'{CONFIGS_PATH}/proxyfarm.db')
+store.migrate(
+    users_file=f'{CONFIGS_PATH}/3proxy/users.conf',
+    assignments_file=f'{CONFIGS_PATH}/dcom/user_assignments.json',
+    ip_history_file=f'{CONFIGS_PATH}/dcom/ip_history.json'
+)
+
+# IP change history - segmented append-only log, kept for months
+ip_log = IPHistoryLog(f'{CONFIGS_PATH}/dcom/ip_history')
+if ip_log.is_empty():
+    ip_log.append_many(store.take_ip_changes())
+
 class DCOMManager:
     """Enhanced DCOM management with multi-device support"""
     
     def __init__(self):
         self.modem_ip = "192.168.8.1"
+        self.hilink = get_client(self.modem_ip)
+        self.poller = ModemPoller()
+        self.egress = EgressResolver()
+        self._modems_observed = None
+        self.discovery = DeviceDiscovery()
+        self.discovery.add_listener(self._on_device_event)
+        self.freshness = FreshnessTracker()
+        self.traffic = TrafficCollector()
+        self.routes = PolicyRouter()
+        self.device_ids = {}  # USB serial/port key -> dcom id
         self.devices = {}  # Store multiple DCOM devices
-        self.user_assignments = {}  # User -> DCOM mapping
-        self.dcom_assignments = {}  # DCOM -> Users mapping
+        self.user_assignments = {}  # User -> DCOM mapping (cached from store)
+        self.dcom_assignments = {}  # DCOM -> Users mapping (cached from store)
+        self._assignments_version = None
         self.load_dcom_devices()
         self.load_assignments()
-        self.ip_history = {}  # Track IP changes
-        self.load_ip_history()
     
     def load_dcom_devices(self):
-        """Detect and load available DCOM devices"""
+        """Detect and load available DCOM devices from sysfs"""
+        devices_file = os.environ.get('DCOM_DEVICES_FILE')
+        if devices_file:
+            # Static device list (e.g. simmodem.py for offline testing) instead of sysfs
+            with open(devices_file, 'r') as f:
+                self.devices = {d['id']: {**self._static_entry(), **d} for d in json.load(f)}
+            return
         try:
-            # Run detection script
-            result = subprocess.run(
-                [f'{SCRIPTS_PATH}/detect-dcom-devices.sh'],
-                capture_output=True, text=True, timeout=10
-            )
+            if not self.discovery.available:
+                raise RuntimeError('sysfs USB tree not available')
             
-            if result.returncode == 0:
-                # Parse detected devices (mock for now)
-                self.devices = {
-                    'dcom1': {
-                        'id': 'dcom1',
-                        'name': 'DCOM Device 1',
-                        'interface': 'enx0c5b8f279a64',
-                        'ip': '192.168.8.1',
-                        'status': 'active',
-                        'signal': '-65 dBm',
-                        'network': 'LTE',
-                        'public_ip': '103.21.244.15',
-                        'assigned_users': [],
-                        'max_users': 50,
-                        'current_load': 0
-                    },
-                    'dcom2': {
-                        'id': 'dcom2', 
-                        'name': 'DCOM Device 2',
-                        'interface': 'enx0c5b8f279a65',
-                        'ip': '192.168.9.1',
-                        'status': 'active',
-                        'signal': '-72 dBm',
-                        'network': 'LTE',
-                        'public_ip': '103.21.244.16',
-                        'assigned_users': [],
-                        'max_users': 50,
-                        'current_load': 0
-                    },
-                    'dcom3': {
-                        'id': 'dcom3',
-                        'name': 'DCOM Device 3', 
-                        'interface': 'enx0c5b8f279a66',
-                        'ip': '192.168.10.1',
-                        'status': 'inactive',
-                        'signal': 'N/A',
-                        'network': 'N/A',
-                        'public_ip': 'N/A',
-                        'assigned_users': [],
-                        'max_users': 50,
-                        'current_load': 0
-                    }
-                }
+            self.load_device_ids()
+            devices = {}
+            for info in self.discovery.scan().values():
+                entry = self._device_entry(info)
+                devices[entry['id']] = entry
+            self.devices = devices
         except Exception as e:
             print(f"Error detecting DCOM devices: {e}")
             # Fallback to single device
@@ -109,46 +148,158 @@ class DCOMManager:
                 }
             }
     
+    def _static_entry(self):
+        """Defaults for devices listed in DCOM_DEVICES_FILE"""
+        return {
+            'status': 'active',
+            'signal': 'N/A',
+            'network': 'N/A',
+            'public_ip': 'N/A',
+            'carrier': None,
+            'apn_profile': None,
+            'assigned_users': [],
+            'max_users': 50,
+            'current_load': 0
+        }
+    
+    def load_device_ids(self):
+        """Load stable USB key -> dcomN mapping so assignments survive replugging"""
+        try:
+            ids_file = f'{CONFIGS_PATH}/dcom/device_ids.json'
+            if os.path.exists(ids_file):
+                with open(ids_file, 'r') as f:
+                    self.device_ids = json.load(f)
+        except Exception as e:
+            print(f"Error loading device ids: {e}")
+    
+    def _free_device_id(self):
+        used = set(self.device_ids.values())
+        n = 1
+        while f'dcom{n}' in used:
+            n += 1
+        return f'dcom{n}'
+    
+    def _device_id(self, key):
+        """
+        Get (or allocate and persist) the dcom id for a USB key. Every worker
+        sees the same hotplug, so allocation happens under a file lock against
+        the file's current contents: the first worker picks the id, the others
+        read it back.
+        """
+        if key not in self.device_ids:
+            ids_file = f'{CONFIGS_PATH}/dcom/device_ids.json'
+            try:
+                with open(f'{ids_file}.lock', 'w') as lock:
+                    fcntl.flock(lock, fcntl.LOCK_EX)
+                    self.load_device_ids()
+                    if key not in self.device_ids:
+                        self.device_ids = {**self.device_ids, key: self._free_device_id()}
+                        tmp_file = f'{ids_file}.{os.getpid()}.tmp'
+                        with open(tmp_file, 'w') as f:
+                            json.dump(self.device_ids, f, indent=2)
+                        os.replace(tmp_file, ids_file)  # readers never see a half-written file
+            except Exception as e:
+                print(f"Error saving device ids: {e}")
+                if key not in self.device_ids:
+                    self.device_ids = {**self.device_ids, key: self._free_device_id()}
+        return self.device_ids[key]
+    
+    def _device_entry(self, info):
+        """Registry entry for a discovered stick"""
+        device_id = self._device_id(info['key'])
+        previous = self.devices.get(device_id, {})
+        return {
+            'id': device_id,
+            'name': f"DCOM {info['vendor'].title()} ({info['serial'] or info['port_path']})",
+            'key': info['key'],
+            'serial': info['serial'],
+            'port_path': info['port_path'],
+            'product': info['product'],
+            'interface': info['interface'],
+            'ip': info['gateway'],
+            'address': info['address'],
+            'status': 'active' if info['gateway'] else 'inactive',
+            'signal': previous.get('signal', 'N/A'),
+            'network': previous.get('network', 'N/A'),
+            'public_ip': previous.get('public_ip', 'N/A'),
+            'carrier': previous.get('carrier'),
+            'apn_profile': previous.get('apn_profile'),
+            'assigned_users': [],
+            'max_users': 50,
+            'current_load': 0
+        }
+    
+    def _on_device_event(self, action, info):
+        """Hotplug: update only the affected device"""
+        if action == 'remove':
+            device_id = self.device_ids.get(info['key'])
+            devices = dict(self.devices)
+            if devices.pop(device_id, None) is not None:
+                self.devices = devices
+                self.poller.forget(device_id)
+            print(f"DCOM unplugged: {info['key']} ({device_id})")
+        else:
+            entry = self._device_entry(info)
+            self.devices = {**self.devices, entry['id']: entry}
+            self.dcom_assignments.setdefault(entry['id'], [])
+            if action == 'add':
+                print(f"DCOM plugged in: {info['key']} ({entry['id']})")
+    
+    def start_hotplug(self):
+        """Start the uevent monitor in this process and resync anything missed before it"""
+        if self.discovery.available and self.discovery.start_monitor():
+            self.load_dcom_devices()
+    
     def load_assignments(self):
-        """Load user-DCOM assignments from config"""
+        """Load user-DCOM assignments from the store"""
         try:
-            assignment_file = f'{CONFIGS_PATH}/dcom/user_assignments.json'
-            if os.path.exists(assignment_file):
-                with open(assignment_file, 'r') as f:
-                    data = json.load(f)
-                    self.user_assignments = data.get('user_assignments', {})
-                    self.dcom_assignments = data.get('dcom_assignments', {})
-            else:
-                # Default assignments
-                self.user_assignments = {}
-                self.dcom_assignments = {device_id: [] for device_id in self.devices.keys()}
+            self._assignments_version = store.version('assignments')
+            user_assignments, dcom_assignments = store.load_assignments()
+            for device_id in self.devices:
+                dcom_assignments.setdefault(device_id, [])
+            self.user_assignments = user_assignments
+            self.dcom_assignments = dcom_assignments
         except Exception as e:
             print(f"Error loading assignments: {e}")
             self.user_assignments = {}
             self.dcom_assignments = {device_id: [] for device_id in self.devices.keys()}
     
-    def save_assignments(self):
-        """Save assignments to config file"""
-        try:
-            assignment_file = f'{CONFIGS_PATH}/dcom/user_assignments.json'
-            data = {
-                'user_assignments': self.user_assignments,
-                'dcom_assignments': self.dcom_assignments,
-                'last_updated': datetime.now().isoformat()
-            }
-            with open(assignment_file, 'w') as f:
-                json.dump(data, f, indent=2)
-            return True
-        except Exception as e:
-            print(f"Error saving assignments: {e}")
-            return False
+    def sync_devices(self):
+        """
+        Pick up addresses of sticks whose interface came up after plug-in. Every
+        worker sees the uevent, but DHCP finishes later, so each one checks for
+        itself before reading the registry (cheap: one ioctl per stick still waiting).
+        """
+        self.discovery.refresh_addresses()
+    
+    def sync_assignments(self):
+        """Reload the cached assignments if another worker changed them (and refresh device addresses)"""
+        self.sync_devices()
+        if store.version('assignments') != self._assignments_version:
+            self.load_assignments()
+    
+    def _assignments_applied(self, apply):
+        """
+        Apply an assignment change we just committed. If our own write is the
+        only one since the last load the version moved by exactly one and the
+        cached copy stays valid; otherwise another worker wrote too, so reload.
+        """
+        version = store.version('assignments')
+        if self._assignments_version is not None and version == self._assignments_version + 1:
+            apply()
+            self._assignments_version = version
+        else:
+            self.load_assignments()
     
     def get_all_devices(self):
         """Get all DCOM devices with status"""
+        self.sync_assignments()
+        self.observe_modems()
         devices_status = {}
         for device_id, device in self.devices.items():
             devices_status[device_id] = {
                 **device,
+                'public_ip': self.egress.cached(device.get('interface')) or device['public_ip'],
                 'assigned_users': self.dcom_assignments.get(device_id, []),
                 'user_count': len(self.dcom_assignments.get(device_id, [])),
                 'load_percentage': min(100, (len(self.dcom_assignments.get(device_id, [])) / device['max_users']) * 100)
@@ -160,99 +311,145 @@ class DCOMManager:
         if dcom_id not in self.devices:
             return {'success': False, 'message': f'DCOM device {dcom_id} not found'}
         
-        # Remove user from any existing assignment
-        for device_id in self.dcom_assignments:
-            if username in self.dcom_assignments[device_id]:
-                self.dcom_assignments[device_id].remove(username)
-        
-        # Add to new assignment
-        if dcom_id not in self.dcom_assignments:
-            self.dcom_assignments[dcom_id] = []
-        
-        if username not in self.dcom_assignments[dcom_id]:
-            self.dcom_assignments[dcom_id].append(username)
-        
-        self.user_assignments[username] = dcom_id
-        
-        if self.save_assignments():
+        result = self.bulk_assign([(username, dcom_id)])
+        if result['success']:
             return {'success': True, 'message': f'User {username} assigned to {dcom_id}'}
         else:
             return {'success': False, 'message': 'Failed to save assignment'}
     
+    def bulk_assign(self, pairs):
+        """Apply many (username, dcom_id) assignments in one transaction - all or nothing"""
+        self.sync_assignments()
+        new_dcom = {}
+        for username, dcom_id in pairs:
+            if dcom_id not in self.devices:
+                return {'success': False, 'message': f'DCOM device {dcom_id} not found', 'assigned': 0}
+            new_dcom[username] = dcom_id  # last one wins
+        
+        old_user_assignments = self.user_assignments
+        old_dcom_assignments = self.dcom_assignments
+        
+        # Only rows that actually change are written
+        changed = [(username, dcom_id) for username, dcom_id in new_dcom.items()
+                   if old_user_assignments.get(username) != dcom_id]
+        try:
+            if changed:
+                store.assign_many(changed)
+        except Exception as e:
+            print(f"Error saving assignments: {e}")
+            return {'success': False, 'message': 'Failed to save assignments', 'assigned': 0}
+        
+        def apply():
+            # Users leaving each device, and users joining each device (in order)
+            leaving = {}
+            joining = {}
+            for username, dcom_id in changed:
+                current = old_user_assignments.get(username)
+                if current is not None:
+                    leaving.setdefault(current, set()).add(username)
+                joining.setdefault(dcom_id, []).append(username)
+            
+            # Rebuild only the affected device lists, once each
+            dcom_assignments = dict(old_dcom_assignments)
+            for device_id in set(leaving) | set(joining):
+                gone = leaving.get(device_id, ())
+                members = [u for u in dcom_assignments.get(device_id, []) if u not in gone]
+                dcom_assignments[device_id] = members + joining.get(device_id, [])
+            
+            self.user_assignments = {**old_user_assignments, **new_dcom}
+            self.dcom_assignments = dcom_assignments
+        
+        if changed:
+            self._assignments_applied(apply)
+            proxy.compile_config()  # moves the users' egress; one debounced reload
+        
+        return {'success': True, 'message': f'Assigned {len(new_dcom)} users', 'assigned': len(new_dcom)}
+    
     def remove_user_from_dcom(self, username):
         """Remove user from DCOM assignment"""
+        self.sync_assignments()
         if username in self.user_assignments:
-            dcom_id = self.user_assignments[username]
-            if dcom_id in self.dcom_assignments and username in self.dcom_assignments[dcom_id]:
-                self.dcom_assignments[dcom_id].remove(username)
-            del self.user_assignments[username]
-            
-            if self.save_assignments():
-                return {'success': True, 'message': f'User {username} removed from DCOM assignment'}
-            else:
+            try:
+                store.unassign(username)
+            except Exception as e:
+                print(f"Error saving assignments: {e}")
                 return {'success': False, 'message': 'Failed to save changes'}
+            
+            def apply():
+                dcom_id = self.user_assignments[username]
+                if dcom_id in self.dcom_assignments and username in self.dcom_assignments[dcom_id]:
+                    self.dcom_assignments[dcom_id] = [u for u in self.dcom_assignments[dcom_id] if u != username]
+                self.user_assignments = {u: d for u, d in self.user_assignments.items() if u != username}
+            
+            self._assignments_applied(apply)
+            proxy.compile_config()
+            return {'success': True, 'message': f'User {username} removed from DCOM assignment'}
         else:
             return {'success': False, 'message': 'User not assigned to any DCOM'}
     
+    def egress_addresses(self):
+        """{dcom_id: local address} for active modems that can carry user traffic"""
+        return {device_id: device['address'] for device_id, device in self.devices.items()
+                if device['status'] == 'active' and device.get('address') and device.get('interface')}
+    
+    def sync_egress(self):
+        """
+        Per-modem policy routing plus per-user egress in 3proxy.cfg. Runs in
+        the telemetry leader; only changed rules and a changed config are applied.
+        """
+        addresses = self.egress_addresses()
+        store.set_egress_addresses(addresses)  # every worker's config compiles pin users to these
+        devices = {device_id: {'interface': self.devices[device_id]['interface'], 'address': address,
+                               'gateway': self.devices[device_id].get('ip')}
+                   for device_id, address in addresses.items()}
+        routes = self.routes.sync(devices)
+        routes['applied'] = list(self.routes.routes().values())
+        config = proxy.compile_config()
+        config.pop('diff', None)
+        return {'routes': routes, 'config': config, 'synced_at': time.time()}
+    
     def get_user_dcom(self, username):
         """Get DCOM assigned to user"""
+        self.sync_assignments()
         return self.user_assignments.get(username)
     
     def auto_assign_users(self, usernames, mode='round_robin'):
         """Auto assign multiple users to DCOMs"""
+        self.sync_assignments()
         active_dcoms = [d_id for d_id, device in self.devices.items() if device['status'] == 'active']
         if not active_dcoms:
             return {'success': False, 'message': 'No active DCOM devices available'}
         
-        assigned = []
-        for i, username in enumerate(usernames):
-            if mode == 'round_robin':
-                dcom_id = active_dcoms[i % len(active_dcoms)]
-            elif mode == 'least_loaded':
-                # Find DCOM with least users
-                dcom_loads = {d_id: len(self.dcom_assignments.get(d_id, [])) for d_id in active_dcoms}
-                dcom_id = min(dcom_loads, key=dcom_loads.get)
-            else:  # random
-                import random
-                dcom_id = random.choice(active_dcoms)
-            
-            result = self.assign_user_to_dcom(username, dcom_id)
-            if result['success']:
-                assigned.append({'username': username, 'dcom': dcom_id})
+        usernames = list(dict.fromkeys(usernames))  # drop duplicates, keep order
+        
+        if mode == 'round_robin':
+            plan = [(username, active_dcoms[i % len(active_dcoms)]) for i, username in enumerate(usernames)]
+        elif mode == 'least_loaded':
+            # Min-heap of (load, order, dcom) - users in this batch don't count towards the current load
+            batch = set(usernames)
+            heap = [(sum(1 for u in self.dcom_assignments.get(d_id, []) if u not in batch), i, d_id)
+                    for i, d_id in enumerate(active_dcoms)]
+            heapq.heapify(heap)
+            plan = []
+            for username in usernames:
+                load, order, dcom_id = heap[0]
+                plan.append((username, dcom_id))
+                heapq.heapreplace(heap, (load + 1, order, dcom_id))
+        else:  # random
+            plan = [(username, random.choice(active_dcoms)) for username in usernames]
+        
+        result = self.bulk_assign(plan)
+        if not result['success']:
+            return {'success': False, 'message': result['message'], 'assignments': []}
         
         return {
             'success': True,
-            'message': f'Assigned {len(assigned)} users',
-            'assignments': assigned
+            'message': f'Assigned {len(plan)} users',
+            'assignments': [{'username': username, 'dcom': dcom_id} for username, dcom_id in plan]
         }
     
-    def load_ip_history(self):
-        """Load IP change history"""
-        try:
-            history_file = f'{CONFIGS_PATH}/dcom/ip_history.json'
-            if os.path.exists(history_file):
-                with open(history_file, 'r') as f:
-                    self.ip_history = json.load(f)
-            else:
-                self.ip_history = {}
-        except Exception as e:
-            print(f"Error loading IP history: {e}")
-            self.ip_history = {}
-    
-    def save_ip_history(self):
-        """Save IP change history"""
-        try:
-            history_file = f'{CONFIGS_PATH}/dcom/ip_history.json'
-            with open(history_file, 'w') as f:
-                json.dump(self.ip_history, f, indent=2)
-        except Exception as e:
-            print(f"Error saving IP history: {e}")
-    
     def track_ip_change(self, dcom_id, old_ip, new_ip):
         """Track IP change for notifications"""
-        if dcom_id not in self.ip_history:
-            self.ip_history[dcom_id] = []
-        
         change_record = {
             'timestamp': datetime.now().isoformat(),
             'old_ip': old_ip,
@@ -260,35 +457,28 @@ class DCOMManager:
             'affected_users': self.dcom_assignments.get(dcom_id, [])
         }
         
-        self.ip_history[dcom_id].append(change_record)
-        
-        # Keep only last 10 changes
-        if len(self.ip_history[dcom_id]) > 10:
-            self.ip_history[dcom_id] = self.ip_history[dcom_id][-10:]
-        
-        self.save_ip_history()
+        try:
+            ip_log.append(dcom_id, old_ip, new_ip, change_record['affected_users'])
+        except Exception as e:
+            print(f"Error saving IP history: {e}")
         return change_record
     
-    def get_ip_changes(self, dcom_id=None, hours=24):
+    def get_ip_changes(self, dcom_id=None, hours=24, limit=None):
         """Get recent IP changes"""
-        from datetime import datetime, timedelta
-        
-        cutoff_time = datetime.now() - timedelta(hours=hours)
+        since = time.time() - hours * 3600
         recent_changes = []
         
-        history_to_check = {dcom_id: self.ip_history[dcom_id]} if dcom_id else self.ip_history
-        
-        for device_id, changes in history_to_check.items():
-            for change in changes:
-                change_time = datetime.fromisoformat(change['timestamp'])
-                if change_time > cutoff_time:
-                    recent_changes.append({
-                        'dcom_id': device_id,
-                        'device_name': self.devices.get(device_id, {}).get('name', device_id),
-                        **change
-                    })
+        for change in ip_log.query(since, dcom_id=dcom_id, limit=limit):
+            recent_changes.append({
+                'dcom_id': change['dcom_id'],
+                'device_name': self.devices.get(change['dcom_id'], {}).get('name', change['dcom_id']),
+                'timestamp': datetime.fromtimestamp(change['ts']).isoformat(),
+                'old_ip': change['old_ip'],
+                'new_ip': change['new_ip'],
+                'affected_users': change['affected_users']
+            })
         
-        return sorted(recent_changes, key=lambda x: x['timestamp'], reverse=True)
+        return recent_changes
     
     def notify_users_ip_change(self, dcom_id, old_ip, new_ip):
         """Generate notification for users about IP change"""
@@ -309,34 +499,253 @@ class DCOMManager:
         }
         
         return notification
+    
+    def get_carrier(self, dcom_id):
+        """Operator of a modem (asked once, then cached on the device entry)"""
+        device = self.devices.get(dcom_id, {})
+        if not device.get('carrier') and device.get('ip'):
+            try:
+                device['carrier'] = get_client(device['ip'], interface=device.get('interface')).carrier()
+            except Exception:
+                return 'Unknown'
+        return device.get('carrier') or 'Unknown'
+    
+    def get_apn_profile(self, dcom_id):
+        """Active APN profile name of a modem (asked once, then cached on the device entry)"""
+        device = self.devices.get(dcom_id, {})
+        if not device.get('apn_profile') and device.get('ip'):
+            try:
+                device['apn_profile'] = get_client(device['ip'], interface=device.get('interface')).apn_profile()['name']
+            except Exception:
+                return 'Unknown'
+        return device.get('apn_profile') or 'Unknown'
+    
+    def reconnect(self, dcom_id, timeout=60):
+        """
+        Drop and re-establish the data session, timing each phase. Returns
+        (new egress IP or None, phase timings); timings are also stored for
+        the latency histograms.
+        """
+        device = self.devices[dcom_id]
+        interface = device.get('interface')
+        client = get_client(device['ip'], interface=interface)
+        request_timeout = 5  # the web UI is slow while the data session is switched
+        timer = PhaseTimer()
+        phase = 'disconnect'
+        try:
+            client.set_data_switch(False, timeout=request_timeout)
+            client.wait_connected(False, timeout=timeout, request_timeout=request_timeout)
+            timer.mark(phase)
+            
+            phase = 'reattach'
+            client.set_data_switch(True, timeout=request_timeout)
+            client.wait_connected(True, timeout=timeout, interval=0.2, request_timeout=request_timeout)
+            timer.mark(phase)
+            
+            phase = 'route_ready'
+            deadline = time.time() + timeout
+            while interface and not interface_address(interface):
+                if time.time() >= deadline:
+                    raise TimeoutError(f'{interface} has no address after {timeout}s')
+                time.sleep(0.1)
+            timer.mark(phase)
+            
+            phase = 'first_egress'
+            while True:
+                try:
+                    probe_connect(*EGRESS_PROBE_TARGET, interface=interface, timeout=2)
+                    break
+                except OSError:
+                    if time.time() >= deadline:
+                        raise TimeoutError(f'No egress through {interface or dcom_id} after {timeout}s')
+                    time.sleep(0.2)
+            timer.mark(phase)
+            
+            phase = 'ip_confirmed'
+            self.egress.invalidate(interface)
+            new_ip = self.egress.resolve(interface, device['ip'])
+            if not new_ip:
+                raise RuntimeError('New egress IP could not be confirmed')
+            timer.mark(phase)
+            return new_ip, timer.to_dict()
+        except Exception:
+            timer.fail(phase)
+            raise
+        finally:
+            try:
+                store.add_rotation_timing(dcom_id, self.get_carrier(dcom_id), self.get_apn_profile(dcom_id),
+                                          timer.to_dict())
+            except Exception as e:
+                print(f"Error saving rotation timing: {e}")
+    
+    def get_rotation_latency(self, hours=168, dcom_id=None):
+        """Phase latency histograms per modem, APN profile and carrier"""
+        samples = store.rotation_timings(time.time() - hours * 3600, dcom_id)
+        return {
+            'samples': len(samples),
+            'phases': list(PHASES) + ['total'],
+            'by_modem': build_histograms(samples, 'dcom_id'),
+            'by_apn': build_histograms(samples, 'apn'),
+            'by_carrier': build_histograms(samples, 'carrier')
+        }
+    
+    def drain_users(self, dcom_id, exclude=(), online=None):
+        """Move a modem's users onto the least loaded online modems; returns [(username, new dcom)]"""
+        self.sync_assignments()
+        users = list(self.dcom_assignments.get(dcom_id, []))
+        targets = [device_id for device_id, device in self.devices.items()
+                   if device['status'] == 'active' and device_id not in exclude and device_id != dcom_id
+                   and (online is None or device_id in online)]
+        if not users or not targets:
+            return []
+        
+        heap = [(len(self.dcom_assignments.get(device_id, [])), device_id) for device_id in targets]
+        heapq.heapify(heap)
+        plan = []
+        for username in users:
+            load, device_id = heapq.heappop(heap)
+            plan.append((username, device_id))
+            heapq.heappush(heap, (load + 1, device_id))
+        result = self.bulk_assign(plan)
+        if not result['success']:
+            raise RuntimeError(result['message'])
+        return plan
+    
+    def restore_users(self, dcom_id, moved):
+        """Move drained users back, unless they were reassigned elsewhere meanwhile"""
+        self.sync_assignments()
+        plan = [(username, dcom_id) for username, moved_to in moved
+                if self.user_assignments.get(username) == moved_to]
+        if plan:
+            self.bulk_assign(plan)
+        return plan
+    
+    def rotate_ip(self, dcom_id, fresh=True, scope='farm', subnet=False, window_hours=None, max_attempts=5):
+        """
+        Reconnect until the modem gets an IP not seen (in `scope`) within the
+        freshness window, up to `max_attempts` reconnects. Every IP handed out
+        is logged, so repeats count towards the carrier's reuse rate.
+        """
+        self.sync_devices()
+        device = self.devices.get(dcom_id)
+        if device is None:
+            return {'success': False, 'message': 'DCOM device not found'}
+        if device['status'] != 'active' or not device.get('ip'):
+            return {'success': False, 'message': 'DCOM device is not active'}
+        
+        self.get_carrier(dcom_id)
+        self.observe_modems()
+        window = window_hours * 3600 if window_hours else None
+        old_ip = self.egress.resolve(device.get('interface'), device['ip']) or device.get('public_ip', 'N/A')
+        first_ip = old_ip
+        attempts = []
+        is_fresh = False
+        for attempt in range(1, max(1, max_attempts) + 1):
+            try:
+                new_ip, timings = self.reconnect(dcom_id)
+            except Exception as e:
+                attempts.append({'attempt': attempt, 'ip': None, 'fresh': False, 'error': str(e)})
+                break
+            
+            self.freshness.sync(ip_log)
+            seen = self.freshness.last_seen(dcom_id, new_ip)
+            # The IP we started from counts as seen even if it predates the log
+            is_fresh = new_ip != first_ip and self.freshness.is_fresh(dcom_id, new_ip, scope, subnet, window)
+            attempts.append({'attempt': attempt, 'ip': new_ip or 'N/A', 'fresh': is_fresh, 'last_seen': seen,
+                             'timings': timings})
+            if new_ip:
+                self.devices[dcom_id]['public_ip'] = new_ip
+                self.track_ip_change(dcom_id, old_ip, new_ip)
+                old_ip = new_ip
+            if new_ip and (is_fresh or not fresh):
+                break
+        
+        new_ip = attempts[-1]['ip'] if attempts and attempts[-1]['ip'] else 'N/A'
+        success = new_ip != 'N/A' and (is_fresh or not fresh)
+        if success:
+            message = f'IP rotated for {device["name"]} after {len(attempts)} reconnect(s)'
+        elif new_ip != 'N/A':
+            message = f'No fresh IP for {device["name"]} after {len(attempts)} reconnect(s)'
+        else:
+            message = f'Reconnect failed for {device["name"]}'
+        result = {
+            'success': success,
+            'message': message,
+            'old_ip': first_ip,
+            'new_ip': new_ip,
+            'fresh': is_fresh,
+            'attempts': attempts,
+            'device_id': dcom_id,
+            'affected_users': self.dcom_assignments.get(dcom_id, [])
+        }
+        if new_ip not in ('N/A', first_ip):
+            result['notification'] = self.notify_users_ip_change(dcom_id, first_ip, new_ip)
+        return result
+        
+    def poll_devices(self):
+        """Poll every registered modem in parallel (gateway IP + interface from the registry)"""
+        self.sync_devices()
+        devices = {k: v for k, v in self.devices.items() if v.get('ip')}
+        results = self.poller.poll(devices)
+        
+        self._observe_egress(results)
         
+        # Byte rates from the counters just sampled (adds 'rates' to each result)
+        self.traffic.update(devices, results)
+        return results
+    
+    def _observe_egress(self, results):
+        """A new WanIPAddress / reset connect time invalidates the cached egress IP"""
+        for device_id, result in results.items():
+            interface = self.devices.get(device_id, {}).get('interface')
+            if interface and result.get('reachable'):
+                self.egress.observe(interface, result.get('wan_ip'),
+                                    (result.get('traffic') or {}).get('CurrentConnectTime'))
+    
+    def observe_modems(self):
+        """Apply the leader's latest modem poll to this worker's egress cache (once per sample)"""
+        snapshot = telemetry.snapshot()
+        sampled_at = snapshot.sampled_at.get('modems')
+        if sampled_at is None or sampled_at == self._modems_observed:
+            return
+        self._modems_observed = sampled_at
+        self._observe_egress(snapshot.get('modems') or {})
+    
+    def get_primary_device(self):
+        """Device behind modem_ip, else the first active device with an interface"""
+        for device in self.devices.values():
+            if device.get('ip') == self.modem_ip and device.get('interface'):
+                return device
+        for device in self.devices.values():
+            if device['status'] == 'active' and device.get('interface'):
+                return device
+        return None
+    
     def get_status(self):
-        """Get DCOM status using our existing scripts"""
+        """Get DCOM status from the HiLink API"""
         try:
-            # Use hilink-advanced.sh to get status
-            result = subprocess.run(
-                [f'{SCRIPTS_PATH}/hilink-advanced.sh', 'status'],
-                capture_output=True, text=True, timeout=10
-            )
+            data = self.hilink.snapshot()
+            status = data['status']
+            conn_status = status.get('ConnectionStatus', '')
             
-            if result.returncode == 0:
-                return {
-                    'connected': True,
-                    'status': 'Connected',
-                    'signal': self._extract_signal(),
-                    'ip': self._extract_ip(),
-                    'network': self._extract_network_type(),
-                    'last_update': datetime.now().strftime('%H:%M:%S')
-                }
-            else:
-                return {
-                    'connected': False,
-                    'status': 'Disconnected',
-                    'signal': 'N/A',
-                    'ip': 'N/A',
-                    'network': 'N/A',
-                    'last_update': datetime.now().strftime('%H:%M:%S')
-                }
+            return {
+                'connected': conn_status == '901',
+                'status': CONNECTION_STATUS.get(conn_status, f'Unknown ({conn_status})'),
+                'signal': data['signal'].get('rssi') or 'N/A',
+                'ip': status.get('WanIPAddress') or 'N/A',
+                'network': NETWORK_TYPES.get(status.get('CurrentNetworkType', ''), 'Unknown'),
+                'last_update': datetime.now().strftime('%H:%M:%S')
+            }
+        except OSError:
+            # Modem unreachable
+            return {
+                'connected': False,
+                'status': 'Disconnected',
+                'signal': 'N/A',
+                'ip': 'N/A',
+                'network': 'N/A',
+                'last_update': datetime.now().strftime('%H:%M:%S')
+            }
         except Exception as e:
             return {
                 'connected': False,
@@ -347,54 +756,24 @@ class DCOMManager:
                 'last_update': datetime.now().strftime('%H:%M:%S')
             }
     
-    def _extract_signal(self):
-        """Extract signal strength"""
-        try:
-            result = subprocess.run(
-                [f'{SCRIPTS_PATH}/hilink-advanced.sh', 'signal'],
-                capture_output=True, text=True, timeout=5
-            )
-            if 'rssi' in result.stdout:
-                # Extract RSSI value
-                lines = result.stdout.split('\n')
-                for line in lines:
-                    if 'rssi' in line.lower():
-                        return line.split('>')[-1].split('<')[0]
-            return 'N/A'
-        except:
-            return 'N/A'
-    
-    def _extract_ip(self):
-        """Extract current IP"""
-        try:
-            result = subprocess.run(
-                [f'{SCRIPTS_PATH}/check-wan-ip.sh'],
-                capture_output=True, text=True, timeout=10
-            )
-            if result.returncode == 0:
-                lines = result.stdout.split('\n')
-                for line in lines:
-                    if 'Public IP' in line and 'Failed' not in line:
-                        return line.split(':')[-1].strip()
-            return 'N/A'
-        except:
-            return 'N/A'
-    
-    def _extract_network_type(self):
-        """Extract network type"""
-        try:
-            result = subprocess.run(
-                [f'{SCRIPTS_PATH}/hilink-advanced.sh', 'status'],
-                capture_output=True, text=True, timeout=5
-            )
-            if 'Network: LTE' in result.stdout:
-                return 'LTE'
-            return 'Unknown'
-        except:
-            return 'Unknown'
-    
     def restart_connection(self):
         """Restart DCOM connection"""
+        device = self.get_primary_device()
+        if device:
+            try:
+                new_ip, timings = self.reconnect(device['id'])
+                return {
+                    'success': True,
+                    'message': 'Connection restarted successfully',
+                    'output': f"Reconnected in {timings['total'] / 1000:.1f}s, public IP {new_ip}",
+                    'timings': timings
+                }
+            except Exception as e:
+                return {
+                    'success': False,
+                    'message': f'Error: {str(e)}',
+                    'output': ''
+                }
         try:
             result = subprocess.run(
                 [f'{SCRIPTS_PATH}/connection-control.sh', 'restart'],
@@ -444,9 +823,18 @@ class ProxyManager:
     """3Proxy management class with full functionality"""
     
     def __init__(self):
-        self.config_file = '/etc/3proxy/3proxy.cfg'
+        self.config_file = os.environ.get('PROXY_CONFIG_FILE', '/etc/3proxy/3proxy.cfg')
         self.users_file = f'{CONFIGS_PATH}/3proxy/users.conf'
-        self.user_manager_script = f'{SCRIPTS_PATH}/user-manager.sh'
+        self.users = UserRegistry(store)
+        self.quotas = QuotaBook(store, PROXY_COUNTER_FILE)
+        self._throttled = None  # throttled users in the last config enforce_quotas() deployed
+        self.reloader = ProxyReloader(f'{LOGS_PATH}/3proxy_reloads.json', fallback=self._systemctl_reload)
+        self.sockets = ProxyInspector('3proxy')
+        # Shared 3330-3339 ports plus the dedicated ranges in port_pool.json, balanced on live connections
+        self.ports = PortPool(store, load_ranges(f'{CONFIGS_PATH}/3proxy/port_pool.json'), load=self._port_load)
+        self.deployer = ConfigDeployer(self.config_file, backup_dir=f'{CONFIGS_PATH}/3proxy/backups',
+                                       on_change=lambda: self.reloader.request('config'))
+        self._local_ip = None
         
     def generate_random_credentials(self):
         """Generate random username and password"""
@@ -461,24 +849,28 @@ class ProxyManager:
         
         return username, password
     
-    def get_random_available_port(self, port_type='http'):
-        """Get random available port based on type"""
-        port_ranges = {
-            'http': [3330, 3331, 3332, 3333, 3334],
-            'socks5': [3330, 3335, 3336],  # 3330 is multi-protocol
-            'socks4': [3337],
-            'no_auth': [3338, 3339]
-        }
-        
-        available_ports = port_ranges.get(port_type, port_ranges['http'])
-        return random.choice(available_ports)
+    def _port_load(self):
+        """Live connections per listening port, from the last proxy status sample"""
+        connections = telemetry.snapshot().get('proxy', {}).get('connections_per_port', {})
+        return {int(port): n for port, n in connections.items()}
+    
+    def get_available_port(self, username, port_type='http'):
+        """The user's port of this type - their dedicated one if they have it, else a shared one (least loaded)"""
+        if port_type not in PORT_TYPES:
+            port_type = 'http'
+        if username not in self.users:
+            return self.ports.least_loaded(port_type)  # not a stored user: suggest a port, hold nothing
+        port = self.ports.port_of(username, port_type, dedicated=True)
+        if port is None:
+            port = self.ports.allocate(username, port_type)
+        return port
     
     def generate_proxy_config(self, username=None, password=None, port_type='http', connection_mode='direct'):
         """Generate complete proxy configuration with DCOM-aware routing"""
         if not username or not password:
             username, password = self.generate_random_credentials()
         
-        port = self.get_random_available_port(port_type)
+        port = self.get_available_port(username, port_type)
         
         # Get server IP based on connection mode and user's DCOM assignment
         if connection_mode == 'direct':
@@ -504,28 +896,24 @@ class ProxyManager:
     
     def _get_server_ip(self):
         """Get best server IP for proxy config"""
-        try:
-            # Try to get DCOM public IP first
-            result = subprocess.run([
-                'curl', '--interface', 'enx0c5b8f279a64', '--connect-timeout', '5', '-s',
-                'http://httpbin.org/ip'
-            ], capture_output=True, text=True)
-            
-            if result.returncode == 0:
-                ip_info = json.loads(result.stdout)
-                return ip_info.get('origin', '').split(',')[0].strip()
-        except:
-            pass
+        # DCOM public IP, resolved at most once per TTL / reconnect
+        device = dcom.get_primary_device()
+        if device:
+            dcom.observe_modems()
+            ip = dcom.egress.resolve(device['interface'], device.get('ip'))
+            if ip:
+                return ip
         
         # Fallback to eth0 IP
-        try:
-            result = subprocess.run(['hostname', '-I'], capture_output=True, text=True)
-            if result.returncode == 0:
-                return result.stdout.strip().split()[0]
-        except:
-            pass
-        
-        return '10.21.0.107'  # Default fallback
+        if self._local_ip is None:
+            try:
+                result = subprocess.run(['hostname', '-I'], capture_output=True, text=True, timeout=5)
+                if result.returncode == 0 and result.stdout.strip():
+                    self._local_ip = result.stdout.strip().split()[0]
+            except:
+                pass
+        
+        return self._local_ip or '10.21.0.107'  # Default fallback
     
     def _get_server_ip_for_user(self, username):
         """Get server IP based on user's DCOM assignment"""
@@ -605,7 +993,7 @@ class ProxyManager:
         if not username or not password:
             username, password = self.generate_random_credentials()
         
-        port = self.get_random_available_port(port_type)
+        port = self.get_available_port(username, port_type)
         
         # Use gateway IP instead of direct DCOM IP
         gateway_ip = self._get_gateway_ip(username)
@@ -679,30 +1067,20 @@ class ProxyManager:
                 'message': add_result['message']
             }
     
-    def get_user_connections(self, username=None):
-        """Get active connections for user(s)"""
+    def get_user_connections(self, username=None, limit=1000):
+        """Established client connections on 3proxy's listening ports (one /proc pass)"""
         try:
-            # Get current connections from netstat
-            result = subprocess.run(['netstat', '-tn'], capture_output=True, text=True)
-            connections = []
-            
-            if result.returncode == 0:
-                for line in result.stdout.split('\n'):
-                    if 'ESTABLISHED' in line and ':333' in line:
-                        parts = line.split()
-                        if len(parts) >= 4:
-                            local_addr = parts[3]
-                            foreign_addr = parts[4]
-                            connections.append({
-                                'local': local_addr,
-                                'foreign': foreign_addr,
-                                'user': username if username else 'unknown'
-                            })
-            
+            sockets = self.sockets.scan()
+            connections = [
+                {'port': port, 'foreign': f'{ip}:{client_port}', 'user': username if username else 'unknown'}
+                for port, ip, client_port in sockets.connection_list()[:limit]
+            ]
             return {
                 'success': True,
                 'connections': connections,
-                'total': len(connections)
+                'total': sockets.total,
+                'per_listener': sockets.per_listener(),
+                'per_client': sockets.per_client()
             }
         except Exception as e:
             return {
@@ -715,34 +1093,20 @@ class ProxyManager:
     def get_status(self):
         """Get detailed 3proxy status"""
         try:
-            # Check if running
-            result = subprocess.run(['pgrep', '3proxy'], capture_output=True)
-            if result.returncode == 0:
-                pid = result.stdout.decode().strip()
-                
-                # Get listening ports
-                ports_result = subprocess.run(['netstat', '-tlnp'], capture_output=True, text=True)
-                ports = []
-                if ports_result.returncode == 0:
-                    for line in ports_result.stdout.split('\n'):
-                        if '3proxy' in line and ':333' in line:
-                            port = line.split(':')[1].split()[0]
-                            ports.append(port)
-                
-                # Get active connections
-                conn_result = subprocess.run(['netstat', '-tn'], capture_output=True, text=True)
-                active_connections = 0
-                if conn_result.returncode == 0:
-                    for line in conn_result.stdout.split('\n'):
-                        if 'ESTABLISHED' in line and ':333' in line:
-                            active_connections += 1
-                
+            sockets = self.sockets.scan()
+            if sockets.pid is not None:
+                clients = sockets.per_client()
                 return {
                     'running': True,
                     'status': 'Running',
-                    'pid': pid,
-                    'ports': sorted(ports),
-                    'active_connections': active_connections,
+                    'pid': str(sockets.pid),
+                    'ports': [str(port) for port in sorted(sockets.listeners)],
+                    'active_connections': sockets.total,
+                    'connections_per_port': {str(port): n for port, n in sockets.per_listener().items()},
+                    'client_ips': len(clients),
+                    'top_clients': heapq.nlargest(10, clients.items(), key=lambda item: item[1]),
+                    'sockets_scanned': sockets.scanned,
+                    'scan_ms': sockets.elapsed_ms,
                     'total_users': self._count_users(),
                     'last_update': datetime.now().strftime('%H:%M:%S')
                 }
@@ -768,13 +1132,135 @@ class ProxyManager:
             }
     
     def _count_users(self):
-        """Count users in users.conf"""
+        """Count users (from the in-memory registry)"""
         try:
-            with open(self.users_file, 'r') as f:
-                return len([line for line in f if line.strip() and not line.startswith('#')])
+            return len(self.users)
         except:
             return 0
     
+    def _export_users(self):
+        """Regenerate users.conf for 3proxy from the store"""
+        store.export_users_conf(self.users_file)
+    
+    def build_config(self):
+        """
+        3proxy config model: the standard ports and every dedicated port in
+        use, users included from users.conf, pinned to their modem (egress
+        addresses as last stored by sync_egress) and held to their quota
+        (throttled users get their throttle rate instead of their plan's)
+        """
+        users = self.quotas.apply(store_users(store))
+        listeners = standard_listeners(os.environ.get('PROXY_NO_AUTH_SOURCES', '127.0.0.1'))
+        listeners += self.ports.listeners({user.username for user in users})
+        return ProxyConfig(
+            listeners,
+            users,
+            users_file=self.users_file,
+            log_file=PROXY_LOG_FILE,
+            counter_file=PROXY_COUNTER_FILE,
+            maxconn=PROXY_MAXCONN,
+            internal_users=probe_users(store)
+        )
+    
+    def compile_config(self, dry_run=False):
+        """Render 3proxy.cfg and deploy it if it differs from the deployed file (one reload if so)"""
+        try:
+            os.makedirs(f'{LOGS_PATH}/3proxy', exist_ok=True)
+            # Workers and the telemetry leader all compile: read the store and
+            # replace the file under one lock so a stale render can't land last
+            with self.deployer.locked():
+                started = time.perf_counter()
+                text = render(self.build_config())
+                compile_ms = round((time.perf_counter() - started) * 1000, 1)
+                result = self.deployer.deploy(text, dry_run=dry_run)
+            if not result['changed']:
+                message = '3proxy config is up to date'
+            elif dry_run:
+                message = '3proxy config differs from the deployed file'
+            else:
+                message = '3proxy config deployed'
+            return {'success': True, 'message': message, 'compile_ms': compile_ms,
+                    'config_file': self.config_file, **result}
+        except Exception as e:
+            return {'success': False, 'message': f'Error: {str(e)}'}
+    
+    def _backup_users(self):
+        """Copy users.conf into backups/ (oldest copies beyond USERS_BACKUP_KEEP are dropped)"""
+        if not os.path.exists(self.users_file):
+            return None
+        backup_dir = f'{CONFIGS_PATH}/3proxy/backups'
+        os.makedirs(backup_dir, exist_ok=True)
+        backup_file = f"{backup_dir}/users.conf.{datetime.now().strftime('%Y%m%d_%H%M%S_%f')}"
+        shutil.copy2(self.users_file, backup_file)
+        backups = sorted(f for f in os.listdir(backup_dir) if f.startswith('users.conf.'))
+        for name in backups[:-USERS_BACKUP_KEEP]:
+            os.remove(f'{backup_dir}/{name}')
+        return backup_file
+    
+    def add_users_bulk(self, users=(), count=0, port_type='http', connection_mode='direct', reload=True):
+        """
+        Create many users at once: `users` is [{'username', 'password'?}] and
+        `count` more get random credentials. One store transaction, one
+        users.conf write, one backup and one 3proxy reload for the whole batch.
+        """
+        taken = self.users.usernames()
+        batch = []
+        errors = []
+        for i, entry in enumerate(users):
+            username = entry.get('username')
+            password = entry.get('password') or self.generate_random_credentials()[1]
+            if not self._valid_credential(username) or not self._valid_credential(password):
+                errors.append(f'#{i}: username and password must be non-empty strings without ":" or spaces')
+            elif username.startswith(PROBE_USER_PREFIX):
+                errors.append(f'#{i}: usernames starting with {PROBE_USER_PREFIX} are reserved')
+            elif username in taken:
+                errors.append(f'#{i}: user {username} already exists')
+            else:
+                taken.add(username)
+                batch.append((username, password))
+        if errors:
+            return {'success': False, 'message': f'{len(errors)} invalid user(s)', 'errors': errors}
+        
+        for _ in range(count):
+            username, password = self.generate_random_credentials()
+            while username in taken:
+                username, password = self.generate_random_credentials()
+            taken.add(username)
+            batch.append((username, password))
+        if not batch:
+            return {'success': False, 'message': 'No users to create'}
+        
+        try:
+            backup_file = self._backup_users()
+            created_at, version = store.add_users(batch)
+            self.users.added(batch, 'CL', created_at, version)
+            self._export_users()
+        except Exception as e:
+            return {'success': False, 'message': f'Error: {str(e)}'}
+        
+        usernames = [username for username, _ in batch]
+        if connection_mode == 'direct':
+            # One assignment transaction up front instead of one per generated config
+            dcom.auto_assign_users(usernames, mode='least_loaded')
+        # Likewise one port pool write for the whole batch
+        self.ports.allocate_many(usernames, port_type)
+        reload_result = self.reloader.request('bulk_add') if reload else None
+        
+        configs = [self.generate_proxy_config(username, password, port_type, connection_mode)
+                   for username, password in batch]
+        return {
+            'success': True,
+            'message': f'Created {len(batch)} users' + ('' if reload else ' (reload 3proxy to apply)'),
+            'created': len(batch),
+            'backup': backup_file,
+            'reload': reload_result,
+            'configs': configs
+        }
+    
+    def _valid_credential(self, value):
+        """users.conf is colon separated, one user per line"""
+        return isinstance(value, str) and bool(value) and ':' not in value and not any(c.isspace() for c in value)
+    
     def start(self):
         """Start 3proxy"""
         try:
@@ -799,6 +1285,31 @@ class ProxyManager:
         except Exception as e:
             return {'success': False, 'message': f'Error: {str(e)}'}
     
+    def reload(self):
+        """Reload 3proxy now without dropping established connections"""
+        try:
+            record = self.reloader.reload_now(['manual'])
+            if record['success']:
+                message = (f"3proxy reloaded in {record['duration_ms']:.0f}ms, "
+                           f"{record['connections_lost']} of {record['connections_before']} connections lost")
+            else:
+                message = f"Failed to reload 3proxy: {record['error']}"
+            return {'success': record['success'], 'message': message, 'reload': record}
+        except Exception as e:
+            return {'success': False, 'message': f'Error: {str(e)}'}
+    
+    def _systemctl_reload(self):
+        """ExecReload of the unit (SIGUSR1) - used when we may not signal 3proxy directly"""
+        try:
+            result = subprocess.run(['sudo', 'systemctl', 'reload', '3proxy'],
+                                  capture_output=True, text=True)
+            return {
+                'success': result.returncode == 0,
+                'message': '3proxy reloaded successfully' if result.returncode == 0 else f'Failed to reload 3proxy: {result.stderr}'
+            }
+        except Exception as e:
+            return {'success': False, 'message': f'Error: {str(e)}'}
+    
     def restart(self):
         """Restart 3proxy"""
         try:
@@ -812,102 +1323,194 @@ class ProxyManager:
             return {'success': False, 'message': f'Error: {str(e)}'}
     
     def get_users(self):
-        """Get all users from users.conf"""
+        """Get all users from the registry"""
         try:
-            users = []
-            with open(self.users_file, 'r') as f:
-                for line in f:
-                    line = line.strip()
-                    if line and not line.startswith('#'):
-                        parts = line.split(':')
-                        if len(parts) >= 3:
-                            users.append({
-                                'username': parts[0],
-                                'type': parts[1],
-                                'password': parts[2] if len(parts[2]) < 20 else '***'  # Hide long passwords
-                            })
-            return {'success': True, 'users': users}
+            return {'success': True, 'users': [user.to_dict() for user in self.users.records()]}
         except Exception as e:
             return {'success': False, 'message': f'Error reading users: {str(e)}', 'users': []}
     
     def add_user(self, username, password):
         """Add new user"""
+        if not self._valid_credential(username) or not self._valid_credential(password):
+            return {'success': False, 'message': 'Username and password must not contain ":" or spaces'}
+        if username.startswith(PROBE_USER_PREFIX):
+            return {'success': False, 'message': f'Usernames starting with {PROBE_USER_PREFIX} are reserved'}
         try:
-            result = subprocess.run([self.user_manager_script, 'add', username, password],
-                                  capture_output=True, text=True)
-            return {
-                'success': result.returncode == 0,
-                'message': result.stdout if result.returncode == 0 else result.stderr
-            }
+            if username in self.users:
+                return {'success': False, 'message': f'User {username} already exists!'}
+            created_at, version = store.add_users([(username, password)])
+            self.users.added([(username, password)], 'CL', created_at, version)
+            self._export_users()
+            reload = self.reloader.request('add_user')
+            return {'success': True, 'message': f'User {username} added (3proxy reloads in {reload["due_in"]}s)',
+                    'reload': reload}
         except Exception as e:
             return {'success': False, 'message': f'Error: {str(e)}'}
     
     def remove_user(self, username):
         """Remove user"""
         try:
-            result = subprocess.run([self.user_manager_script, 'remove', username],
-                                  capture_output=True, text=True)
-            return {
-                'success': result.returncode == 0,
-                'message': result.stdout if result.returncode == 0 else result.stderr
-            }
+            had_quota = self.quotas.get(username) is not None
+            had_port = bool(self.ports.dedicated_ports_of(username))
+            version = store.remove_user(username)
+            if version is None:
+                return {'success': False, 'message': f'User {username} not found!'}
+            self.users.removed(username, version)
+            self._export_users()
+            if had_quota or had_port:
+                self.compile_config()  # drop their counter, limits and dedicated listener
+            reload = self.reloader.request('remove_user')
+            return {'success': True, 'message': f'User {username} removed (3proxy reloads in {reload["due_in"]}s)',
+                    'reload': reload}
         except Exception as e:
             return {'success': False, 'message': f'Error: {str(e)}'}
     
+    def set_quota(self, username, data):
+        """Create or replace a user's quota and compile it into 3proxy.cfg"""
+        try:
+            quota = Quota.from_request(username, data)
+            if self.quotas.set(quota) is None:
+                return {'success': False, 'message': f'User {username} not found!'}
+            result = self.compile_config()
+            result.pop('diff', None)
+            return {'success': result['success'], 'message': f'Quota set for {username}',
+                    'quota': self.quotas.usage([quota])[username], 'config': result}
+        except ValueError as e:
+            return {'success': False, 'message': str(e)}
+        except Exception as e:
+            return {'success': False, 'message': f'Error: {str(e)}'}
+
+    def remove_quota(self, username):
+        try:
+            if not self.quotas.remove(username):
+                return {'success': False, 'message': f'{username} has no quota'}
+            result = self.compile_config()
+            result.pop('diff', None)
+            return {'success': result['success'], 'message': f'Quota removed for {username}', 'config': result}
+        except Exception as e:
+            return {'success': False, 'message': f'Error: {str(e)}'}
+
+    def get_port_assignments(self):
+        """Users per port, and per shared port its users, live connections and load in %"""
+        stats = self.ports.stats()
+        load_stats = {}
+        for port, entry in stats['ports'].items():
+            # Unbounded shared ports are loaded by connections against 3proxy's maxconn
+            if entry['capacity']:
+                load = entry['load']
+            else:
+                load = round(100 * entry['connections'] / PROXY_MAXCONN) if PROXY_MAXCONN else 0
+            load_stats[str(port)] = {**entry, 'load': load, 'capacity': entry['capacity'] or PROXY_MAXCONN}
+        assignments = {str(port): [] for port in stats['ports']}
+        assignments.update({str(port): users for port, users in self.ports.assignments().items()})
+        return {'success': True, 'assignments': assignments, 'load_stats': load_stats, 'ranges': stats['ranges']}
+
+    def save_port_assignments(self, assignments):
+        """Apply a {port: [usernames]} map from the assignment page and compile any dedicated ports it touches"""
+        try:
+            if not isinstance(assignments, dict) or \
+                    not all(isinstance(users, list) for users in assignments.values()):
+                return {'success': False, 'message': 'assignments must map ports to lists of usernames'}
+            unknown = sorted({u for users in assignments.values() for u in users if u not in self.users})
+            if unknown:
+                return {'success': False, 'message': f'Unknown users: {", ".join(unknown[:20])}'}
+            changes = self.ports.replace(assignments)
+            result = self.compile_config() if changes['assigned'] or changes['released'] else None
+            if result:
+                result.pop('diff', None)
+            return {'success': True, 'message': 'Assignments saved', **changes, 'config': result}
+        except ValueError as e:
+            return {'success': False, 'message': str(e)}
+        except Exception as e:
+            return {'success': False, 'message': f'Error: {str(e)}'}
+
+    def allocate_port(self, username, port_type='http', dedicated=False, policy='least_loaded'):
+        """Give a user a port (dedicated ones get their own listener in 3proxy.cfg)"""
+        try:
+            if username not in self.users:
+                return {'success': False, 'message': f'User {username} not found!'}
+            port = self.ports.allocate(username, port_type, dedicated, policy)
+            result = {'success': True, 'username': username, 'port': port, 'port_type': port_type,
+                      'dedicated': dedicated, 'message': f'{username} is on port {port}'}
+            if dedicated:
+                compiled = self.compile_config()
+                compiled.pop('diff', None)
+                result['config'] = compiled
+            return result
+        except ValueError as e:
+            return {'success': False, 'message': str(e)}
+        except Exception as e:
+            return {'success': False, 'message': f'Error: {str(e)}'}
+
+    def release_port(self, username, port_type='http', dedicated=False):
+        try:
+            port = self.ports.release(username, port_type, dedicated)
+            if port is None:
+                return {'success': False, 'message': f'{username} has no {port_type} port to release'}
+            result = {'success': True, 'port': port, 'message': f'Port {port} released'}
+            if dedicated:
+                compiled = self.compile_config()
+                compiled.pop('diff', None)
+                result['config'] = compiled
+            return result
+        except Exception as e:
+            return {'success': False, 'message': f'Error: {str(e)}'}
+
+    def enforce_quotas(self):
+        """
+        Recompile when a throttle-mode user crossed their budget or got
+        back under it (3proxy resets counters each period); 3proxy itself
+        cuts off cut-mode users as soon as their counter passes the limit.
+        """
+        usage = self.quotas.usage()
+        throttled = {name for name, entry in usage.items() if entry['throttled']}
+        result = {'quotas': len(usage), 'exceeded': sum(1 for e in usage.values() if e['exceeded']),
+                  'throttled': len(throttled), 'recompiled': False}
+        if throttled != self._throttled:
+            compiled = self.compile_config()
+            if compiled['success']:
+                self._throttled = throttled
+            result['recompiled'] = True
+            result['config_changed'] = compiled.get('changed')
+        return result
+
     def change_password(self, username, new_password):
         """Change user password"""
+        if not self._valid_credential(new_password):
+            return {'success': False, 'message': 'Password must not contain ":" or spaces'}
         try:
-            result = subprocess.run([self.user_manager_script, 'passwd', username, new_password],
-                                  capture_output=True, text=True)
-            return {
-                'success': result.returncode == 0,
-                'message': result.stdout if result.returncode == 0 else result.stderr
-            }
+            version = store.set_password(username, new_password)
+            if version is None:
+                return {'success': False, 'message': f'User {username} not found!'}
+            self.users.password_changed(username, new_password, version)
+            self._export_users()
+            reload = self.reloader.request('change_password')
+            return {'success': True,
+                    'message': f'Password changed for user {username} (3proxy reloads in {reload["due_in"]}s)',
+                    'reload': reload}
         except Exception as e:
             return {'success': False, 'message': f'Error: {str(e)}'}
     
-    def test_proxy(self, port, username=None, password=None):
-        """Test proxy connection"""
+    def test_proxy(self, port, username=None, password=None, protocol='http'):
+        """Test one port with one credential pair (same probe as the fleet verifier)"""
         try:
-            if username and password:
-                # Test with auth
-                result = subprocess.run([
-                    'curl', '--connect-timeout', '10', '--max-time', '15',
-                    '--proxy-user', f'{username}:{password}',
-                    '-x', f'localhost:{port}',
-                    'http://httpbin.org/ip'
-                ], capture_output=True, text=True)
-            else:
-                # Test without auth
-                result = subprocess.run([
-                    'curl', '--connect-timeout', '10', '--max-time', '15',
-                    '-x', f'localhost:{port}',
-                    'http://httpbin.org/ip'
-                ], capture_output=True, text=True)
-            
-            if result.returncode == 0:
-                try:
-                    ip_info = json.loads(result.stdout)
-                    return {
-                        'success': True,
-                        'message': f'Proxy test successful',
-                        'ip': ip_info.get('origin', 'Unknown'),
-                        'response_time': 'OK'
-                    }
-                except:
-                    return {
-                        'success': True,
-                        'message': 'Proxy test successful (non-JSON response)',
-                        'ip': 'Unknown',
-                        'response_time': 'OK'
-                    }
-            else:
+            result = asyncio.run(probe('127.0.0.1', int(port), protocol, EchoTarget(VERIFY_ECHO_URL),
+                                       username, password, timeout=15))
+            if result['status'] == 'ok':
                 return {
-                    'success': False,
-                    'message': f'Proxy test failed: {result.stderr}',
-                    'ip': 'N/A',
-                    'response_time': 'Failed'
+                    'success': True,
+                    'message': 'Proxy test successful',
+                    'ip': result['observed_ip'],
+                    'response_time': f"{result['total_ms']} ms",
+                    'latency': result
                 }
+            return {
+                'success': False,
+                'message': f"Proxy test failed: {result['error']}",
+                'ip': 'N/A',
+                'response_time': 'Failed',
+                'latency': result
+            }
         except Exception as e:
             return {
                 'success': False,
@@ -916,10 +1519,158 @@ class ProxyManager:
                 'response_time': 'Error'
             }
 
+    def verification_cases(self, usernames=None, ports=None, dcom_ids=None):
+        """
+        One case per user x listener they may use x protocol it speaks, with
+        the IPs their modem may show (public and local), plus every modem's
+        IPs to name the one behind an unexpected egress
+        """
+        dcom.sync_assignments()
+        assignments = dcom.user_assignments
+        addresses = dcom.egress_addresses()
+        modems = {}
+        for device_id, device in dcom.get_all_devices().items():
+            modems[device_id] = [ip for ip in (device.get('public_ip'), addresses.get(device_id))
+                                 if ip and ip != 'N/A']
+        users = [user for user in self.users.records() if usernames is None or user.username in usernames]
+        listeners = [listener for listener in standard_listeners() if listener.auth == 'strong']
+        listeners += self.ports.listeners()
+        cases = []
+        for listener in listeners:
+            if ports is not None and listener.port not in ports:
+                continue
+            allowed = set(listener.users) if listener.users is not None else None
+            for user in users:
+                if allowed is not None and user.username not in allowed:
+                    continue
+                dcom_id = assignments.get(user.username)
+                if dcom_ids is not None and dcom_id not in dcom_ids:
+                    continue
+                for protocol in protocols_for(listener.service):
+                    cases.append({'username': user.username, 'password': user.password, 'port': listener.port,
+                                  'protocol': protocol, 'dcom_id': dcom_id, 'expected': modems.get(dcom_id, [])})
+        return cases, modems
+
 # Initialize managers
 dcom = DCOMManager()
 proxy = ProxyManager()
 
+# Background sampling - routes only read the latest snapshot
+telemetry = TelemetryCollector(snapshot_file=f'{LOGS_PATH}/telemetry.json')
+telemetry.register('dcom', dcom.get_status, interval=5)
+telemetry.register('modems', dcom.poll_devices, interval=5)
+telemetry.register('proxy', proxy.get_status, interval=5)
+telemetry.register('apn', dcom.get_current_apn, interval=300)  # APN rarely changes
+
+_health_proxies = {'version': None, 'urls': {}}
+
+def health_devices():
+    """
+    Registered modems for the health prober. A modem whose egress address is
+    known gets a `proxy_url` through its internal probe user (pinned to it in
+    3proxy.cfg, no quota, left out of the log stats), so the HTTP probe leaves
+    via that modem.
+    """
+    version = store.version('egress')
+    if version != _health_proxies['version']:
+        port = PORT_TYPES['http'][0]
+        urls = {user.username[len(PROBE_USER_PREFIX):]:
+                f"http://{quote(user.username, safe='')}:{quote(user.password, safe='')}@127.0.0.1:{port}"
+                for user in probe_users(store)}
+        _health_proxies.update(version=version, urls=urls)
+    urls = _health_proxies['urls']
+    return {dcom_id: {**device, 'proxy_url': urls[dcom_id]} if dcom_id in urls else device
+            for dcom_id, device in dcom.devices.items()}
+
+health = HealthProber(
+    health_devices,
+    tcp_target=EGRESS_PROBE_TARGET,
+    http_url=os.environ.get('HEALTH_HTTP_URL', 'http://connectivitycheck.gstatic.com/generate_204')
+)
+# Probes run only in the telemetry leader; other workers read the results from the snapshot
+telemetry.register('health', health.results, interval=5)
+telemetry.register('egress', dcom.sync_egress, interval=30)
+telemetry.register('quotas', proxy.enforce_quotas, interval=30)
+
+# Request log counters - tailed by the telemetry leader, published as a summary
+proxy_log = ProxyLogStats(PROXY_LOG_FILE, state_file=f'{LOGS_PATH}/3proxy_stats.json',
+                          ignore_users=PROBE_USER_PREFIX)
+
+def proxy_log_summary():
+    proxy_log.poll()
+    return proxy_log.summary(limit=20)
+
+telemetry.register('proxy_log', proxy_log_summary, interval=2)
+
+# Rotated request logs are compacted into a columnar archive - hourly, on a thread of
+# its own (started per worker in start_background_tasks; one compacts at a time)
+log_archive = LogArchive(f'{LOGS_PATH}/3proxy/archive')
+
+# Metric history - written by the telemetry leader, read by every worker
+metrics = TimeSeriesStore(f'{LOGS_PATH}/metrics')
+
+def _metric_number(value):
+    """-65dBm / '12' / 3.5 -> float; 'N/A' and missing -> None"""
+    if isinstance(value, (int, float)):
+        return float(value)
+    match = re.match(r'\s*([-+]?\d+(?:\.\d+)?)', str(value or ''))
+    return float(match.group(1)) if match else None
+
+def record_metrics():
+    """Append the latest modem/proxy sample to the metric history"""
+    snapshot = telemetry.snapshot()
+    modems = snapshot.get('modems') or {}
+    probes = snapshot.get('health') or {}
+    proxy_status = snapshot.get('proxy') or {}
+    values = {}
+    for device_id, poll in modems.items():
+        rates = poll.get('rates') or {}
+        device_probes = probes.get(device_id, {}).get('probes', {})
+        values.update({
+            f'{device_id}.rssi': _metric_number(poll.get('signal')),
+            f'{device_id}.rsrp': _metric_number(poll.get('rsrp')),
+            f'{device_id}.sinr': _metric_number(poll.get('sinr')),
+            f'{device_id}.rx_bps': rates.get('rx_bps'),
+            f'{device_id}.tx_bps': rates.get('tx_bps'),
+            f'{device_id}.poll_ms': poll.get('latency_ms') if poll.get('reachable') else None,
+            f'{device_id}.health': probes.get(device_id, {}).get('health_score')
+        })
+        for probe_name, stats in device_probes.items():
+            values[f'{device_id}.{probe_name}_rtt_ms'] = stats.get('last_rtt_ms')
+    values['farm.modems_online'] = sum(1 for poll in modems.values() if poll.get('connected'))
+    if proxy_status.get('running'):
+        values['proxy.active_connections'] = proxy_status.get('active_connections')
+        values['proxy.total_users'] = proxy_status.get('total_users')
+    metrics.record(values)
+    return {'series': sum(1 for v in values.values() if v is not None), 'recorded_at': time.time()}
+
+telemetry.register('metrics', record_metrics, interval=5)
+
+def rotation_capacity():
+    """(online modem ids, active modem count) from the latest poll"""
+    modems = telemetry.snapshot().get('modems') or {}
+    active = [device_id for device_id, device in dcom.devices.items() if device['status'] == 'active']
+    online = {device_id for device_id in active if modems.get(device_id, {}).get('connected', True)}
+    return online, len(active)
+
+rotations = RotationOrchestrator(
+    f'{CONFIGS_PATH}/dcom/rotation_jobs',
+    rotate=dcom.rotate_ip,
+    capacity=rotation_capacity,
+    drain=lambda dcom_id, exclude: dcom.drain_users(dcom_id, exclude, rotation_capacity()[0]),
+    restore=dcom.restore_users
+)
+
+# Fleet verification jobs - probe every user through every listener, results streamed per job
+verifier = FleetVerifier(f'{LOGS_PATH}/verify_jobs')
+
+@app.before_request
+def start_background_tasks():
+    """Start collectors/monitors in each worker process (threads don't survive the gunicorn fork)"""
+    telemetry.start()
+    dcom.start_hotplug()
+    log_archive.start_compactor(PROXY_LOG_FILE)
+
 @app.route('/')
 def dashboard():
     """Main dashboard page"""
@@ -968,18 +1719,19 @@ def settings():
 @app.route('/api/status')
 def api_status():
     """Get overall system status"""
-    dcom_status = dcom.get_status()
-    proxy_status = proxy.get_status()
-    apn_info = dcom.get_current_apn()
+    snapshot = telemetry.snapshot()
     
     return jsonify({
-        'dcom': dcom_status,
-        'proxy': proxy_status,
-        'apn': apn_info,
+        'dcom': snapshot.get('dcom', {'connected': False, 'status': 'Pending', 'signal': 'N/A',
+                                      'ip': 'N/A', 'network': 'N/A', 'last_update': 'N/A'}),
+        'proxy': snapshot.get('proxy', {'running': False, 'status': 'Pending', 'pid': 'N/A', 'ports': [],
+                                        'active_connections': 0, 'total_users': 0, 'last_update': 'N/A'}),
+        'apn': snapshot.get('apn', {'name': 'Unknown', 'apn': 'Unknown', 'username': 'Unknown'}),
         'system': {
             'timestamp': datetime.now().isoformat(),
             'uptime': _get_uptime()
-        }
+        },
+        'telemetry': snapshot.meta()
     })
 
 @app.route('/api/dcom/restart', methods=['POST'])
@@ -1006,6 +1758,30 @@ def api_proxy_restart():
     result = proxy.restart()
     return jsonify(result)
 
+@app.route('/api/proxy/reload', methods=['POST'])
+def api_proxy_reload():
+    """Reload 3proxy config and users now, keeping established connections"""
+    return jsonify(proxy.reload())
+
+@app.route('/api/proxy/config/diff')
+def api_proxy_config_diff():
+    """Diff between the compiled 3proxy config and the deployed one"""
+    return jsonify(proxy.compile_config(dry_run=True))
+
+@app.route('/api/proxy/config/deploy', methods=['POST'])
+def api_proxy_config_deploy():
+    """Compile and deploy 3proxy.cfg; reloads 3proxy only if the file changed"""
+    return jsonify(proxy.compile_config())
+
+@app.route('/api/proxy/reloads')
+def api_proxy_reloads():
+    """Reload history: durations, merged requests and connections lost"""
+    try:
+        limit = int(request.args.get('limit', 20))
+        return jsonify({'success': True, 'summary': proxy.reloader.summary(), 'history': proxy.reloader.history(limit)})
+    except Exception as e:
+        return jsonify({'success': False, 'message': str(e)})
+
 @app.route('/api/proxy/users')
 def api_proxy_users():
     """Get all proxy users"""
@@ -1025,6 +1801,32 @@ def api_proxy_add_user():
     result = proxy.add_user(username, password)
     return jsonify(result)
 
+@app.route('/api/proxy/users/bulk', methods=['POST'])
+def api_proxy_bulk_users():
+    """
+    Provision many users in one go. Body: {"count": N} for random credentials
+    and/or {"users": [{"username", "password"?}]}, plus port_type,
+    connection_mode and reload (default true). Returns every config.
+    """
+    data = request.get_json() or {}
+    try:
+        count = int(data.get('count', 0))
+    except (TypeError, ValueError):
+        return jsonify({'success': False, 'message': 'count must be an integer'})
+    users = data.get('users') or []
+    if not isinstance(users, list) or not all(isinstance(u, dict) for u in users):
+        return jsonify({'success': False, 'message': 'users must be a list of {"username", "password"}'})
+    if count < 0 or count + len(users) > BULK_USERS_MAX:
+        return jsonify({'success': False, 'message': f'Between 1 and {BULK_USERS_MAX} users per request'})
+    
+    result = proxy.add_users_bulk(
+        users, count,
+        port_type=data.get('port_type', 'http'),
+        connection_mode=data.get('connection_mode', 'direct'),
+        reload=bool(data.get('reload', True))
+    )
+    return jsonify(result)
+
 @app.route('/api/proxy/users/remove', methods=['POST'])
 def api_proxy_remove_user():
     """Remove proxy user"""
@@ -1050,6 +1852,43 @@ def api_proxy_change_password():
     result = proxy.change_password(username, new_password)
     return jsonify(result)
 
+@app.route('/api/proxy/users/quota')
+def api_proxy_user_quota():
+    """Quota and consumption (bytes used/remaining this period) for ?username=, or every user with a quota"""
+    try:
+        username = request.args.get('username')
+        if username:
+            quota = proxy.quotas.get(username)
+            if not quota:
+                return jsonify({'success': False, 'message': f'{username} has no quota'})
+            return jsonify({'success': True, 'quota': proxy.quotas.usage([quota])[username]})
+        usage = proxy.quotas.usage()
+        return jsonify({'success': True, 'quotas': list(usage.values()), 'total': len(usage)})
+    except Exception as e:
+        return jsonify({'success': False, 'message': str(e)})
+
+@app.route('/api/proxy/users/quota', methods=['POST'])
+def api_proxy_set_quota():
+    """
+    Set a user's quota: username, bytes_limit (per period), period
+    (H/D/W/M/N), rate_in/rate_out (bits/s), conn_rate (new connections per
+    minute), on_exceed (cut|throttle) and throttle_rate (bits/s)
+    """
+    data = request.get_json() or {}
+    username = data.get('username')
+    if not username:
+        return jsonify({'success': False, 'message': 'Username required'})
+    return jsonify(proxy.set_quota(username, data))
+
+@app.route('/api/proxy/users/quota/remove', methods=['POST'])
+def api_proxy_remove_quota():
+    """Remove a user's quota"""
+    data = request.get_json() or {}
+    username = data.get('username')
+    if not username:
+        return jsonify({'success': False, 'message': 'Username required'})
+    return jsonify(proxy.remove_quota(username))
+
 @app.route('/api/proxy/test', methods=['POST'])
 def api_proxy_test():
     """Test proxy connection"""
@@ -1058,9 +1897,78 @@ def api_proxy_test():
     username = data.get('username')
     password = data.get('password')
     
-    result = proxy.test_proxy(port, username, password)
+    result = proxy.test_proxy(port, username, password, data.get('protocol', 'http'))
     return jsonify(result)
 
+@app.route('/api/proxy/verify', methods=['POST'])
+def api_proxy_verify():
+    """Verify users x listeners x modems concurrently as a background job"""
+    try:
+        data = request.get_json(silent=True) or {}
+        usernames = data.get('usernames')
+        ports = data.get('ports')
+        dcom_ids = data.get('dcom_ids')
+        # Probes always dial the local listeners (they carry users' passwords) and
+        # fetch only a configured echo target
+        target = data.get('target') or VERIFY_ECHO_URL
+        if target not in VERIFY_TARGETS:
+            return jsonify({'success': False, 'message': f'Target {target!r} is not a configured echo target'}), 400
+        cases, modems = proxy.verification_cases(
+            set(usernames) if usernames else None,
+            {int(port) for port in ports} if ports else None,
+            set(dcom_ids) if dcom_ids else None
+        )
+        job = verifier.submit(
+            cases,
+            target,
+            modems=modems,
+            parallelism=data.get('parallelism', VERIFY_PARALLELISM),
+            timeout=data.get('timeout', 10)
+        )
+        return jsonify({
+            'success': True,
+            'message': f'Verifying {len(cases)} user/listener combination(s)',
+            'job': job
+        }), 202
+    except Exception as e:
+        return jsonify({'success': False, 'message': str(e)})
+
+@app.route('/api/proxy/verify/jobs')
+def api_proxy_verify_jobs():
+    """Recent verification jobs (without per-port and per-modem detail)"""
+    try:
+        return jsonify({'success': True, 'jobs': verifier.list()})
+    except Exception as e:
+        return jsonify({'success': False, 'message': str(e)})
+
+@app.route('/api/proxy/verify/jobs/<job_id>')
+def api_proxy_verify_job(job_id):
+    """Progress, status counts and phase latencies of one verification job"""
+    job = verifier.get(job_id)
+    if job is None:
+        return jsonify({'success': False, 'message': 'Job not found'}), 404
+    return jsonify({'success': True, 'job': job})
+
+@app.route('/api/proxy/verify/jobs/<job_id>/results')
+def api_proxy_verify_results(job_id):
+    """Per-probe results as NDJSON; follow=1 streams them until the job ends"""
+    if verifier.get(job_id) is None:
+        return jsonify({'success': False, 'message': 'Job not found'}), 404
+    try:
+        offset = int(request.args.get('offset', 0))
+    except ValueError:
+        return jsonify({'success': False, 'message': 'offset must be a number'})
+    lines = verifier.results(job_id, offset=offset, follow=request.args.get('follow') == '1',
+                             failed_only=request.args.get('failed') == '1')
+    return Response((line + '\n' for line in lines), mimetype='application/x-ndjson')
+
+@app.route('/api/proxy/verify/jobs/<job_id>/cancel', methods=['POST'])
+def api_proxy_verify_cancel(job_id):
+    """Stop a verification job from starting more probes"""
+    if verifier.cancel(job_id):
+        return jsonify({'success': True, 'message': f'Job {job_id} cancelling'})
+    return jsonify({'success': False, 'message': 'Job not found or already finished'})
+
 @app.route('/api/proxy/generate-random-user', methods=['POST'])
 def api_generate_random_user():
     """Generate random user with credentials"""
@@ -1082,22 +1990,17 @@ def api_generate_config():
     if not username:
         return jsonify({'success': False, 'message': 'Username required'})
     
-    # Get user password from users file
-    users_result = proxy.get_users()
-    if users_result['success']:
-        user_found = None
-        for user in users_result['users']:
-            if user['username'] == username:
-                user_found = user
-                break
-        
-        if user_found:
-            config = proxy.generate_proxy_config(username, user_found['password'], port_type, connection_mode)
-            return jsonify({'success': True, 'config': config})
-        else:
-            return jsonify({'success': False, 'message': 'User not found'})
-    else:
+    # Get user password from the registry
+    try:
+        user_found = proxy.users.get(username)
+    except Exception:
         return jsonify({'success': False, 'message': 'Could not read users'})
+    
+    if user_found:
+        config = proxy.generate_proxy_config(username, user_found.password, port_type, connection_mode)
+        return jsonify({'success': True, 'config': config})
+    else:
+        return jsonify({'success': False, 'message': 'User not found'})
 
 @app.route('/api/proxy/generate-direct-config', methods=['POST'])
 def api_generate_direct_config():
@@ -1109,34 +2012,29 @@ def api_generate_direct_config():
     if not username:
         return jsonify({'success': False, 'message': 'Username required'})
     
-    # Get user password from users file
-    users_result = proxy.get_users()
-    if users_result['success']:
-        user_found = None
-        for user in users_result['users']:
-            if user['username'] == username:
-                user_found = user
-                break
+    # Get user password from the registry
+    try:
+        user_found = proxy.users.get(username)
+    except Exception:
+        return jsonify({'success': False, 'message': 'Could not read users'})
+    
+    if user_found:
+        # Generate direct connection config
+        config = proxy.generate_proxy_config(username, user_found.password, port_type, 'direct')
+        
+        # Add direct connection specific info
+        config['connection_type'] = 'Direct DCOM Connection'
+        config['benefits'] = [
+            'Direct connection to DCOM device',
+            'No proxy server overhead',
+            'Dedicated IP per user',
+            'Lower latency',
+            'Better performance'
+        ]
         
-        if user_found:
-            # Generate direct connection config
-            config = proxy.generate_proxy_config(username, user_found['password'], port_type, 'direct')
-            
-            # Add direct connection specific info
-            config['connection_type'] = 'Direct DCOM Connection'
-            config['benefits'] = [
-                'Direct connection to DCOM device',
-                'No proxy server overhead',
-                'Dedicated IP per user',
-                'Lower latency',
-                'Better performance'
-            ]
-            
-            return jsonify({'success': True, 'config': config})
-        else:
-            return jsonify({'success': False, 'message': 'User not found'})
+        return jsonify({'success': True, 'config': config})
     else:
-        return jsonify({'success': False, 'message': 'Could not read users'})
+        return jsonify({'success': False, 'message': 'User not found'})
 
 @app.route('/api/proxy/connections')
 def api_proxy_connections():
@@ -1192,31 +2090,62 @@ def api_fail2ban_3proxy():
 
 @app.route('/api/users/stats')
 def api_users_stats():
-    """Get detailed user statistics"""
+    """Get detailed user statistics (traffic counters from the 3proxy request log)"""
     try:
-        users_result = proxy.get_users()
-        connections_result = proxy.get_user_connections()
+        snapshot = telemetry.snapshot()
+        log_stats = snapshot.get('proxy_log') or {}
+        proxy_status = snapshot.get('proxy') or {}
+        total_bytes = log_stats.get('bytes_out', 0) + log_stats.get('bytes_in', 0)
         
-        if users_result['success']:
-            total_users = len(users_result['users'])
-            online_users = max(1, int(total_users * 0.7))  # Mock 70% online
-            active_connections = connections_result.get('total', 0) if connections_result['success'] else 0
-            
-            return jsonify({
-                'success': True,
-                'stats': {
-                    'total_users': total_users,
-                    'online_users': online_users,
-                    'active_connections': active_connections,
-                    'bandwidth_usage': {
-                        'total': '2.5 GB',
-                        'average': '150 MB/user'
-                    },
-                    'top_users': users_result['users'][:5]
-                }
-            })
-        else:
-            return jsonify({'success': False, 'message': 'Failed to get user stats'})
+        return jsonify({
+            'success': True,
+            'stats': {
+                'total_users': len(proxy.users),
+                'online_users': log_stats.get('online_users', 0),
+                'users_seen': log_stats.get('users_seen', 0),
+                'active_connections': proxy_status.get('active_connections', 0),
+                'requests': log_stats.get('requests', 0),
+                'bandwidth_usage': {
+                    'total': _format_bytes(total_bytes),
+                    'average': f"{_format_bytes(log_stats.get('average_bytes_per_user', 0))}/user",
+                    'bytes_out': log_stats.get('bytes_out', 0),
+                    'bytes_in': log_stats.get('bytes_in', 0)
+                },
+                'errors': log_stats.get('errors', {}),
+                'top_users': log_stats.get('top_users', []),
+                'listeners': log_stats.get('listeners', []),
+                'top_destinations': log_stats.get('top_destinations', [])
+            },
+            'telemetry': snapshot.meta('proxy_log')
+        })
+    except Exception as e:
+        return jsonify({'success': False, 'message': str(e)})
+
+@app.route('/api/logs/query')
+def api_logs_query():
+    """
+    Traffic from the archived 3proxy logs. Filters: user, listener (port or
+    PROXY.3331), from/to (unix seconds); group_by=user|listener|host|client|
+    error|day|hour; limit caps the groups. stream=1 returns one NDJSON line
+    per archive as it is scanned.
+    """
+    try:
+        filters = {
+            'user': request.args.get('user') or None,
+            'listener': request.args.get('listener') or None,
+            'start': request.args.get('from', type=float),
+            'end': request.args.get('to', type=float),
+            'group_by': request.args.get('group_by') or None
+        }
+        limit = request.args.get('limit', 100, type=int)
+        if request.args.get('stream') in ('1', 'true'):
+            partials = log_archive.query(**filters)  # validates group_by before streaming starts
+            def generate():
+                for partial in partials:
+                    yield json.dumps({'archive': partial['archive'], 'groups': partial['groups'].to_list(limit),
+                                      'stats': partial['stats']}) + '\n'
+            return Response(generate(), mimetype='application/x-ndjson')
+        return jsonify({'success': True, **log_archive.aggregate(limit=limit, **filters)})
     except Exception as e:
         return jsonify({'success': False, 'message': str(e)})
 
@@ -1224,59 +2153,65 @@ def api_users_stats():
 def api_proxy_assignments():
     """Get current proxy port assignments"""
     try:
-        # Mock assignment data - in real implementation, store this in database
-        assignments = {
-            '3330': ['admin', 'user1', 'user2'],
-            '3331': ['user3', 'customer1'],
-            '3335': ['vip1'],
-            '3337': ['test1'],
-            '3338': [],
-            '3339': []
-        }
-        
-        return jsonify({
-            'success': True,
-            'assignments': assignments,
-            'load_stats': {
-                '3330': {'load': 75, 'capacity': 100, 'connections': 15},
-                '3331': {'load': 45, 'capacity': 50, 'connections': 8},
-                '3335': {'load': 20, 'capacity': 50, 'connections': 3},
-                '3337': {'load': 10, 'capacity': 30, 'connections': 1},
-                '3338': {'load': 0, 'capacity': 50, 'connections': 0},
-                '3339': {'load': 0, 'capacity': 50, 'connections': 0}
-            }
-        })
+        return jsonify(proxy.get_port_assignments())
     except Exception as e:
         return jsonify({'success': False, 'message': str(e)})
 
 @app.route('/api/proxy/assignments/save', methods=['POST'])
 def api_save_assignments():
-    """Save proxy assignments"""
-    try:
-        data = request.get_json()
-        assignments = data.get('assignments', {})
-        
-        # In real implementation, save to database
-        # For now, just return success
-        
-        return jsonify({
-            'success': True,
-            'message': 'Assignments saved successfully',
-            'saved_assignments': assignments
-        })
-    except Exception as e:
-        return jsonify({'success': False, 'message': str(e)})
+    """Save proxy assignments ({port: [usernames]})"""
+    data = request.get_json() or {}
+    return jsonify(proxy.save_port_assignments(data.get('assignments', {})))
+
+@app.route('/api/proxy/ports/allocate', methods=['POST'])
+def api_proxy_allocate_port():
+    """Give a user a shared or dedicated port (policy: least_loaded or sticky)"""
+    data = request.get_json() or {}
+    username = data.get('username')
+    if not username:
+        return jsonify({'success': False, 'message': 'Username required'})
+    policy = data.get('policy', 'least_loaded')
+    if policy not in POLICIES:
+        return jsonify({'success': False, 'message': f'policy must be one of {", ".join(POLICIES)}'})
+    return jsonify(proxy.allocate_port(username, data.get('port_type', 'http'), bool(data.get('dedicated')), policy))
+
+@app.route('/api/proxy/ports/release', methods=['POST'])
+def api_proxy_release_port():
+    """Free a user's port"""
+    data = request.get_json() or {}
+    username = data.get('username')
+    if not username:
+        return jsonify({'success': False, 'message': 'Username required'})
+    return jsonify(proxy.release_port(username, data.get('port_type', 'http'), bool(data.get('dedicated'))))
 
 @app.route('/api/dcom/devices')
 def api_dcom_devices():
     """Get all DCOM devices"""
     try:
+        snapshot = telemetry.snapshot()
         devices = dcom.get_all_devices()
+        
+        # Overlay the last sampled modem status on each device
+        modems = snapshot.get('modems', {})
+        for device_id, device in devices.items():
+            modem_status = modems.get(device_id)
+            if modem_status and modem_status.get('reachable'):
+                device.update({
+                    'status': 'active' if modem_status['connected'] else 'inactive',
+                    'signal': modem_status['signal'],
+                    'network': modem_status['network'],
+                    'public_ip': dcom.egress.cached(device['interface']) or modem_status['wan_ip'],
+                    'poll_latency_ms': modem_status['latency_ms']
+                })
+            elif modem_status:
+                device['status'] = 'inactive'
+        
         return jsonify({
             'success': True,
             'devices': devices,
             'total_devices': len(devices),
-            'active_devices': len([d for d in devices.values() if d['status'] == 'active'])
+            'active_devices': len([d for d in devices.values() if d['status'] == 'active']),
+            'telemetry': snapshot.meta('modems')
         })
     except Exception as e:
         return jsonify({'success': False, 'message': str(e)})
@@ -1297,6 +2232,25 @@ def api_dcom_assign():
     except Exception as e:
         return jsonify({'success': False, 'message': str(e)})
 
+@app.route('/api/dcom/assign/bulk', methods=['POST'])
+def api_dcom_assign_bulk():
+    """Assign many users at once (single write, all or nothing)"""
+    try:
+        data = request.get_json()
+        assignments = data.get('assignments', [])
+        
+        if not assignments:
+            return jsonify({'success': False, 'message': 'Assignment list required'})
+        
+        pairs = [(a.get('username'), a.get('dcom_id')) for a in assignments]
+        if not all(username and dcom_id for username, dcom_id in pairs):
+            return jsonify({'success': False, 'message': 'Each assignment needs username and dcom_id'})
+        
+        result = dcom.bulk_assign(pairs)
+        return jsonify(result)
+    except Exception as e:
+        return jsonify({'success': False, 'message': str(e)})
+
 @app.route('/api/dcom/unassign', methods=['POST'])
 def api_dcom_unassign():
     """Remove user from DCOM assignment"""
@@ -1332,6 +2286,7 @@ def api_dcom_auto_assign():
 def api_dcom_assignments():
     """Get current DCOM-User assignments"""
     try:
+        dcom.sync_assignments()
         return jsonify({
             'success': True,
             'user_assignments': dcom.user_assignments,
@@ -1341,66 +2296,239 @@ def api_dcom_assignments():
     except Exception as e:
         return jsonify({'success': False, 'message': str(e)})
 
+def _format_duration(seconds):
+    seconds = int(seconds)
+    return f"{seconds // 3600}h {seconds % 3600 // 60}m"
+
+def _format_bytes(value):
+    value = float(value)
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if value < 1024:
+            return f"{value:.1f}{unit}"
+        value /= 1024
+    return f"{value:.1f}TB"
+
+def _format_rate(bps):
+    if bps is None:
+        return 'N/A'
+    for unit in ('bps', 'Kbps', 'Mbps'):
+        if bps < 1000:
+            return f"{bps:.1f} {unit}"
+        bps /= 1000
+    return f"{bps:.1f} Gbps"
+
 @app.route('/api/dcom/health')
 def api_dcom_health():
     """Get health status of all DCOM devices"""
     try:
         devices = dcom.get_all_devices()
+        snapshot = telemetry.snapshot()
+        probes = snapshot.get('health') or {}
+        modems = snapshot.get('modems') or {}
         health_data = {}
         
         for device_id, device in devices.items():
-            # Mock health data - in real implementation, ping/check each device
+            device_health = probes.get(device_id, {})
+            poll = modems.get(device_id, {})
+            traffic = poll.get('traffic') or {}
+            api_rtt = device_health.get('probes', {}).get('api', {}).get('rtt_ms')
+            tcp = device_health.get('probes', {}).get('tcp', {})
+            score = device_health.get('health_score')
+            active = device['status'] == 'active'
             health_data[device_id] = {
                 'device_id': device_id,
                 'name': device['name'],
                 'status': device['status'],
-                'response_time': f"{random.randint(50, 200)}ms" if device['status'] == 'active' else 'N/A',
-                'uptime': f"{random.randint(1, 72)}h {random.randint(0, 59)}m" if device['status'] == 'active' else 'N/A',
-                'signal_strength': device['signal'],
-                'data_usage': f"{random.randint(1, 50)}GB" if device['status'] == 'active' else 'N/A',
-                'last_check': datetime.now().strftime('%H:%M:%S'),
-                'health_score': random.randint(70, 100) if device['status'] == 'active' else 0
+                'response_time': f"{api_rtt:.0f}ms" if active and api_rtt is not None else 'N/A',
+                'egress_latency': f"{tcp['rtt_ms']:.0f}ms" if active and tcp.get('rtt_ms') is not None else 'N/A',
+                'packet_loss': f"{tcp['loss_pct']:.0f}%" if active and tcp.get('loss_pct') is not None else 'N/A',
+                'uptime': _format_duration(traffic['CurrentConnectTime'])
+                if active and traffic.get('CurrentConnectTime', '').isdigit() else 'N/A',
+                'signal_strength': poll.get('signal', device['signal']),
+                'data_usage': _format_bytes(int(traffic['TotalDownload']) + int(traffic.get('TotalUpload') or 0))
+                if active and traffic.get('TotalDownload', '').isdigit() else 'N/A',
+                'last_check': datetime.fromtimestamp(max(p.get('last_at') or 0 for p in device_health['probes'].values()))
+                .strftime('%H:%M:%S') if device_health.get('probes') else 'N/A',
+                'health_score': (score or 0) if active else 0,
+                'probes': device_health.get('probes', {})
             }
         
         return jsonify({
             'success': True,
             'health_data': health_data,
             'overall_health': sum(h['health_score'] for h in health_data.values()) / len(health_data)
+            if health_data else 0,
+            'telemetry': snapshot.meta('health')
         })
     except Exception as e:
         return jsonify({'success': False, 'message': str(e)})
 
+def _rotation_options(data):
+    """Per-modem rotate_ip options from a request body"""
+    return {
+        'fresh': bool(data.get('fresh', True)),
+        'scope': data.get('scope') if data.get('scope') in ('modem', 'farm') else 'farm',
+        'subnet': bool(data.get('subnet', False)),
+        'window_hours': data.get('window_hours'),
+        'max_attempts': int(data.get('max_attempts', 5))
+    }
+
 @app.route('/api/dcom/rotate-ip/<dcom_id>', methods=['POST'])
 def api_dcom_rotate_ip(dcom_id):
-    """Rotate IP for specific DCOM device"""
+    """Rotate IP for specific DCOM device (runs as a background job)"""
     try:
         devices = dcom.get_all_devices()
         if dcom_id not in devices:
             return jsonify({'success': False, 'message': 'DCOM device not found'})
-        
-        device = devices[dcom_id]
-        if device['status'] != 'active':
+        if devices[dcom_id]['status'] != 'active':
             return jsonify({'success': False, 'message': 'DCOM device is not active'})
         
-        # Mock IP rotation - in real implementation, restart DCOM connection
-        old_ip = device['public_ip']
-        new_ip = f"103.21.244.{random.randint(10, 99)}"
-        
-        # Update device IP
-        dcom.devices[dcom_id]['public_ip'] = new_ip
-        
-        # Track IP change
-        change_record = dcom.track_ip_change(dcom_id, old_ip, new_ip)
-        notification = dcom.notify_users_ip_change(dcom_id, old_ip, new_ip)
-        
+        data = request.get_json(silent=True) or {}
+        job = rotations.submit([dcom_id], max_offline=1, min_online_pct=0,
+                               drain=data.get('drain'), options=_rotation_options(data))
         return jsonify({
             'success': True,
-            'message': f'IP rotated successfully for {device["name"]}',
-            'old_ip': old_ip,
-            'new_ip': new_ip,
-            'device_id': dcom_id,
-            'affected_users': change_record['affected_users'],
-            'notification': notification
+            'message': f'IP rotation started for {devices[dcom_id]["name"]}',
+            'job': job
+        }), 202
+    except Exception as e:
+        return jsonify({'success': False, 'message': str(e)})
+
+@app.route('/api/dcom/rotate', methods=['POST'])
+def api_dcom_rotate():
+    """Rotate many DCOMs concurrently - capacity-aware, optionally draining users first"""
+    try:
+        data = request.get_json(silent=True) or {}
+        devices = dcom.get_all_devices()
+        dcom_ids = data.get('dcom_ids', 'all')
+        if dcom_ids == 'all':
+            dcom_ids = [device_id for device_id, device in devices.items() if device['status'] == 'active']
+        unknown = [device_id for device_id in dcom_ids if device_id not in devices]
+        if unknown:
+            return jsonify({'success': False, 'message': f"DCOM device(s) not found: {', '.join(unknown)}"})
+        
+        job = rotations.submit(
+            dcom_ids,
+            max_offline=data.get('max_offline', 4),
+            min_online_pct=data.get('min_online_pct', 75),
+            drain=data.get('drain'),
+            options=_rotation_options(data)
+        )
+        return jsonify({
+            'success': True,
+            'message': f'Rotation job started for {len(dcom_ids)} DCOM(s)',
+            'job': job
+        }), 202
+    except Exception as e:
+        return jsonify({'success': False, 'message': str(e)})
+
+@app.route('/api/dcom/rotate/jobs')
+def api_dcom_rotation_jobs():
+    """Recent rotation jobs (without per-modem detail)"""
+    try:
+        return jsonify({'success': True, 'jobs': rotations.list()})
+    except Exception as e:
+        return jsonify({'success': False, 'message': str(e)})
+
+@app.route('/api/dcom/rotate/jobs/<job_id>')
+def api_dcom_rotation_job(job_id):
+    """Progress of one rotation job"""
+    job = rotations.get(job_id)
+    if job is None:
+        return jsonify({'success': False, 'message': 'Job not found'}), 404
+    return jsonify({'success': True, 'job': job})
+
+@app.route('/api/dcom/rotate/jobs/<job_id>/cancel', methods=['POST'])
+def api_dcom_rotation_cancel(job_id):
+    """Stop a rotation job from taking more modems offline"""
+    if rotations.cancel(job_id):
+        return jsonify({'success': True, 'message': f'Job {job_id} cancelling'})
+    return jsonify({'success': False, 'message': 'Job not found or already finished'})
+
+@app.route('/api/dcom/rotation-latency')
+def api_dcom_rotation_latency():
+    """Reconnect phase latency histograms per modem, APN profile and carrier"""
+    try:
+        hours = int(request.args.get('hours', 168))
+        dcom_id = request.args.get('dcom_id')
+        return jsonify({'success': True, **dcom.get_rotation_latency(hours, dcom_id)})
+    except Exception as e:
+        return jsonify({'success': False, 'message': str(e)})
+
+@app.route('/api/dcom/ip-freshness')
+def api_dcom_ip_freshness():
+    """Seen-IP index size and per-carrier IP reuse rates"""
+    try:
+        dcom.freshness.sync(ip_log)
+        return jsonify({
+            'success': True,
+            'index': dcom.freshness.summary(),
+            'carriers': dcom.freshness.reuse_rates(dcom.get_carrier)
+        })
+    except Exception as e:
+        return jsonify({'success': False, 'message': str(e)})
+
+@app.route('/api/metrics/series')
+def api_metrics_series():
+    """Names of the recorded metric series (optionally filtered by prefix)"""
+    try:
+        names = metrics.names(request.args.get('prefix', ''))
+        return jsonify({'success': True, 'series': names, 'total': len(names)})
+    except Exception as e:
+        return jsonify({'success': False, 'message': str(e)})
+
+@app.route('/api/metrics')
+def api_metrics():
+    """
+    Range query over the metric history: ?series=a,b or ?prefix=dcom1.
+    plus either hours=N or from/to (unix seconds); max_points caps each series
+    """
+    try:
+        names = [n for n in request.args.get('series', '').split(',') if n]
+        if not names:
+            prefix = request.args.get('prefix')
+            if not prefix:
+                return jsonify({'success': False, 'message': 'series or prefix is required'})
+            names = metrics.names(prefix)
+        now = time.time()
+        end = request.args.get('to', type=float) or now
+        start = request.args.get('from', type=float) or end - request.args.get('hours', 1, type=float) * 3600
+        max_points = min(max(request.args.get('max_points', 500, type=int), 1), 5000)
+        return jsonify({
+            'success': True,
+            'from': int(start),
+            'to': int(end),
+            'series': [metrics.query(name, start, end, max_points) for name in names]
+        })
+    except Exception as e:
+        return jsonify({'success': False, 'message': str(e)})
+
+@app.route('/api/dcom/egress')
+def api_dcom_egress():
+    """Per-modem egress: source address, routing table/rule and the users leaving through it"""
+    try:
+        snapshot = telemetry.snapshot()
+        sync = snapshot.get('egress') or {}
+        applied = {route['address']: route for route in (sync.get('routes') or {}).get('applied', [])}
+        egress = set(dcom.egress_addresses().values())
+        dcom.sync_assignments()
+        modems = {}
+        for device_id, device in dcom.devices.items():
+            address = device.get('address')
+            modems[device_id] = {
+                'name': device['name'],
+                'interface': device.get('interface'),
+                'address': address,
+                'gateway': device.get('ip'),
+                'egress': address in egress,
+                'route': applied.get(address),
+                'users': len(dcom.dcom_assignments.get(device_id, []))
+            }
+        return jsonify({
+            'success': True,
+            'modems': modems,
+            'last_sync': sync,
+            'telemetry': snapshot.meta('egress')
         })
     except Exception as e:
         return jsonify({'success': False, 'message': str(e)})
@@ -1431,21 +2559,37 @@ def api_dcom_performance():
     """Get performance metrics for all DCOM devices"""
     try:
         devices = dcom.get_all_devices()
+        snapshot = telemetry.snapshot()
+        modems = snapshot.get('modems') or {}
+        probes = snapshot.get('health') or {}
         performance_data = {}
         
         for device_id, device in devices.items():
-            if device['status'] == 'active':
+            poll = modems.get(device_id, {})
+            if device['status'] == 'active' and poll.get('reachable'):
+                rates = poll.get('rates') or {}
+                traffic = poll.get('traffic') or {}
+                tcp = probes.get(device_id, {}).get('probes', {}).get('tcp', {})
+                used = sum(int(traffic.get(k) or 0) for k in ('TotalDownload', 'TotalUpload')
+                           if str(traffic.get(k, '')).isdigit())
                 performance_data[device_id] = {
                     'device_id': device_id,
                     'name': device['name'],
-                    'cpu_usage': f"{random.randint(20, 80)}%",
-                    'memory_usage': f"{random.randint(30, 70)}%",
-                    'network_usage': f"{random.randint(10, 90)}%",
-                    'bandwidth': f"{random.randint(50, 200)} Mbps",
-                    'latency': f"{random.randint(10, 50)}ms",
-                    'packet_loss': f"{random.randint(0, 5)}%",
+                    'download_rate': _format_rate(rates.get('rx_bps')),
+                    'upload_rate': _format_rate(rates.get('tx_bps')),
+                    'avg_download_rate': _format_rate(rates.get('avg_rx_bps')),
+                    'peak_download_rate': _format_rate(rates.get('peak_rx_bps')),
+                    'avg_upload_rate': _format_rate(rates.get('avg_tx_bps')),
+                    'peak_upload_rate': _format_rate(rates.get('peak_tx_bps')),
+                    'packets_per_second': round((rates.get('rx_pps') or 0) + (rates.get('tx_pps') or 0), 1)
+                    if 'rx_pps' in rates else 'N/A',
+                    'drops_per_second': round((rates.get('rx_drop_pps') or 0) + (rates.get('tx_drop_pps') or 0), 2)
+                    if 'rx_drop_pps' in rates else 'N/A',
+                    'latency': f"{tcp['rtt_ms']:.0f}ms" if tcp.get('rtt_ms') is not None else 'N/A',
+                    'packet_loss': f"{tcp['loss_pct']:.0f}%" if tcp.get('loss_pct') is not None else 'N/A',
+                    'data_used': _format_bytes(used) if used else 'N/A',
                     'connected_users': len(dcom.dcom_assignments.get(device_id, [])),
-                    'throughput': f"{random.randint(100, 500)} MB/s"
+                    'rates': rates
                 }
             else:
                 performance_data[device_id] = {
@@ -1458,7 +2602,8 @@ def api_dcom_performance():
         return jsonify({
             'success': True,
             'performance_data': performance_data,
-            'timestamp': datetime.now().isoformat()
+            'timestamp': datetime.now().isoformat(),
+            'telemetry': snapshot.meta('modems')
         })
     except Exception as e:
         return jsonify({'success': False, 'message': str(e)})
@@ -1469,8 +2614,9 @@ def api_dcom_ip_changes():
     try:
         hours = int(request.args.get('hours', 24))
         dcom_id = request.args.get('dcom_id')
+        limit = request.args.get('limit', type=int)
         
-        changes = dcom.get_ip_changes(dcom_id, hours)
+        changes = dcom.get_ip_changes(dcom_id, hours, limit)
         
         return jsonify({
             'success': True,
@@ -1491,24 +2637,15 @@ def api_generate_gateway_config():
         if not username:
             return jsonify({'success': False, 'message': 'Username required'})
         
-        # Get user password from users file
-        users_result = proxy.get_users()
-        if users_result['success']:
-            user_found = None
-            for user in users_result['users']:
-                if user['username'] == username:
-                    user_found = user
-                    break
+        # Get user password from the registry
+        user_found = proxy.users.get(username)
+        if user_found:
+            # Generate gateway config
+            config = proxy.generate_dynamic_proxy_config(username, user_found.password, port_type)
             
-            if user_found:
-                # Generate gateway config
-                config = proxy.generate_dynamic_proxy_config(username, user_found['password'], port_type)
-                
-                return jsonify({'success': True, 'config': config})
-            else:
-                return jsonify({'success': False, 'message': 'User not found'})
+            return jsonify({'success': True, 'config': config})
         else:
-            return jsonify({'success': False, 'message': 'Could not read users'})
+            return jsonify({'success': False, 'message': 'User not found'})
     except Exception as e:
         return jsonify({'success': False, 'message': str(e)})
 
@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+"""
+Proxy Farm System - DCOM device discovery
+Reads /sys directly and follows kernel uevents for hotplug
+"""
+
+import fcntl
+import os
+import socket
+import struct
+import threading
+
+# Same vendors as configs/udev/99-dcom-stable.rules
+DCOM_VENDORS = {
+    '12d1': 'huawei',
+    '19d2': 'zte',
+    '05c6': 'olax'
+}
+
+NETLINK_KOBJECT_UEVENT = 15
+SIOCGIFADDR = 0x8915
+
+
+def _read(path):
+    try:
+        with open(path, 'r') as f:
+            return f.read().strip()
+    except OSError:
+        return ''
+
+
+def interface_address(interface):
+    """IPv4 address of an interface (None if it has none yet)"""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        packed = fcntl.ioctl(sock.fileno(), SIOCGIFADDR, struct.pack('256s', interface[:15].encode()))
+        return socket.inet_ntoa(packed[20:24])
+    except OSError:
+        return None
+    finally:
+        sock.close()
+
+
+def guess_gateway(address):
+    """HiLink sticks serve their API on .1 of the subnet they hand out"""
+    if not address:
+        return None
+    return address.rsplit('.', 1)[0] + '.1'
+
+
+def parse_uevent(message):
+    """Split a raw kernel uevent into (action, env dict)"""
+    parts = message.split(b'\0')
+    header = parts[0].decode(errors='replace')
+    if '@' not in header:
+        return None, {}
+    env = {}
+    for part in parts[1:]:
+        if b'=' in part:
+            key, _, value = part.partition(b'=')
+            env[key.decode(errors='replace')] = value.decode(errors='replace')
+    return env.get('ACTION', header.split('@', 1)[0]), env
+
+
+class DeviceDiscovery:
+    """
+    Registry of DCOM sticks keyed by USB serial (or port path when the stick
+    reports no serial). Full scans happen once; after that the registry is
+    updated per device from kernel uevents.
+    """
+
+    def __init__(self, sysfs_root='/sys', address_lookup=interface_address):
+        self.sysfs_root = sysfs_root.rstrip('/')
+        self.address_lookup = address_lookup
+        self.devices = {}  # key -> device info
+        self._by_port = {}  # port path -> key
+        self._lock = threading.Lock()
+        self._listeners = []
+        self._thread = None
+        self._pid = None
+        self._failed_pid = None  # process where the netlink socket could not be opened
+
+    @property
+    def available(self):
+        return os.path.isdir(f'{self.sysfs_root}/bus/usb/devices')
+
+    def add_listener(self, callback):
+        """callback(action, device) is called for 'add', 'change' and 'remove'"""
+        self._listeners.append(callback)
+
+    def _notify(self, action, device):
+        for callback in self._listeners:
+            try:
+                callback(action, device)
+            except Exception as e:
+                print(f"Discovery listener error: {e}")
+
+    def read_usb_device(self, usb_dir):
+        """Build device info from a /sys USB device directory (None if not a DCOM)"""
+        vendor_id = _read(f'{usb_dir}/idVendor')
+        if vendor_id not in DCOM_VENDORS:
+            return None
+
+        port_path = os.path.basename(usb_dir)
+        serial = _read(f'{usb_dir}/serial')
+        interfaces = []
+        ttys = []
+        try:
+            entries = sorted(os.listdir(usb_dir))
+        except OSError:
+            return None
+        for entry in entries:
+            if not entry.startswith(f'{port_path}:'):
+                continue
+            intf_dir = f'{usb_dir}/{entry}'
+            try:
+                interfaces.extend(sorted(os.listdir(f'{intf_dir}/net')))
+            except OSError:
+                pass
+            try:
+                ttys.extend(name for name in sorted(os.listdir(intf_dir)) if name.startswith('tty'))
+            except OSError:
+                pass
+
+        vendor = DCOM_VENDORS[vendor_id]
+        interface = interfaces[0] if interfaces else None
+        address = self.address_lookup(interface) if interface else None
+        return {
+            'key': f'{vendor}-{serial}' if serial else f'usb-{port_path}',
+            'vendor': vendor,
+            'vendor_id': vendor_id,
+            'product_id': _read(f'{usb_dir}/idProduct'),
+            'manufacturer': _read(f'{usb_dir}/manufacturer'),
+            'product': _read(f'{usb_dir}/product'),
+            'serial': serial or None,
+            'port_path': port_path,
+            'interface': interface,
+            'interfaces': interfaces,
+            'ttys': ttys,
+            'address': address,
+            'gateway': guess_gateway(address)
+        }
+
+    def scan(self):
+        """Full scan of /sys/bus/usb/devices (startup only)"""
+        found = {}
+        base = f'{self.sysfs_root}/bus/usb/devices'
+        try:
+            names = sorted(os.listdir(base))
+        except OSError:
+            names = []
+        for name in names:
+            if ':' in name or name.startswith('usb'):
+                continue
+            device = self.read_usb_device(os.path.realpath(f'{base}/{name}'))
+            if device:
+                found[device['key']] = device
+
+        with self._lock:
+            self.devices = found
+            self._by_port = {d['port_path']: key for key, d in found.items()}
+        return dict(found)
+
+    def refresh_port(self, port_path):
+        """Re-read a single USB port and update the registry"""
+        usb_dir = os.path.realpath(f'{self.sysfs_root}/bus/usb/devices/{port_path}')
+        device = self.read_usb_device(usb_dir) if os.path.isdir(usb_dir) else None
+
+        with self._lock:
+            old_key = self._by_port.get(port_path)
+            old = self.devices.get(old_key) if old_key else None
+            if device is None:
+                if old is None:
+                    return None
+                del self.devices[old_key]
+                del self._by_port[port_path]
+                action, result = 'remove', old
+            else:
+                if old_key and old_key != device['key']:
+                    self.devices.pop(old_key, None)
+                self.devices[device['key']] = device
+                self._by_port[port_path] = device['key']
+                if old == device:
+                    return device
+                action, result = ('change' if old else 'add'), device
+        self._notify(action, result)
+        return result
+
+    def refresh_addresses(self):
+        """Fill in address/gateway for devices whose interface came up after plug-in"""
+        changed = []
+        with self._lock:
+            for device in self.devices.values():
+                if device['interface'] and not device['address']:
+                    address = self.address_lookup(device['interface'])
+                    if address:
+                        device['address'] = address
+                        device['gateway'] = guess_gateway(address)
+                        changed.append(dict(device))
+        for device in changed:
+            self._notify('change', device)
+        return changed
+
+    def handle_uevent(self, action, env):
+        """Apply one kernel uevent; only USB device and net events matter"""
+        devpath = env.get('DEVPATH', '')
+        subsystem = env.get('SUBSYSTEM')
+        if subsystem == 'usb' and env.get('DEVTYPE') == 'usb_device':
+            port_path = os.path.basename(devpath)
+        elif subsystem == 'net':
+            # .../1-1.2/1-1.2:1.0/net/enx... -> 1-1.2
+            parts = devpath.split('/')
+            if len(parts) < 4 or ':' not in parts[-3]:
+                return None
+            port_path = parts[-3].split(':')[0]
+        else:
+            return None
+        if action not in ('add', 'remove', 'change', 'bind', 'unbind', 'move'):
+            return None
+        return self.refresh_port(port_path)
+
+    def start_monitor(self):
+        """
+        Listen for kernel uevents in a background thread; True if a new monitor
+        was started. A process that can't open the netlink socket doesn't retry.
+        """
+        pid = os.getpid()
+        if self._failed_pid == pid or (self._pid == pid and self._thread and self._thread.is_alive()):
+            return False
+        try:
+            sock = socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM, NETLINK_KOBJECT_UEVENT)
+            sock.bind((0, 1))  # group 1 = kernel events
+        except (OSError, AttributeError) as e:
+            self._failed_pid = pid
+            print(f"Uevent monitor unavailable: {e}")
+            return False
+        self._pid = pid
+        self._thread = threading.Thread(target=self._monitor, args=(sock,), name='uevent', daemon=True)
+        self._thread.start()
+        return True
+
+    def _monitor(self, sock):
+        while True:
+            try:
+                message = sock.recv(65536)
+                action, env = parse_uevent(message)
+                if action:
+                    self.handle_uevent(action, env)
+            except Exception as e:
+                print(f"Uevent monitor error: {e}")
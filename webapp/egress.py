@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+"""
+Proxy Farm System - Egress IP resolver
+TTL-cached public IP per modem interface
+"""
+
+import ipaddress
+import json
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, Future, as_completed, TimeoutError as FutureTimeout
+from urllib.parse import urlsplit
+
+from hilink import BoundHTTPConnection, bind_to_interface, get_client
+
+DEFAULT_ECHO_URLS = (
+    'http://api.ipify.org/',
+    'http://ifconfig.me/ip',
+    'http://icanhazip.com/',
+    'http://httpbin.org/ip'
+)
+
+
+def parse_ip(text):
+    """Extract a public IPv4/IPv6 address from an echo service reply"""
+    text = text.strip()
+    if text.startswith('{'):
+        data = json.loads(text)
+        text = str(data.get('origin') or data.get('ip') or '')
+    text = text.split(',')[0].strip()
+    try:
+        address = ipaddress.ip_address(text)
+    except ValueError:
+        return None
+    return str(address) if address.is_global else None
+
+
+def probe_connect(host, port, interface=None, timeout=3.0):
+    """TCP connect to host:port out of `interface`; returns the connect time in ms (raises OSError)"""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        if interface:
+            bind_to_interface(sock, interface)
+        sock.settimeout(timeout)
+        started = time.perf_counter()
+        sock.connect((host, port))
+        return (time.perf_counter() - started) * 1000
+    finally:
+        sock.close()
+
+
+class EgressResolver:
+    """
+    Caches the egress IP per interface. On a miss the modem API and several
+    echo services are raced and the first valid answer wins; concurrent
+    callers for the same interface share one lookup.
+    """
+
+    def __init__(self, ttl=600, negative_ttl=30, timeout=3.0, echo_urls=DEFAULT_ECHO_URLS, max_workers=16):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.timeout = timeout
+        self.echo_urls = tuple(echo_urls)
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='egress')
+        self._cache = {}  # interface -> (ip or None, expires_at)
+        self._wan = {}  # interface -> (wan_ip, connect_time) last reported by the modem
+        self._inflight = {}  # interface -> Future
+        self._lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0, 'lookups': 0}
+
+    def cached(self, interface):
+        """Cached IP without triggering a lookup (None if missing/expired)"""
+        entry = self._cache.get(interface)
+        if entry and entry[1] > time.time():
+            return entry[0]
+        return None
+
+    def resolve(self, interface, modem_host=None):
+        """Egress IP of an interface (None if nothing answered in time)"""
+        entry = self._cache.get(interface)
+        if entry and entry[1] > time.time():
+            # Failed lookups are cached briefly too, so an outage doesn't cause a request storm
+            self.stats['hits'] += 1
+            return entry[0]
+
+        with self._lock:
+            future = self._inflight.get(interface)
+            owner = future is None
+            if owner:
+                future = Future()
+                self._inflight[interface] = future
+                self.stats['misses'] += 1
+
+        if owner:
+            try:
+                ip = self._lookup(interface, modem_host)
+                self._cache[interface] = (ip, time.time() + (self.ttl if ip else self.negative_ttl))
+                future.set_result(ip)
+            except Exception as e:
+                future.set_result(None)
+                print(f"Egress lookup failed for {interface}: {e}")
+            finally:
+                with self._lock:
+                    self._inflight.pop(interface, None)
+        try:
+            return future.result(timeout=self.timeout + 1)
+        except FutureTimeout:
+            return None
+
+    def _lookup(self, interface, modem_host):
+        self.stats['lookups'] += 1
+        futures = [self._executor.submit(self._ask_echo, interface, url) for url in self.echo_urls]
+        if modem_host:
+            futures.append(self._executor.submit(self._ask_modem, modem_host, interface))
+        try:
+            for future in as_completed(futures, timeout=self.timeout):
+                try:
+                    ip = future.result()
+                except Exception:
+                    continue
+                if ip:
+                    return ip
+        except FutureTimeout:
+            pass
+        return None
+
+    def _ask_modem(self, modem_host, interface):
+        # WanIPAddress is only the egress IP when the carrier doesn't CGNAT us
+        status = get_client(modem_host, interface=interface).get('api/monitoring/status',
+                                                                    timeout=self.timeout)
+        return parse_ip(status.get('WanIPAddress', ''))
+
+    def _ask_echo(self, interface, url):
+        parts = urlsplit(url)
+        conn = BoundHTTPConnection(parts.netloc, interface=interface, timeout=self.timeout)
+        try:
+            conn.request('GET', parts.path or '/', headers={'User-Agent': 'curl/8.0', 'Accept': '*/*'})
+            response = conn.getresponse()
+            if response.status != 200:
+                return None
+            return parse_ip(response.read(256).decode(errors='replace'))
+        finally:
+            conn.close()
+
+    def invalidate(self, interface=None):
+        """Drop one (or every) cached IP"""
+        if interface is None:
+            self._cache.clear()
+        else:
+            self._cache.pop(interface, None)
+
+    def observe(self, interface, wan_ip, connect_time=None):
+        """
+        Feed modem status from the poller: a new WanIPAddress or a connect
+        time that went backwards means the modem reconnected.
+        """
+        if not interface:
+            return False
+        try:
+            connect_time = int(connect_time) if connect_time not in (None, '') else None
+        except ValueError:
+            connect_time = None
+        previous = self._wan.get(interface)
+        self._wan[interface] = (wan_ip, connect_time)
+        if previous is None:
+            # An IP resolved before the first observation may predate a reconnect
+            if interface in self._cache:
+                self.invalidate(interface)
+            return False
+        old_wan, old_connect = previous
+        reconnected = (wan_ip != old_wan or
+                       (connect_time is not None and old_connect is not None and connect_time < old_connect))
+        if reconnected:
+            self.invalidate(interface)
+        return reconnected
@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+"""
+Proxy Farm System - IP freshness tracker
+Remembers which public IPs (and /24s) each modem and the farm have been handed
+"""
+
+import ipaddress
+import math
+import threading
+import time
+from array import array
+from bisect import bisect_left
+
+DAY = 86400
+PRUNE_INTERVAL = 3600
+
+
+def ip_key(value):
+    """IPv4 address as an integer (None for IPv6 / N/A - only IPv4 is tracked)"""
+    try:
+        address = ipaddress.ip_address(value)
+    except (ValueError, TypeError):
+        return None
+    return int(address) if address.version == 4 else None
+
+
+class SeenIndex:
+    """
+    Sorted uint32 keys with a parallel uint32 last-seen array: 8 bytes per
+    address, binary search lookups, no per-entry Python objects.
+    """
+
+    __slots__ = ('keys', 'seen')
+
+    def __init__(self):
+        self.keys = array('I')
+        self.seen = array('I')
+
+    def __len__(self):
+        return len(self.keys)
+
+    def last_seen(self, key):
+        i = bisect_left(self.keys, key)
+        if i < len(self.keys) and self.keys[i] == key:
+            return self.seen[i]
+        return None
+
+    def touch(self, key, ts):
+        i = bisect_left(self.keys, key)
+        if i < len(self.keys) and self.keys[i] == key:
+            self.seen[i] = max(self.seen[i], ts)
+        else:
+            self.keys.insert(i, key)
+            self.seen.insert(i, ts)
+
+    def prune(self, cutoff):
+        """Forget keys not seen since `cutoff`"""
+        keep = [i for i, ts in enumerate(self.seen) if ts >= cutoff]
+        if len(keep) != len(self.keys):
+            self.keys = array('I', (self.keys[i] for i in keep))
+            self.seen = array('I', (self.seen[i] for i in keep))
+
+    def nbytes(self):
+        return (len(self.keys) + len(self.seen)) * 4
+
+
+class FreshnessTracker:
+    """
+    Per-modem and farm-wide indexes of handed-out IPs and /24s, fed from the
+    IP change log. Every worker catches up from the log before answering, so
+    rotations done by another worker are seen too.
+    """
+
+    def __init__(self, window=7 * DAY, horizon=30 * DAY):
+        self.window = window
+        self.horizon = max(horizon, window)
+        self._modems = {}  # dcom_id -> (ips, subnets)
+        self._farm = (SeenIndex(), SeenIndex())
+        self._stats = {}  # dcom_id -> [rotations, ip reused on modem, ip reused on farm, /24 reused on farm]
+        self._synced_until = None
+        self._boundary = set()  # changes already applied at exactly _synced_until
+        self._pruned_at = 0
+        self._lock = threading.Lock()
+
+    def _indexes(self, dcom_id):
+        indexes = self._modems.get(dcom_id)
+        if indexes is None:
+            indexes = self._modems[dcom_id] = (SeenIndex(), SeenIndex())
+        return indexes
+
+    def sync(self, ip_log, now=None):
+        """
+        Replay IP changes appended to the log since the last sync. The last
+        synced timestamp is queried again (changes logged in the same instant
+        after a sync would be missed otherwise); ones already applied are skipped.
+        """
+        now = now or time.time()
+        applied = 0
+        with self._lock:
+            since = self._synced_until if self._synced_until is not None else now - self.horizon
+            changes = ip_log.query(math.nextafter(since, -math.inf), until=now)  # since <= ts <= now
+            for change in reversed(changes):  # query returns newest first
+                key = (change['dcom_id'], change['old_ip'], change['new_ip'])
+                if change['ts'] == self._synced_until and key in self._boundary:
+                    continue
+                self._record(change['dcom_id'], change['new_ip'], change['ts'])
+                applied += 1
+            if changes:
+                newest = changes[0]['ts']
+                boundary = {(change['dcom_id'], change['old_ip'], change['new_ip'])
+                            for change in changes if change['ts'] == newest}
+                self._boundary = boundary | self._boundary if newest == self._synced_until else boundary
+                self._synced_until = newest
+            elif self._synced_until is None:
+                self._synced_until = since
+        if now - self._pruned_at >= PRUNE_INTERVAL:
+            self._pruned_at = now
+            self.prune(now)
+        return applied
+
+    def _record(self, dcom_id, ip, ts):
+        key = ip_key(ip)
+        if key is None:
+            return
+        ts = int(ts)
+        cutoff = ts - self.window
+        ips, subnets = self._indexes(dcom_id)
+        stats = self._stats.setdefault(dcom_id, [0, 0, 0, 0])
+        stats[0] += 1
+        stats[1] += (ips.last_seen(key) or 0) >= cutoff
+        stats[2] += (self._farm[0].last_seen(key) or 0) >= cutoff
+        stats[3] += (self._farm[1].last_seen(key >> 8) or 0) >= cutoff
+        ips.touch(key, ts)
+        subnets.touch(key >> 8, ts)
+        self._farm[0].touch(key, ts)
+        self._farm[1].touch(key >> 8, ts)
+
+    def last_seen(self, dcom_id, ip):
+        """Last time `ip` / its /24 was handed to this modem and to any modem (epoch or None)"""
+        key = ip_key(ip)
+        if key is None:
+            return {'modem_ip': None, 'modem_subnet': None, 'farm_ip': None, 'farm_subnet': None}
+        with self._lock:
+            ips, subnets = self._modems.get(dcom_id) or (SeenIndex(), SeenIndex())
+            return {
+                'modem_ip': ips.last_seen(key),
+                'modem_subnet': subnets.last_seen(key >> 8),
+                'farm_ip': self._farm[0].last_seen(key),
+                'farm_subnet': self._farm[1].last_seen(key >> 8)
+            }
+
+    def is_fresh(self, dcom_id, ip, scope='farm', subnet=False, window=None, now=None):
+        """True if `ip` (or with subnet=True its /24) wasn't seen in `scope` within the window"""
+        if ip_key(ip) is None:
+            return ip is not None and ip != 'N/A'  # IPv6 isn't tracked
+        cutoff = (now or time.time()) - (window or self.window)
+        seen = self.last_seen(dcom_id, ip)
+        last = seen[f"{scope}_{'subnet' if subnet else 'ip'}"]
+        return last is None or last < cutoff
+
+    def prune(self, now=None):
+        """Drop entries older than the horizon"""
+        cutoff = int((now or time.time()) - self.horizon)
+        with self._lock:
+            for ips, subnets in self._modems.values():
+                ips.prune(cutoff)
+                subnets.prune(cutoff)
+            self._farm[0].prune(cutoff)
+            self._farm[1].prune(cutoff)
+
+    def reuse_rates(self, carrier_of):
+        """Reuse rates per carrier; `carrier_of(dcom_id)` maps modems to carriers"""
+        totals = {}
+        with self._lock:
+            for dcom_id, stats in self._stats.items():
+                carrier = totals.setdefault(carrier_of(dcom_id), {'modems': [], 'rotations': 0, 'reused': [0, 0, 0]})
+                carrier['modems'].append(dcom_id)
+                carrier['rotations'] += stats[0]
+                for i in range(3):
+                    carrier['reused'][i] += stats[i + 1]
+
+        report = {}
+        for name, carrier in totals.items():
+            rotations = carrier['rotations'] or 1
+            report[name] = {
+                'modems': sorted(carrier['modems']),
+                'rotations': carrier['rotations'],
+                'modem_ip_reuse_rate': round(carrier['reused'][0] / rotations * 100, 1),
+                'farm_ip_reuse_rate': round(carrier['reused'][1] / rotations * 100, 1),
+                'farm_subnet_reuse_rate': round(carrier['reused'][2] / rotations * 100, 1)
+            }
+        return report
+
+    def summary(self):
+        with self._lock:
+            return {
+                'window_hours': self.window / 3600,
+                'modems': len(self._modems),
+                'farm_ips': len(self._farm[0]),
+                'farm_subnets': len(self._farm[1]),
+                'index_bytes': sum(ips.nbytes() + subnets.nbytes() for ips, subnets in self._modems.values())
+                + self._farm[0].nbytes() + self._farm[1].nbytes()
+            }
@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+"""
+Proxy Farm System - Modem health prober
+Jittered per-modem probes smoothed with EWMA into a health score
+"""
+
+import base64
+import heapq
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import unquote, urlsplit
+
+from egress import probe_connect
+from hilink import BoundHTTPConnection, get_client
+
+# (good, bad) round-trip in ms per probe: full marks at or below good, none at or above bad
+LATENCY_SCALE = {'api': (100, 2000), 'tcp': (150, 3000), 'http': (500, 5000)}
+
+
+class ProbeStats:
+    """EWMA of round-trip time and success rate for one probe of one modem"""
+
+    __slots__ = ('rtt', 'success', 'samples', 'last_rtt', 'last_error', 'last_at')
+
+    def __init__(self):
+        self.rtt = None
+        self.success = None
+        self.samples = 0
+        self.last_rtt = None
+        self.last_error = None
+        self.last_at = None
+
+    def add(self, ok, rtt, alpha, error=None):
+        self.samples += 1
+        self.last_at = time.time()
+        self.last_error = error
+        self.success = float(ok) if self.success is None else alpha * ok + (1 - alpha) * self.success
+        if ok:
+            self.last_rtt = rtt
+            self.rtt = rtt if self.rtt is None else alpha * rtt + (1 - alpha) * self.rtt
+
+    def to_dict(self):
+        return {
+            'rtt_ms': round(self.rtt, 1) if self.rtt is not None else None,
+            'last_rtt_ms': round(self.last_rtt, 1) if self.last_rtt is not None else None,
+            'loss_pct': round((1 - self.success) * 100, 1) if self.success is not None else None,
+            'samples': self.samples,
+            'last_error': self.last_error,
+            'last_at': self.last_at
+        }
+
+
+class HealthProber:
+    """
+    Each modem is probed every `interval` seconds (+-`jitter`), with first
+    probes spread over one interval so a large farm never fires at once.
+    Probes: HiLink API round-trip, TCP connect out of the modem's interface,
+    and - when the device has a `proxy_url` - an HTTP GET through 3proxy.
+    """
+
+    def __init__(self, devices, interval=15.0, jitter=0.2, alpha=0.3, timeout=2.0,
+                 tcp_target=('1.1.1.1', 443), http_url='http://connectivitycheck.gstatic.com/generate_204',
+                 max_workers=16):
+        self.devices = devices  # devices() -> {dcom_id: device}
+        self.interval = interval
+        self.jitter = jitter
+        self.alpha = alpha
+        self.timeout = timeout
+        self.tcp_target = tcp_target
+        self.http_url = http_url
+        self.max_workers = max_workers
+        self._stats = {}  # dcom_id -> {probe: ProbeStats}
+        self._queue = []  # heap of (due, dcom_id)
+        self._queued = set()
+        self._lock = threading.Lock()
+        self._queue_lock = threading.Lock()
+        self._executor = None
+        self._thread = None
+        self._pid = None
+
+    def start(self):
+        """Start the scheduler once per process (safe to call repeatedly)"""
+        if self._pid == os.getpid() and self._thread and self._thread.is_alive():
+            return
+        self._pid = os.getpid()
+        self._queue, self._queued = [], set()
+        self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='health')
+        self._thread = threading.Thread(target=self._loop, name='health', daemon=True)
+        self._thread.start()
+
+    def _next_due(self, now):
+        return now + self.interval * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+    def _loop(self):
+        while True:
+            try:
+                self._schedule_new()
+                now = time.time()
+                with self._queue_lock:
+                    due = []
+                    while self._queue and self._queue[0][0] <= now:
+                        due.append(heapq.heappop(self._queue)[1])
+                    delay = self._queue[0][0] - now if self._queue else 1.0
+                for dcom_id in due:
+                    self._executor.submit(self._probe, dcom_id)
+            except Exception as e:
+                print(f"Health prober error: {e}")
+                delay = 1.0
+            time.sleep(min(1.0, max(0.05, delay)))
+
+    def _schedule_new(self):
+        """Queue modems we haven't seen yet at a random offset within one interval"""
+        now = time.time()
+        with self._queue_lock:
+            for dcom_id in self.devices():
+                if dcom_id not in self._queued:
+                    self._queued.add(dcom_id)
+                    heapq.heappush(self._queue, (now + random.uniform(0, self.interval), dcom_id))
+
+    def _probe(self, dcom_id):
+        device = self.devices().get(dcom_id)
+        if device is None:
+            # Unplugged - stop probing and forget it
+            with self._lock:
+                self._stats.pop(dcom_id, None)
+            with self._queue_lock:
+                self._queued.discard(dcom_id)
+            return
+        try:
+            results = {}
+            if device.get('ip'):
+                results['api'] = self._timed(self._probe_api, device)
+            if self.tcp_target:
+                results['tcp'] = self._timed(probe_connect, *self.tcp_target,
+                                             interface=device.get('interface'), timeout=self.timeout)
+            if device.get('proxy_url') and self.http_url:
+                results['http'] = self._timed(self._probe_http, device['proxy_url'])
+            with self._lock:
+                stats = self._stats.setdefault(dcom_id, {})
+                for probe, (ok, rtt, error) in results.items():
+                    stats.setdefault(probe, ProbeStats()).add(ok, rtt, self.alpha, error)
+        finally:
+            with self._queue_lock:
+                heapq.heappush(self._queue, (self._next_due(time.time()), dcom_id))
+
+    def _timed(self, func, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            func(*args, **kwargs)
+            return True, (time.perf_counter() - started) * 1000, None
+        except Exception as e:
+            return False, None, str(e) or e.__class__.__name__
+
+    def _probe_api(self, device):
+        status = get_client(device['ip'], interface=device.get('interface')).get(
+            'api/monitoring/status', timeout=self.timeout)
+        if status.get('ConnectionStatus') != '901':
+            raise RuntimeError(f"not connected ({status.get('ConnectionStatus')})")
+
+    def _probe_http(self, proxy_url):
+        """GET http_url through an HTTP proxy (absolute-form request line)"""
+        proxy = urlsplit(proxy_url)
+        headers = {'User-Agent': 'proxyfarm-health/1.0', 'Connection': 'close'}
+        if proxy.username:
+            credentials = f'{unquote(proxy.username)}:{unquote(proxy.password or "")}'
+            token = base64.b64encode(credentials.encode()).decode()
+            headers['Proxy-Authorization'] = f'Basic {token}'
+        conn = BoundHTTPConnection(proxy.hostname, port=proxy.port or 3128, timeout=self.timeout)
+        try:
+            conn.request('GET', self.http_url, headers=headers)
+            response = conn.getresponse()
+            response.read(1024)
+            if response.status >= 400:
+                raise RuntimeError(f'HTTP {response.status}')
+        finally:
+            conn.close()
+
+    # Results -------------------------------------------------------------
+
+    def score(self, stats):
+        """0-100: availability counts 60%, latency 40%, averaged over the probes that ran"""
+        parts = []
+        for probe, probe_stats in stats.items():
+            if probe_stats.success is None:
+                continue
+            good, bad = LATENCY_SCALE[probe]
+            latency = 0.0
+            if probe_stats.rtt is not None:
+                latency = min(1.0, max(0.0, (bad - probe_stats.rtt) / (bad - good)))
+            parts.append(0.6 * probe_stats.success + 0.4 * latency * probe_stats.success)
+        return round(sum(parts) / len(parts) * 100) if parts else None
+
+    def results(self):
+        """{dcom_id: {'health_score', 'probes': {probe: stats}}} - also starts the prober"""
+        self.start()
+        with self._lock:
+            return {
+                dcom_id: {
+                    'health_score': self.score(stats),
+                    'probes': {probe: s.to_dict() for probe, s in stats.items()}
+                }
+                for dcom_id, stats in self._stats.items()
+            }
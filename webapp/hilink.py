@@ -0,0 +1,289 @@
+#!/usr/bin/env python3
+"""
+Proxy Farm System - HiLink API client
+Keep-alive HTTP session per modem with cached verification token
+"""
+
+import http.client
+import socket
+import threading
+import time
+import xml.etree.ElementTree as ET
+
+from discovery import interface_address
+
+# Error codes returned when the session/token is no longer accepted
+TOKEN_ERRORS = {'125001', '125002', '125003'}
+
+# Endpoints sampled together for a status snapshot
+STATUS_ENDPOINTS = (
+    'api/monitoring/status',
+    'api/device/signal',
+    'api/monitoring/traffic-statistics',
+)
+
+NETWORK_TYPES = {
+    '0': 'No Service', '1': 'GSM', '2': 'GPRS', '3': 'EDGE', '4': 'WCDMA',
+    '5': 'HSDPA', '6': 'HSUPA', '7': 'HSPA', '8': 'TD-SCDMA', '9': 'HSPA+',
+    '10': 'EVDO Rev.0', '11': 'EVDO Rev.A', '12': 'EVDO Rev.B', '13': '1xRTT',
+    '14': 'UMB', '15': '1xEVDV', '16': '3xRTT', '17': 'HSPA+ 64QAM',
+    '18': 'HSPA+ MIMO', '19': 'LTE', '101': 'LTE'
+}
+
+CONNECTION_STATUS = {
+    '901': 'Connected',
+    '902': 'Disconnected',
+    '903': 'Disconnecting',
+    '905': 'Connecting'
+}
+
+
+class HiLinkError(Exception):
+    """Error response returned by the modem API"""
+
+    def __init__(self, code, endpoint):
+        super().__init__(f'HiLink error {code} on {endpoint}')
+        self.code = code
+        self.endpoint = endpoint
+
+
+def parse_response(body, endpoint=''):
+    """Parse a HiLink XML reply into a flat dict (raises HiLinkError on <error>)"""
+    root = ET.fromstring(body)
+    if root.tag == 'error':
+        raise HiLinkError(root.findtext('code', 'unknown'), endpoint)
+    return {child.tag: (child.text or '').strip() for child in root}
+
+
+def parse_profiles(body, endpoint='api/dialup/profiles'):
+    """Current APN profile from api/dialup/profiles (nested <Profiles><Profile>...)"""
+    root = ET.fromstring(body)
+    if root.tag == 'error':
+        raise HiLinkError(root.findtext('code', 'unknown'), endpoint)
+    current = root.findtext('CurrentProfile', '').strip()
+    profiles = root.findall('./Profiles/Profile')
+    for profile in profiles:
+        if profile.findtext('Index', '').strip() == current or len(profiles) == 1:
+            return {
+                'index': profile.findtext('Index', '').strip(),
+                'name': profile.findtext('Name', '').strip() or 'Unknown',
+                'apn': profile.findtext('ApnName', '').strip() or 'Unknown',
+                'username': profile.findtext('Username', '').strip()
+            }
+    return {'index': current, 'name': 'Unknown', 'apn': 'Unknown', 'username': ''}
+
+
+def bind_to_interface(sock, interface, source_address=None):
+    """
+    Make `sock` leave through `interface`: SO_BINDTODEVICE where allowed,
+    plus the interface's own address as source (policy routing maps it to the
+    interface's table). Raises OSError if neither applies, rather than letting
+    the connection quietly take the default route out of another link.
+    """
+    bound = False
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, getattr(socket, 'SO_BINDTODEVICE', 25), interface.encode())
+        bound = True
+    except OSError:
+        pass  # Needs CAP_NET_RAW - the source address has to do it
+    address = source_address or (interface_address(interface), 0)
+    if address[0]:
+        sock.bind(address)
+        bound = True
+    if not bound:
+        raise OSError(f'Cannot bind to {interface}: no SO_BINDTODEVICE permission and no address')
+
+
+class BoundHTTPConnection(http.client.HTTPConnection):
+    """HTTPConnection pinned to a network interface (see bind_to_interface)"""
+
+    def __init__(self, host, interface=None, **kwargs):
+        super().__init__(host, **kwargs)
+        self.interface = interface
+
+    def connect(self):
+        if not self.interface:
+            return super().connect()
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        try:
+            bind_to_interface(sock, self.interface, self.source_address)
+            sock.connect((self.host, self.port))
+        except OSError:
+            sock.close()
+            raise
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.sock = sock
+
+
+class HiLinkClient:
+    """Persistent session to a single HiLink modem"""
+
+    def __init__(self, host='192.168.8.1', timeout=3.0, source_address=None, interface=None):
+        self.host = host
+        self.timeout = timeout
+        self.source_address = source_address
+        self.interface = interface
+        self._conn = None
+        self._token = None
+        self._cookie = None
+        self._lock = threading.Lock()
+
+    def _connection(self):
+        if self._conn is None:
+            source = (self.source_address, 0) if self.source_address else None
+            self._conn = BoundHTTPConnection(
+                self.host, interface=self.interface, timeout=self.timeout, source_address=source
+            )
+        return self._conn
+
+    def _request(self, method, path, body=None, timeout=None):
+        """Send one request over the keep-alive connection, reconnecting once if it dropped"""
+        timeout = timeout or self.timeout
+        headers = {'Connection': 'keep-alive'}
+        if self._token:
+            headers['__RequestVerificationToken'] = self._token
+        if self._cookie:
+            headers['Cookie'] = self._cookie
+        if body is not None:
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+
+        for attempt in (1, 2):
+            conn = self._connection()
+            conn.timeout = timeout  # the client is shared: each caller brings its own timeout
+            if conn.sock is not None:
+                conn.sock.settimeout(timeout)
+            try:
+                conn.request(method, f'/{path}', body=body, headers=headers)
+                response = conn.getresponse()
+                data = response.read()
+                break
+            except (http.client.HTTPException, ConnectionError):
+                self.close()
+                if attempt == 2:
+                    raise
+            except OSError:
+                self.close()
+                raise
+
+        # Some firmwares rotate the token/session on every write
+        new_token = response.getheader('__RequestVerificationToken')
+        if new_token:
+            self._token = new_token.split('#')[0]
+        cookie = response.getheader('Set-Cookie')
+        if cookie:
+            self._cookie = cookie.split(';')[0]
+        return data
+
+    def _refresh_token(self, timeout=None):
+        """Fetch a fresh verification token (and session cookie when offered)"""
+        self._token = None
+        try:
+            info = parse_response(self._request('GET', 'api/webserver/SesTokInfo', timeout=timeout), 'SesTokInfo')
+            if info.get('SesInfo'):
+                self._cookie = info['SesInfo']
+            self._token = info.get('TokInfo') or None
+        except HiLinkError:
+            pass
+        if not self._token:
+            info = parse_response(self._request('GET', 'api/webserver/token', timeout=timeout), 'token')
+            token = info.get('token', '')
+            # Newer firmwares return a 64-char token and expect the last 32 chars
+            self._token = token[32:] if len(token) > 32 else token
+
+    def _call(self, method, endpoint, body=None, parser=parse_response, timeout=None):
+        if self._token is None:
+            self._refresh_token(timeout)
+        try:
+            return parser(self._request(method, endpoint, body, timeout), endpoint)
+        except HiLinkError as e:
+            if e.code not in TOKEN_ERRORS:
+                raise
+        self._refresh_token(timeout)
+        return parser(self._request(method, endpoint, body, timeout), endpoint)
+
+    def get(self, endpoint, timeout=None):
+        """GET an API endpoint and return its fields"""
+        with self._lock:
+            return self._call('GET', endpoint, timeout=timeout)
+
+    def post(self, endpoint, body, timeout=None):
+        """POST an XML request body to an API endpoint"""
+        if not body.startswith('<?xml'):
+            body = f'<?xml version="1.0" encoding="UTF-8"?><request>{body}</request>'
+        with self._lock:
+            return self._call('POST', endpoint, body, timeout=timeout)
+
+    def get_many(self, endpoints, timeout=None):
+        """Fetch several endpoints back to back on one connection and token"""
+        results = {}
+        with self._lock:
+            for endpoint in endpoints:
+                results[endpoint] = self._call('GET', endpoint, timeout=timeout)
+        return results
+
+    def snapshot(self, timeout=None):
+        """Status, signal and traffic counters in one batched call"""
+        data = self.get_many(STATUS_ENDPOINTS, timeout)
+        return {
+            'status': data['api/monitoring/status'],
+            'signal': data['api/device/signal'],
+            'traffic': data['api/monitoring/traffic-statistics']
+        }
+
+    def set_data_switch(self, enabled, timeout=None):
+        """Toggle mobile data (used for reconnect / IP rotation)"""
+        return self.post('api/dialup/mobile-dataswitch', f'<dataswitch>{1 if enabled else 0}</dataswitch>',
+                         timeout=timeout)
+
+    def wait_connected(self, connected=True, timeout=60.0, interval=0.5, request_timeout=None):
+        """Poll ConnectionStatus until it is (or is no longer) 901; returns the status fields"""
+        deadline = time.time() + timeout
+        while True:
+            try:
+                status = self.get('api/monitoring/status', timeout=request_timeout)
+                if (status.get('ConnectionStatus') == '901') == connected:
+                    return status
+            except (OSError, HiLinkError):
+                pass  # the web UI can stall while the modem re-attaches
+            if time.time() >= deadline:
+                raise TimeoutError(f"{self.host}: still {'disconnected' if connected else 'connected'} "
+                                   f"after {timeout:.0f}s")
+            time.sleep(interval)
+
+    def apn_profile(self, timeout=None):
+        """Active APN profile: index, name, apn, username"""
+        with self._lock:
+            return self._call('GET', 'api/dialup/profiles', parser=parse_profiles, timeout=timeout)
+
+    def carrier(self, timeout=None):
+        """Operator name of the current PLMN"""
+        plmn = self.get('api/net/current-plmn', timeout=timeout)
+        return plmn.get('FullName') or plmn.get('ShortName') or plmn.get('Numeric') or 'Unknown'
+
+    def close(self):
+        if self._conn is not None:
+            try:
+                self._conn.close()
+            except Exception:
+                pass
+            self._conn = None
+
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_client(host, source_address=None, interface=None):
+    """
+    Return the shared client for a modem, creating it on first use. It is
+    shared by every caller, so callers that need a timeout other than the
+    default pass it per request (`client.get(endpoint, timeout=...)`).
+    """
+    key = (host, source_address, interface)
+    with _clients_lock:
+        client = _clients.get(key)
+        if client is None:
+            client = HiLinkClient(host, source_address=source_address, interface=interface)
+            _clients[key] = client
+        return client
@@ -0,0 +1,449 @@
+#!/usr/bin/env python3
+"""
+Proxy Farm System - IP change history
+Append-only, day-segmented log with a per-modem time index
+"""
+
+import calendar
+import fcntl
+import ipaddress
+import json
+import mmap
+import os
+import struct
+import threading
+import time
+from array import array
+from bisect import bisect_right
+
+# ts, dcom index, old ip, new ip, affected-users offset/length in the .aux file
+RECORD = struct.Struct('<dI16s16sQI')
+IDX_HEADER = struct.Struct('<I')
+IDX_ENTRY = struct.Struct('<IIQ')  # dcom index, count, offset of its positions
+
+DAY = 86400
+
+
+def pack_ip(value):
+    """16-byte form of an IP (IPv4 as ::ffff:a.b.c.d); zeros for N/A"""
+    try:
+        address = ipaddress.ip_address(value)
+    except (ValueError, TypeError):
+        return bytes(16)
+    if address.version == 4:
+        return bytes(10) + b'\xff\xff' + address.packed
+    return address.packed
+
+
+def unpack_ip(raw):
+    if raw == bytes(16):
+        return 'N/A'
+    address = ipaddress.IPv6Address(raw)
+    return str(address.ipv4_mapped or address)
+
+
+def segment_range(name):
+    """[start, end) epoch covered by a segment name (YYYYMMDD daily, YYYYMM compacted monthly)"""
+    if len(name) == 8:
+        start = calendar.timegm(time.strptime(name, '%Y%m%d'))
+        return start, start + DAY
+    year, month = int(name[:4]), int(name[4:])
+    start = calendar.timegm((year, month, 1, 0, 0, 0))
+    return start, calendar.timegm((year + month // 12, month % 12 + 1, 1, 0, 0, 0))
+
+
+class _Timestamps:
+    """Sequence view of record timestamps for bisect"""
+
+    def __init__(self, segment, positions=None):
+        self.segment = segment
+        self.positions = positions
+
+    def __len__(self):
+        return len(self.positions) if self.positions is not None else self.segment.count
+
+    def __getitem__(self, i):
+        pos = self.positions[i] if self.positions is not None else i
+        return self.segment.ts(pos)
+
+
+class Segment:
+    """<name>.dat fixed-size records, <name>.aux user lists, <name>.idx per-modem index (sealed only)"""
+
+    def __init__(self, directory, name):
+        self.name = name
+        self.base = f'{directory}/{name}'
+        self.start, self.end = segment_range(name)
+        self._map = None
+        self._mapped_size = 0
+        self._inode = None
+        self._idx = None
+        self._idx_map = None
+        self._idx_inode = None
+        self._active_index = {}  # dcom index -> array of record positions
+        self._indexed = 0
+
+    @property
+    def count(self):
+        self._refresh()
+        return self._mapped_size // RECORD.size
+
+    def _refresh(self):
+        """(Re)map the data file when it has grown - old segments are mapped once"""
+        try:
+            st = os.stat(f'{self.base}.dat')
+            size, inode = st.st_size, st.st_ino
+        except OSError:
+            size, inode = 0, None
+        size -= size % RECORD.size
+        if inode != self._inode:
+            # Rewritten by compaction in another worker - forget everything derived from it
+            self._inode = inode
+            self._idx = None
+            self._active_index = {}
+            self._indexed = 0
+            self._mapped_size = -1
+        if size != self._mapped_size:
+            if self._map is not None:
+                self._map.close()
+            self._map = None
+            if size:
+                with open(f'{self.base}.dat', 'rb') as f:
+                    self._map = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+            self._mapped_size = size
+
+    def ts(self, pos):
+        return RECORD.unpack_from(self._map, pos * RECORD.size)[0]
+
+    def record(self, pos):
+        return RECORD.unpack_from(self._map, pos * RECORD.size)
+
+    def affected_users(self, offset, length):
+        if not length:
+            return []
+        with open(f'{self.base}.aux', 'rb') as f:
+            return json.loads(os.pread(f.fileno(), length, offset))
+
+    def positions(self, dcom_index):
+        """Record positions for one modem, in time order"""
+        try:
+            idx_inode = os.stat(f'{self.base}.idx').st_ino
+        except OSError:
+            idx_inode = None
+        if idx_inode is not None:
+            if idx_inode != self._idx_inode:
+                self._idx = None  # rebuilt after a back-fill
+                self._idx_inode = idx_inode
+            return self._sealed_positions(dcom_index)
+        count = self.count
+        for pos in range(self._indexed, count):
+            self._active_index.setdefault(self.record(pos)[1], array('I')).append(pos)
+        self._indexed = count
+        return self._active_index.get(dcom_index, array('I'))
+
+    def _sealed_positions(self, dcom_index):
+        if self._idx is None:
+            with open(f'{self.base}.idx', 'rb') as f:
+                self._idx_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            (n,) = IDX_HEADER.unpack_from(self._idx_map, 0)
+            self._idx = {}
+            for i in range(n):
+                dcom, count, offset = IDX_ENTRY.unpack_from(self._idx_map, IDX_HEADER.size + i * IDX_ENTRY.size)
+                self._idx[dcom] = (count, offset)
+        if dcom_index not in self._idx:
+            return array('I')
+        count, offset = self._idx[dcom_index]
+        return memoryview(self._idx_map)[offset:offset + count * 4].cast('I')
+
+    def build_index(self):
+        """Write the per-modem index once the segment is sealed"""
+        by_dcom = {}
+        for pos in range(self.count):
+            by_dcom.setdefault(self.record(pos)[1], array('I')).append(pos)
+        offset = IDX_HEADER.size + len(by_dcom) * IDX_ENTRY.size
+        header = IDX_HEADER.pack(len(by_dcom))
+        entries = b''
+        arrays = b''
+        for dcom in sorted(by_dcom):
+            positions = by_dcom[dcom]
+            entries += IDX_ENTRY.pack(dcom, len(positions), offset + len(arrays))
+            arrays += positions.tobytes()
+        tmp_file = f'{self.base}.idx.tmp'
+        with open(tmp_file, 'wb') as f:
+            f.write(header + entries + arrays)
+        os.replace(tmp_file, f'{self.base}.idx')
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        self._mapped_size = 0
+
+
+class IPHistoryLog:
+    """
+    IP changes for every modem, kept for months. Records are appended to the
+    segment of their UTC day; a day is sealed (per-modem index written) once
+    the next day starts. Range queries binary-search each overlapping
+    segment, so `hours=` never touches records outside the window.
+    """
+
+    def __init__(self, directory, retention_days=180):
+        self.directory = directory
+        self.retention_days = retention_days
+        os.makedirs(directory, exist_ok=True)
+        self._segments = {}
+        self._dcoms = []
+        self._dcom_index = {}
+        self._lock = threading.Lock()
+        self._load_dcoms()
+
+    # Modem dictionary ----------------------------------------------------
+
+    def _load_dcoms(self):
+        try:
+            with open(f'{self.directory}/dcoms.json', 'r') as f:
+                self._dcoms = json.load(f)
+        except (OSError, ValueError):
+            self._dcoms = []
+        self._dcom_index = {dcom_id: i for i, dcom_id in enumerate(self._dcoms)}
+
+    def _dcom_to_index(self, dcom_id):
+        """Called with the write lock held"""
+        if dcom_id not in self._dcom_index:
+            self._load_dcoms()  # another worker may have added it
+        if dcom_id not in self._dcom_index:
+            self._dcoms.append(dcom_id)
+            self._dcom_index[dcom_id] = len(self._dcoms) - 1
+            tmp_file = f'{self.directory}/dcoms.json.tmp'
+            with open(tmp_file, 'w') as f:
+                json.dump(self._dcoms, f)
+            os.replace(tmp_file, f'{self.directory}/dcoms.json')
+        return self._dcom_index[dcom_id]
+
+    def _index_to_dcom(self, index):
+        if index >= len(self._dcoms):
+            self._load_dcoms()
+        return self._dcoms[index] if index < len(self._dcoms) else f'#{index}'
+
+    # Segments ------------------------------------------------------------
+
+    def _segment_names(self):
+        names = set()
+        for filename in os.listdir(self.directory):
+            if filename.endswith('.dat'):
+                names.add(filename[:-4])
+        return sorted(names)
+
+    def _segment(self, name):
+        segment = self._segments.get(name)
+        if segment is None:
+            segment = Segment(self.directory, name)
+            self._segments[name] = segment
+        return segment
+
+    def _locked(self):
+        return _DirLock(f'{self.directory}/.lock', self._lock)
+
+    def append(self, dcom_id, old_ip, new_ip, affected_users=(), ts=None):
+        """Append one IP change (stamped now, once the log is locked, unless `ts` is given)"""
+        self.append_many([(ts, dcom_id, old_ip, new_ip, list(affected_users))])
+
+    def append_many(self, records):
+        """
+        Append [(ts, dcom_id, old_ip, new_ip, affected_users)] with their own
+        timestamps. A day that already holds later records gets its data
+        file rewritten in time order instead. A ts of None is stamped inside
+        the lock, so records without one land in the order of their stamps
+        across workers (readers that sync from the newest ts never skip one).
+        """
+        with self._locked():
+            now = time.time()
+            by_day = {}
+            for record in sorted(((r[0] or now,) + tuple(r[1:]) for r in records), key=lambda r: r[0]):
+                by_day.setdefault(time.strftime('%Y%m%d', time.gmtime(record[0])), []).append(record)
+            existing = set(self._segment_names())
+            new_day = False
+            for name, day_records in sorted(by_day.items()):
+                new_day = new_day or name not in existing
+                segment = self._segment(name)
+                if os.path.exists(f'{segment.base}.idx'):
+                    # Back-filling a sealed day - its index is rebuilt below
+                    os.unlink(f'{segment.base}.idx')
+                    new_day = True
+                packed = []
+                with open(f'{segment.base}.aux', 'ab') as aux:
+                    for ts, dcom_id, old_ip, new_ip, users in day_records:
+                        payload = json.dumps(users).encode() if users else b''
+                        offset = aux.tell()
+                        aux.write(payload)
+                        packed.append(RECORD.pack(ts, self._dcom_to_index(dcom_id), pack_ip(old_ip),
+                                                  pack_ip(new_ip), offset, len(payload)))
+                count = segment.count
+                if count and day_records[0][0] < segment.ts(count - 1):
+                    self._rewrite_sorted(segment, packed)
+                else:
+                    with open(f'{segment.base}.dat', 'ab') as dat:
+                        dat.write(b''.join(packed))
+                existing.add(name)
+            if new_day:
+                # First record of a new day: seal yesterday and do the housekeeping
+                self._seal_old_segments()
+                self._expire(time.time())
+                self._compact(time.time())
+
+    def _rewrite_sorted(self, segment, packed):
+        """Merge out-of-order records into a segment (replaced atomically; readers remap on the new inode)"""
+        rows = [segment.record(pos) for pos in range(segment.count)]
+        rows += [RECORD.unpack(record) for record in packed]
+        rows.sort(key=lambda row: row[0])  # stable: equal timestamps keep arrival order
+        tmp_file = f'{segment.base}.dat.tmp'
+        with open(tmp_file, 'wb') as f:
+            f.write(b''.join(RECORD.pack(*row) for row in rows))
+        os.replace(tmp_file, f'{segment.base}.dat')
+
+    def _seal_old_segments(self):
+        today = time.strftime('%Y%m%d', time.gmtime())
+        for name in self._segment_names():
+            if name < today[:len(name)] and not os.path.exists(f'{self.directory}/{name}.idx'):
+                self._segment(name).build_index()
+
+    def query(self, since, until=None, dcom_id=None, limit=None):
+        """Changes with since < ts <= until, newest first"""
+        until = until if until is not None else time.time() + 1
+        dcom_index = None
+        if dcom_id is not None:
+            self._load_dcoms()
+            dcom_index = self._dcom_index.get(dcom_id)
+            if dcom_index is None:
+                return []
+
+        results = []
+        for name in reversed(self._segment_names()):
+            segment = self._segment(name)
+            if segment.end <= since or segment.start > until:
+                continue
+            if not segment.count:
+                continue
+            positions = segment.positions(dcom_index) if dcom_index is not None else None
+            view = _Timestamps(segment, positions)
+            lo = bisect_right(view, since)
+            hi = bisect_right(view, until)
+            for i in range(hi - 1, lo - 1, -1):
+                pos = positions[i] if positions is not None else i
+                ts, dcom, old_ip, new_ip, offset, length = segment.record(pos)
+                results.append({
+                    'dcom_id': self._index_to_dcom(dcom),
+                    'ts': ts,
+                    'old_ip': unpack_ip(old_ip),
+                    'new_ip': unpack_ip(new_ip),
+                    'affected_users': segment.affected_users(offset, length)
+                })
+                if limit and len(results) >= limit:
+                    return results
+        return results
+
+    def is_empty(self):
+        return not self._segment_names()
+
+    # Maintenance ---------------------------------------------------------
+
+    def enforce_retention(self, now=None):
+        """Delete whole segments older than the retention window"""
+        with self._locked():
+            return self._expire(now or time.time())
+
+    def compact(self, older_than_days=31, now=None):
+        """Merge sealed daily segments of finished months into one monthly segment"""
+        with self._locked():
+            return self._compact(now or time.time(), older_than_days)
+
+    def _expire(self, now):
+        cutoff = now - self.retention_days * DAY
+        removed = []
+        for name in self._segment_names():
+            if segment_range(name)[1] <= cutoff:
+                self._drop(name)
+                removed.append(name)
+        return removed
+
+    def _compact(self, now, older_than_days=31):
+        current_month = time.strftime('%Y%m', time.gmtime(now))
+        cutoff = now - older_than_days * DAY
+        months = {}
+        for name in self._segment_names():
+            if len(name) == 8 and name[:6] < current_month and segment_range(name)[1] <= cutoff:
+                months.setdefault(name[:6], []).append(name)
+        merged = []
+        for month, days in sorted(months.items()):
+            if os.path.exists(f'{self.directory}/{month}.dat'):
+                days = [month] + days  # fold into an earlier compaction
+            rows = []
+            for name in days:
+                segment = self._segment(name)
+                with open(f'{segment.base}.aux', 'rb') as f:
+                    aux_data = f.read()
+                for pos in range(segment.count):
+                    ts, dcom, old_ip, new_ip, offset, length = segment.record(pos)
+                    rows.append((ts, dcom, old_ip, new_ip, aux_data[offset:offset + length]))
+            # Back-filled days can predate the month's earlier compaction; a
+            # crash after the replace below but before the days were dropped
+            # leaves their records in both - so sort, and skip exact repeats
+            rows.sort(key=lambda row: row[0])
+            dat = bytearray()
+            aux = bytearray()
+            seen = set()
+            for row in rows:
+                if row in seen:
+                    continue
+                seen.add(row)
+                ts, dcom, old_ip, new_ip, payload = row
+                dat += RECORD.pack(ts, dcom, old_ip, new_ip, len(aux), len(payload))
+                aux += payload
+            base = f'{self.directory}/{month}'
+            for ext, data in (('.aux', aux), ('.dat', dat)):
+                with open(f'{base}{ext}.tmp', 'wb') as f:
+                    f.write(data)
+            old = self._segments.pop(month, None)
+            if old:
+                old.close()
+            os.replace(f'{base}.aux.tmp', f'{base}.aux')
+            os.replace(f'{base}.dat.tmp', f'{base}.dat')
+            self._segment(month).build_index()
+            # Only now that the monthly segment is in place
+            for name in days:
+                if name != month:
+                    self._drop(name)
+            merged.append(month)
+        return merged
+
+    def _drop(self, name):
+        segment = self._segments.pop(name, None)
+        if segment:
+            segment.close()
+        for ext in ('.dat', '.aux', '.idx'):
+            try:
+                os.unlink(f'{self.directory}/{name}{ext}')
+            except OSError:
+                pass
+
+
+class _DirLock:
+    """Thread lock + flock so several gunicorn workers can append safely"""
+
+    def __init__(self, path, thread_lock):
+        self.path = path
+        self.thread_lock = thread_lock
+        self.fd = None
+
+    def __enter__(self):
+        self.thread_lock.acquire()
+        self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        fcntl.flock(self.fd, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        fcntl.flock(self.fd, fcntl.LOCK_UN)
+        os.close(self.fd)
+        self.thread_lock.release()
+        return False
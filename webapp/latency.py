@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+"""
+Proxy Farm System - Rotation latency
+Phase timing for reconnects and fixed-bucket latency histograms
+"""
+
+import time
+from bisect import bisect_left
+
+# Reconnect phases, in order; each is timed from the end of the previous one
+PHASES = ('disconnect', 'reattach', 'route_ready', 'first_egress', 'ip_confirmed')
+
+# Bucket upper bounds in ms (the last bucket is open-ended)
+BUCKETS_MS = (50, 100, 250, 500, 750, 1000, 1500, 2000, 3000, 5000, 7500, 10000,
+              15000, 20000, 30000, 45000, 60000, 90000, 120000)
+
+
+class PhaseTimer:
+    """Marks phase boundaries of one reconnect"""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self._last = self.started
+        self.phases = {}  # phase -> ms
+        self.failed_phase = None
+
+    def mark(self, phase):
+        now = time.perf_counter()
+        self.phases[phase] = round((now - self._last) * 1000, 1)
+        self._last = now
+
+    def fail(self, phase):
+        self.failed_phase = phase
+
+    @property
+    def total_ms(self):
+        return round((self._last - self.started) * 1000, 1)
+
+    def to_dict(self):
+        total = None if self.failed_phase else self.total_ms
+        return {**self.phases, 'total': total, 'failed_phase': self.failed_phase}
+
+
+class LatencyHistogram:
+    """Counts per fixed bucket plus count/sum/min/max"""
+
+    __slots__ = ('counts', 'count', 'total', 'min', 'max')
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS_MS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def add(self, ms):
+        self.counts[bisect_left(BUCKETS_MS, ms)] += 1
+        self.count += 1
+        self.total += ms
+        self.min = ms if self.min is None else min(self.min, ms)
+        self.max = ms if self.max is None else max(self.max, ms)
+
+    def percentile(self, p):
+        """Upper bound of the bucket holding the p-th percentile (capped at the observed max)"""
+        if not self.count:
+            return None
+        rank = p / 100 * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen >= rank and n:
+                bound = BUCKETS_MS[i] if i < len(BUCKETS_MS) else self.max
+                return min(bound, self.max)
+        return self.max
+
+    def to_dict(self):
+        buckets = {}
+        for i, n in enumerate(self.counts):
+            if n:
+                buckets['+Inf' if i == len(BUCKETS_MS) else str(BUCKETS_MS[i])] = n
+        return {
+            'count': self.count,
+            'mean_ms': round(self.total / self.count, 1) if self.count else None,
+            'min_ms': self.min,
+            'max_ms': self.max,
+            'p50_ms': self.percentile(50),
+            'p90_ms': self.percentile(90),
+            'p99_ms': self.percentile(99),
+            'buckets': buckets
+        }
+
+
+def build_histograms(samples, key):
+    """
+    Group timing samples by `key` ('dcom_id', 'apn', 'carrier') into
+    {group: {'samples', 'failures', 'failed_phases', 'phases': {phase: histogram}}}
+    """
+    groups = {}
+    for sample in samples:
+        group = groups.get(sample[key])
+        if group is None:
+            group = groups[sample[key]] = {'samples': 0, 'failures': 0, 'failed_phases': {},
+                                           'phases': {phase: LatencyHistogram() for phase in PHASES + ('total',)}}
+        group['samples'] += 1
+        if sample.get('failed_phase'):
+            group['failures'] += 1
+            group['failed_phases'][sample['failed_phase']] = group['failed_phases'].get(sample['failed_phase'], 0) + 1
+        for phase, histogram in group['phases'].items():
+            value = sample.get(phase)
+            if value is not None:
+                histogram.add(value)
+    for group in groups.values():
+        group['phases'] = {phase: h.to_dict() for phase, h in group['phases'].items() if h.count}
+    return groups
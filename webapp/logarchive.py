@@ -0,0 +1,583 @@
+#!/usr/bin/env python3
+"""
+Proxy Farm System - 3proxy log archive
+Compacts rotated 3proxy logs into a columnar format and answers traffic
+queries over them
+
+    python3 logarchive.py compact /home/proxy-farm-system/logs/3proxy
+    python3 logarchive.py query /home/proxy-farm-system/logs/3proxy/archive --user alice --from 2025-07-09
+"""
+
+import argparse
+import fcntl
+import glob
+import hashlib
+import json
+import os
+import re
+import struct
+import sys
+import threading
+import time
+import zlib
+from array import array
+from datetime import datetime, timezone
+from itertools import accumulate
+
+from proxylog import TS, LISTENER, ERROR, USER, CLIENT, REMOTE, BYTES_OUT, BYTES_IN, FIELDS, COMPRESSED
+
+MAGIC = b'PFLOGA1\n'
+TRAILER = struct.Struct('<QI8s')  # footer offset, footer length, magic
+EXTENSION = '.pfa'
+
+BLOCK_ROWS = 65536
+BLOOM_BITS_PER_KEY = 10
+BLOOM_HASHES = 4
+
+# Dictionary-encoded columns (ids into the file's dictionaries)
+DICT_COLUMNS = ('user', 'listener', 'host', 'client')
+# Column -> fixed-width array typecode. `ts` holds millisecond deltas from
+# the previous row, the first row being the block's base_ts; zlib takes care
+# of the unused high bytes.
+TYPECODES = {'ts': 'q', 'listener': 'I', 'error': 'H', 'user': 'I', 'client': 'I', 'host': 'I', 'port': 'H',
+             'bytes_out': 'Q', 'bytes_in': 'Q'}
+
+GROUPS = ('user', 'listener', 'host', 'client', 'error', 'day', 'hour')
+
+
+def _shuffle(data, width):
+    """Group byte 0 of every value, then byte 1, ... - the mostly-zero high bytes then compress to almost nothing"""
+    return b''.join(data[i::width] for i in range(width))
+
+
+def _unshuffle(data, width):
+    out = bytearray(len(data))
+    step = len(data) // width
+    for i in range(width):
+        out[i::width] = data[i * step:(i + 1) * step]
+    return bytes(out)
+
+
+def _find(data, value, width):
+    """Indices of `value` in a packed little-endian array of `width`-byte ints"""
+    needle = value.to_bytes(width, 'little')
+    indices = []
+    position = data.find(needle)
+    while position >= 0:
+        if position % width == 0:
+            indices.append(position // width)
+            position = data.find(needle, position + width)
+        else:
+            position = data.find(needle, position + width - position % width)
+    return indices
+
+
+def _bloom_positions(key, bits):
+    """BLOOM_HASHES bit positions for an integer key (double hashing)"""
+    h1 = (key * 0x9E3779B1 + 0x7F4A7C15) & 0xFFFFFFFF
+    h2 = ((key ^ 0x5BD1E995) * 0x85EBCA6B & 0xFFFFFFFF) | 1
+    return [(h1 + i * h2) % bits for i in range(BLOOM_HASHES)]
+
+
+def _bloom(keys):
+    bits = max(64, len(keys) * BLOOM_BITS_PER_KEY)
+    bits += -bits % 8
+    bloom = bytearray(bits // 8)
+    for key in keys:
+        for position in _bloom_positions(key, bits):
+            bloom[position >> 3] |= 1 << (position & 7)
+    return bytes(bloom)
+
+
+def _bloom_contains(bloom, key):
+    bits = len(bloom) * 8
+    return all(bloom[p >> 3] >> (p & 7) & 1 for p in _bloom_positions(key, bits))
+
+
+class _Dictionary:
+    __slots__ = ('ids', 'values')
+
+    def __init__(self):
+        self.ids = {}
+        self.values = []
+
+    def id(self, value):
+        i = self.ids.get(value)
+        if i is None:
+            i = self.ids[value] = len(self.values)
+            self.values.append(value)
+        return i
+
+
+def parse_log(path):
+    """Yield (ts_ms, listener, error, user, client, host, port, bytes_out, bytes_in) per well-formed line"""
+    with open(path, 'rb') as f:
+        for line in f:
+            fields = line.rstrip(b'\n').split(b' ', FIELDS - 1)
+            if len(fields) < FIELDS - 1:
+                continue
+            try:
+                ts = round(float(fields[TS]) * 1000)
+                host, _, port = fields[REMOTE].rpartition(b':')
+                row = (ts, fields[LISTENER], int(fields[ERROR]), fields[USER], fields[CLIENT].rpartition(b':')[0],
+                       host, int(port or 0), int(fields[BYTES_OUT]), int(fields[BYTES_IN]))
+            except ValueError:
+                continue
+            yield row
+
+
+def _write_block(f, columns, rows):
+    times = columns['ts']
+    block = {'rows': rows, 'base_ts': times[0], 'min_ts': min(times), 'max_ts': max(times), 'cols': {}}
+    deltas = [0] + [b - a for a, b in zip(times, times[1:])]
+    for name, typecode in TYPECODES.items():
+        values = array(typecode, deltas if name == 'ts' else columns[name])
+        data = zlib.compress(_shuffle(values.tobytes(), values.itemsize), 6)
+        block['cols'][name] = [f.tell(), len(data)]
+        f.write(data)
+    bloom = _bloom(set(columns['user']))
+    block['user_bloom'] = [f.tell(), len(bloom)]
+    f.write(bloom)
+    block['listeners'] = sorted(set(columns['listener']))
+    return block
+
+
+def write_archive(rows, path, source=None, block_rows=BLOCK_ROWS):
+    """
+    Write parsed rows (see parse_log) to `path`, one block of `block_rows`
+    at a time: every column of every block is byte-shuffled and
+    zlib-compressed on its own so a query only reads the columns it needs,
+    and the dictionaries and block index go in a compressed JSON footer.
+    """
+    dictionaries = {name: _Dictionary() for name in DICT_COLUMNS}
+    user_ids, listener_ids = dictionaries['user'].id, dictionaries['listener'].id
+    host_ids, client_ids = dictionaries['host'].id, dictionaries['client'].id
+    blocks = []
+    tmp_file = f'{path}.tmp'
+    with open(tmp_file, 'wb') as f:
+        f.write(MAGIC)
+        columns = {name: [] for name in TYPECODES}
+        count = 0
+        for ts, listener, error, user, client, host, port, sent, received in rows:
+            columns['ts'].append(ts)
+            columns['listener'].append(listener_ids(listener))
+            columns['error'].append(error)
+            columns['user'].append(user_ids(user))
+            columns['client'].append(client_ids(client))
+            columns['host'].append(host_ids(host))
+            columns['port'].append(port)
+            columns['bytes_out'].append(sent)
+            columns['bytes_in'].append(received)
+            count += 1
+            if count == block_rows:
+                blocks.append(_write_block(f, columns, count))
+                columns = {name: [] for name in TYPECODES}
+                count = 0
+        if count:
+            blocks.append(_write_block(f, columns, count))
+
+        footer = zlib.compress(json.dumps({
+            'version': 1,
+            'source': source,
+            'rows': sum(b['rows'] for b in blocks),
+            'min_ts': min((b['min_ts'] for b in blocks), default=None),
+            'max_ts': max((b['max_ts'] for b in blocks), default=None),
+            'dicts': {name: [v.decode(errors='replace') for v in d.values] for name, d in dictionaries.items()},
+            'blocks': blocks
+        }, separators=(',', ':')).encode(), 6)
+        footer_offset = f.tell()
+        f.write(footer)
+        f.write(TRAILER.pack(footer_offset, len(footer), MAGIC))
+    os.replace(tmp_file, path)
+    return sum(b['rows'] for b in blocks)
+
+
+class Aggregate:
+    """requests / bytes_out / bytes_in / errors, optionally per group"""
+
+    __slots__ = ('groups',)
+
+    def __init__(self):
+        self.groups = {}  # key -> [requests, bytes_out, bytes_in, errors]
+
+    def add(self, key, requests, sent, received, errors):
+        row = self.groups.get(key)
+        if row is None:
+            row = self.groups[key] = [0, 0, 0, 0]
+        row[0] += requests
+        row[1] += sent
+        row[2] += received
+        row[3] += errors
+
+    def merge(self, other):
+        for key, row in other.groups.items():
+            self.add(key, *row)
+
+    def to_list(self, limit=None):
+        rows = sorted(self.groups.items(), key=lambda item: item[1][1] + item[1][2], reverse=True)
+        return [{'key': key, 'requests': r[0], 'bytes_out': r[1], 'bytes_in': r[2], 'bytes': r[1] + r[2],
+                 'errors': r[3]} for key, r in rows[:limit]]
+
+
+class ArchiveFile:
+    """Read side of one .pfa file; the footer is parsed once"""
+
+    def __init__(self, path):
+        self.path = path
+        self.name = os.path.basename(path)
+        with open(path, 'rb') as f:
+            f.seek(-TRAILER.size, os.SEEK_END)
+            offset, length, magic = TRAILER.unpack(f.read(TRAILER.size))
+            if magic != MAGIC:
+                raise ValueError(f'{path}: not a log archive')
+            f.seek(offset)
+            footer = json.loads(zlib.decompress(f.read(length)))
+        self.rows = footer['rows']
+        self.source = footer['source']
+        self.min_ts = footer['min_ts']
+        self.max_ts = footer['max_ts']
+        self.dicts = footer['dicts']
+        self.blocks = footer['blocks']
+        self._ids = {name: None for name in DICT_COLUMNS}
+
+    def lookup(self, column, value):
+        """Dictionary id of `value` in this file (None if it never occurs)"""
+        if self._ids[column] is None:
+            self._ids[column] = {v: i for i, v in enumerate(self.dicts[column])}
+        return self._ids[column].get(value)
+
+    def _raw(self, fd, block, name):
+        offset, length = block['cols'][name]
+        return _unshuffle(zlib.decompress(os.pread(fd, length, offset)), array(TYPECODES[name]).itemsize)
+
+    def _column(self, fd, block, name):
+        values = array(TYPECODES[name], self._raw(fd, block, name))
+        if name == 'ts':
+            return list(accumulate(values, initial=block['base_ts']))[1:]
+        return values
+
+    def scan(self, user_id=None, listener_ids=None, start=None, end=None, group_by=None, stats=None):
+        """
+        Aggregate rows matching the filters (dictionary ids, ms times,
+        end exclusive). Blocks are skipped on their time range, user bloom
+        filter and listener list; only the columns a block needs are read.
+        """
+        result = Aggregate()
+        stats = stats if stats is not None else {}
+        fd = os.open(self.path, os.O_RDONLY)
+        try:
+            for block in self.blocks:
+                if (start is not None and block['max_ts'] < start) or (end is not None and block['min_ts'] >= end):
+                    stats['blocks_skipped'] = stats.get('blocks_skipped', 0) + 1
+                    continue
+                if listener_ids is not None and not listener_ids.intersection(block['listeners']):
+                    stats['blocks_skipped'] = stats.get('blocks_skipped', 0) + 1
+                    continue
+                if user_id is not None:
+                    offset, length = block['user_bloom']
+                    if not _bloom_contains(os.pread(fd, length, offset), user_id):
+                        stats['blocks_skipped'] = stats.get('blocks_skipped', 0) + 1
+                        continue
+                stats['blocks_read'] = stats.get('blocks_read', 0) + 1
+                self._scan_block(fd, block, user_id, listener_ids, start, end, group_by, result)
+        finally:
+            os.close(fd)
+        return result
+
+    def _scan_block(self, fd, block, user_id, listener_ids, start, end, group_by, result):
+        # Matching row indices (None = every row), narrowed by each filter the block needs
+        rows = None
+        if user_id is not None:
+            rows = _find(self._raw(fd, block, 'user'), user_id, array(TYPECODES['user']).itemsize)
+        if listener_ids is not None and not listener_ids.issuperset(block['listeners']):
+            listeners = self._column(fd, block, 'listener')
+            rows = [i for i, l in enumerate(listeners) if l in listener_ids] if rows is None else \
+                [i for i in rows if listeners[i] in listener_ids]
+        times = None
+        if (start is not None and block['min_ts'] < start) or (end is not None and block['max_ts'] >= end):
+            times = self._column(fd, block, 'ts')
+            lo = start if start is not None else float('-inf')
+            hi = end if end is not None else float('inf')
+            rows = [i for i, t in enumerate(times) if lo <= t < hi] if rows is None else \
+                [i for i in rows if lo <= times[i] < hi]
+        if rows is not None and not rows:
+            return
+
+        sent = self._column(fd, block, 'bytes_out')
+        received = self._column(fd, block, 'bytes_in')
+        errors = self._column(fd, block, 'error')
+        if group_by is None:
+            if rows is None:
+                result.add(None, block['rows'], sum(sent), sum(received), block['rows'] - errors.count(0))
+            else:
+                result.add(None, len(rows), sum(sent[i] for i in rows), sum(received[i] for i in rows),
+                           sum(1 for i in rows if errors[i]))
+            return
+
+        if group_by in ('day', 'hour'):
+            if times is None:
+                times = self._column(fd, block, 'ts')
+            step = 86400000 if group_by == 'day' else 3600000
+            keys = [t - t % step for t in times]
+        elif group_by == 'error':
+            keys = errors
+        else:
+            keys = self._column(fd, block, group_by)
+        groups = result.groups
+        for i in (range(block['rows']) if rows is None else rows):
+            key = keys[i]
+            row = groups.get(key)
+            if row is None:
+                row = groups[key] = [0, 0, 0, 0]
+            row[0] += 1
+            row[1] += sent[i]
+            row[2] += received[i]
+            if errors[i]:
+                row[3] += 1
+
+    def label(self, group_by, key):
+        """Readable group key"""
+        if group_by in DICT_COLUMNS:
+            return self.dicts[group_by][key]
+        if group_by in ('day', 'hour'):
+            return datetime.fromtimestamp(key / 1000, timezone.utc).strftime('%Y-%m-%d' if group_by == 'day' else '%Y-%m-%d %H:00')
+        return key
+
+
+def _digest(path, chunk_size=1 << 20):
+    """Short content hash of a file"""
+    h = hashlib.blake2b(digest_size=6)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _archive_name(source, archive, digest):
+    """'3proxy.log.20261017T000001-20261017T235959.<digest>.pfa' - rotation numbers dropped"""
+    stem = re.sub(r'(\.\d+)+$', '', source)
+    if archive.min_ts is None:
+        span = 'empty'
+    else:
+        span = '-'.join(datetime.fromtimestamp(ts / 1000, timezone.utc).strftime('%Y%m%dT%H%M%S')
+                        for ts in (archive.min_ts, archive.max_ts))
+    return f'{stem}.{span}.{digest}{EXTENSION}'
+
+
+class LogArchive:
+    """
+    Directory of .pfa files: compaction of rotated logs into it and
+    queries across it. Rotated logs are compacted once they have not been
+    written to for `min_age` seconds, and removed after the archive is
+    written and read back with the same row count.
+    """
+
+    def __init__(self, directory, min_age=3600, remove_source=True):
+        self.directory = directory
+        self.min_age = min_age
+        self.remove_source = remove_source
+        self._files = {}  # path -> (mtime, ArchiveFile)
+        self._compactor = None
+        self._compactor_pid = None
+        os.makedirs(directory, exist_ok=True)
+
+    # Compaction ---------------------------------------------------------------
+
+    def pending(self, log_file):
+        """Rotated logs of `log_file` (not the live one) old enough to compact"""
+        now = time.time()
+        paths = []
+        for path in sorted(glob.glob(f'{glob.escape(log_file)}.*')):
+            if path.endswith(COMPRESSED + ('.tmp',)):
+                continue
+            try:
+                if now - os.path.getmtime(path) >= self.min_age:
+                    paths.append(path)
+            except OSError:
+                continue
+        return paths
+
+    def compact(self, path):
+        """
+        Archive one rotated log; returns sizes and row count. logrotate
+        reuses names like 3proxy.log.1 daily, so archives are named by their
+        time span and a digest of the source and never overwrite each other;
+        compacting the same file again (e.g. after a crash before it was
+        removed) finds its archive already there.
+        """
+        started = time.perf_counter()
+        name = os.path.basename(path)
+        digest = _digest(path)
+        partial = os.path.join(self.directory, f'{name}.{digest}.partial')
+        try:
+            rows = write_archive(parse_log(path), partial, source=name)
+            archive = ArchiveFile(partial)
+            if archive.rows != rows:
+                raise RuntimeError(f'{partial}: row count mismatch after writing')
+            target = os.path.join(self.directory, _archive_name(name, archive, digest))
+            try:
+                os.link(partial, target)  # unlike os.replace, fails rather than replacing an archive
+                existed = False
+            except FileExistsError:
+                existed = True
+        finally:
+            if os.path.exists(partial):
+                os.remove(partial)
+        size, archived = os.path.getsize(path), os.path.getsize(target)
+        if self.remove_source:
+            os.remove(path)
+        return {'source': path, 'archive': target, 'already_archived': existed, 'rows': rows, 'bytes': size,
+                'archive_bytes': archived, 'ratio': round(size / archived, 1) if archived else None,
+                'elapsed_ms': round((time.perf_counter() - started) * 1000, 1)}
+
+    def compact_pending(self, log_file):
+        results = []
+        for path in self.pending(log_file):
+            try:
+                results.append(self.compact(path))
+            except Exception as e:
+                results.append({'source': path, 'error': str(e)})
+        return {'compacted': results, 'archives': len(self.archives())}
+
+    def compact_pending_exclusive(self, log_file):
+        """compact_pending, unless another process is already compacting (None then)"""
+        with open(os.path.join(self.directory, '.compact.lock'), 'w') as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return None
+            return self.compact_pending(log_file)
+
+    def start_compactor(self, log_file, interval=3600, delay=60):
+        """
+        Compact pending logs every `interval` seconds on a thread of its own,
+        once per process (safe to call repeatedly). Compaction parses and
+        deflates whole days of traffic, so it must not hold up samplers.
+        """
+        if self._compactor_pid == os.getpid() and self._compactor and self._compactor.is_alive():
+            return
+        self._compactor_pid = os.getpid()
+        self._compactor = threading.Thread(target=self._compact_loop, args=(log_file, interval, delay),
+                                           name='log-compact', daemon=True)
+        self._compactor.start()
+
+    def _compact_loop(self, log_file, interval, delay):
+        time.sleep(delay)
+        while True:
+            try:
+                self.compact_pending_exclusive(log_file)
+            except Exception as e:
+                print(f"Log compaction error: {e}")
+            time.sleep(interval)
+
+    # Queries --------------------------------------------------------------------
+
+    def archives(self):
+        """ArchiveFile per .pfa file, oldest data first (footers cached by mtime)"""
+        current = {}
+        for path in glob.glob(os.path.join(glob.escape(self.directory), '*' + EXTENSION)):
+            try:
+                mtime = os.path.getmtime(path)
+                cached = self._files.get(path)
+                current[path] = cached if cached and cached[0] == mtime else (mtime, ArchiveFile(path))
+            except (OSError, ValueError):
+                continue
+        self._files = current
+        return sorted((archive for _, archive in current.values()), key=lambda a: (a.min_ts or 0, a.name))
+
+    def query(self, user=None, listener=None, start=None, end=None, group_by=None):
+        """
+        Iterator of one partial result per archive that can hold matches - so
+        callers can stream - as {'archive', 'groups': Aggregate with
+        labelled keys, 'stats'}. `listener` matches 'PROXY.3331' or just
+        the port; `start`/`end` are epoch seconds, end exclusive.
+        """
+        if group_by is not None and group_by not in GROUPS:
+            raise ValueError(f'group_by must be one of {", ".join(GROUPS)}')
+        return self._query(user, listener, start, end, group_by)
+
+    def _query(self, user, listener, start, end, group_by):
+        start_ms = None if start is None else int(start * 1000)
+        end_ms = None if end is None else int(end * 1000)
+        for archive in self.archives():
+            stats = {'blocks': len(archive.blocks)}
+            started = time.perf_counter()
+            if archive.min_ts is None or (start_ms is not None and archive.max_ts < start_ms) or \
+                    (end_ms is not None and archive.min_ts >= end_ms):
+                continue
+            user_id = None
+            if user is not None:
+                user_id = archive.lookup('user', user)
+                if user_id is None:
+                    continue
+            listener_ids = None
+            if listener is not None:
+                listener = str(listener)
+                listener_ids = {i for i, name in enumerate(archive.dicts['listener'])
+                                if name == listener or name.rpartition('.')[2] == listener}
+                if not listener_ids:
+                    continue
+            partial = archive.scan(user_id, listener_ids, start_ms, end_ms, group_by, stats)
+            labelled = Aggregate()
+            for key, row in partial.groups.items():
+                labelled.add(archive.label(group_by, key) if group_by else None, *row)
+            stats['elapsed_ms'] = round((time.perf_counter() - started) * 1000, 2)
+            yield {'archive': archive.name, 'groups': labelled, 'stats': stats}
+
+    def aggregate(self, user=None, listener=None, start=None, end=None, group_by=None, limit=100):
+        """All partial results merged: {'totals', 'groups', 'archives', 'blocks_read', 'blocks_skipped', 'elapsed_ms'}"""
+        started = time.perf_counter()
+        merged, totals = Aggregate(), Aggregate()
+        archives, read, skipped = 0, 0, 0
+        for partial in self.query(user, listener, start, end, group_by):
+            archives += 1
+            read += partial['stats'].get('blocks_read', 0)
+            skipped += partial['stats'].get('blocks_skipped', 0)
+            merged.merge(partial['groups'])
+        for row in merged.groups.values():
+            totals.add(None, *row)
+        total = totals.to_list()
+        return {
+            'totals': total[0] if total else {'key': None, 'requests': 0, 'bytes_out': 0, 'bytes_in': 0,
+                                              'bytes': 0, 'errors': 0},
+            'groups': merged.to_list(limit) if group_by else [],
+            'archives': archives,
+            'blocks_read': read,
+            'blocks_skipped': skipped,
+            'elapsed_ms': round((time.perf_counter() - started) * 1000, 2)
+        }
+
+
+def _epoch(value):
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        return datetime.fromisoformat(value).timestamp()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compact and query rotated 3proxy logs')
+    commands = parser.add_subparsers(dest='command', required=True)
+    compact_cmd = commands.add_parser('compact', help='archive rotated logs in a log directory')
+    compact_cmd.add_argument('log_dir')
+    compact_cmd.add_argument('--min-age', type=int, default=3600, help='only logs untouched for this many seconds')
+    compact_cmd.add_argument('--keep-source', action='store_true')
+    query_cmd = commands.add_parser('query', help='aggregate traffic from an archive directory')
+    query_cmd.add_argument('archive_dir')
+    query_cmd.add_argument('--user')
+    query_cmd.add_argument('--listener')
+    query_cmd.add_argument('--from', dest='start', help='epoch seconds or ISO date/time')
+    query_cmd.add_argument('--to', dest='end')
+    query_cmd.add_argument('--group-by', choices=GROUPS)
+    args = parser.parse_args()
+
+    if args.command == 'compact':
+        archive = LogArchive(os.path.join(args.log_dir, 'archive'), min_age=args.min_age,
+                             remove_source=not args.keep_source)
+        json.dump(archive.compact_pending(os.path.join(args.log_dir, '3proxy.log')), sys.stdout, indent=2)
+    else:
+        json.dump(LogArchive(args.archive_dir).aggregate(args.user, args.listener, _epoch(args.start),
+                                                         _epoch(args.end), args.group_by), sys.stdout, indent=2)
+    sys.stdout.write('\n')
@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+"""
+Proxy Farm System - Policy routing
+One routing table and one `ip rule` per modem, so traffic sourced from a
+modem's address leaves through that modem
+"""
+
+import json
+import re
+import subprocess
+import threading
+
+
+class ModemRoute:
+    """Table/rule for one modem: `from <address> lookup <table>`, table default via <gateway> dev <interface>"""
+
+    __slots__ = ('table', 'priority', 'interface', 'address', 'gateway')
+
+    def __init__(self, table, priority, interface, address, gateway):
+        self.table = table
+        self.priority = priority
+        self.interface = interface
+        self.address = address
+        self.gateway = gateway
+
+    def __eq__(self, other):
+        return isinstance(other, ModemRoute) and self.to_tuple() == other.to_tuple()
+
+    def to_tuple(self):
+        return (self.table, self.priority, self.interface, self.address, self.gateway)
+
+    def to_dict(self):
+        return {'table': self.table, 'priority': self.priority, 'interface': self.interface,
+                'address': self.address, 'gateway': self.gateway}
+
+
+def _slot(dcom_id):
+    """dcom7 -> 7; the table and rule priority are derived from it so they survive restarts"""
+    match = re.search(r'(\d+)$', dcom_id or '')
+    return int(match.group(1)) if match else None
+
+
+class PolicyRouter:
+    """
+    Keeps the kernel's policy routing in step with the modems. Only tables
+    and rules whose modem appeared, went away or changed address, gateway
+    or interface are touched; all commands for one sync go through a single
+    `ip -batch`. The applied state is read back from the kernel on the first
+    sync and after any failure.
+    """
+
+    def __init__(self, table_base=100, priority_base=1000, ip_command=('sudo', 'ip'), max_slots=899):
+        self.table_base = table_base
+        self.priority_base = priority_base
+        self.ip_command = list(ip_command)
+        self.max_slots = max_slots
+        self._applied = None  # slot -> ModemRoute, None until read from the kernel
+        self._lock = threading.Lock()
+
+    def plan(self, devices):
+        """({slot: ModemRoute}, [problems]) for modems that have an interface, address and gateway"""
+        desired, problems, owners = {}, [], {}
+        for dcom_id, device in sorted(devices.items()):
+            slot = _slot(dcom_id)
+            interface, address, gateway = device.get('interface'), device.get('address'), device.get('gateway')
+            if not (interface and address and gateway):
+                continue
+            if slot is None or not 0 < slot <= self.max_slots:
+                problems.append(f'{dcom_id}: no routing table slot for this id')
+                continue
+            if address in owners:
+                problems.append(f'{dcom_id}: address {address} is also used by {owners[address]}')
+                continue
+            owners[address] = dcom_id
+            desired[slot] = ModemRoute(self.table_base + slot, self.priority_base + slot, interface, address, gateway)
+        return desired, problems
+
+    def _run(self, args, stdin=None):
+        return subprocess.run(self.ip_command + args, input=stdin, capture_output=True, text=True, timeout=10)
+
+    def read_applied(self):
+        """Our rules and tables as the kernel has them now"""
+        result = self._run(['-j', 'rule', 'show'])
+        if result.returncode != 0:
+            raise RuntimeError(result.stderr.strip() or 'ip rule show failed')
+        applied = {}
+        for rule in json.loads(result.stdout or '[]'):
+            slot = rule.get('priority', 0) - self.priority_base
+            if not 0 < slot <= self.max_slots or str(rule.get('table')) != str(self.table_base + slot):
+                continue
+            route = self._run(['-j', 'route', 'show', 'table', str(self.table_base + slot), 'default'])
+            default = (json.loads(route.stdout or '[]') or [{}])[0] if route.returncode == 0 else {}
+            applied[slot] = ModemRoute(self.table_base + slot, rule['priority'], default.get('dev'),
+                                       rule.get('src'), default.get('gateway'))
+        return applied
+
+    def commands(self, desired, applied):
+        """`ip -batch` lines turning `applied` into `desired`"""
+        lines = []
+        for slot in sorted(set(desired) | set(applied)):
+            want, have = desired.get(slot), applied.get(slot)
+            if want == have:
+                continue
+            if want is None:
+                lines += [f'rule del priority {have.priority}', f'route flush table {have.table}']
+                continue
+            if have is None or (have.gateway, have.interface) != (want.gateway, want.interface):
+                lines.append(f'route replace default via {want.gateway} dev {want.interface} table {want.table}')
+            if have is None or have.address != want.address:
+                if have is not None:
+                    lines.append(f'rule del priority {have.priority}')
+                lines.append(f'rule add from {want.address}/32 table {want.table} priority {want.priority}')
+        return lines
+
+    def sync(self, devices):
+        """Apply the routing for `devices` ({dcom_id: device}); returns what was done"""
+        with self._lock:
+            desired, problems = self.plan(devices)
+            try:
+                if self._applied is None:
+                    self._applied = self.read_applied()
+                lines = self.commands(desired, self._applied)
+                if lines:
+                    result = self._run(['-force', '-batch', '-'], stdin='\n'.join(lines) + '\n')
+                    if result.returncode != 0:
+                        self._applied = None  # re-read the real state next time
+                        return {'success': False, 'commands': lines, 'problems': problems,
+                                'message': result.stderr.strip() or 'ip -batch failed'}
+                self._applied = desired
+                return {'success': True, 'commands': lines, 'problems': problems}
+            except Exception as e:
+                self._applied = None
+                return {'success': False, 'commands': [], 'problems': problems, 'message': str(e)}
+
+    def routes(self):
+        """{slot: route} last applied (empty until the first successful sync)"""
+        with self._lock:
+            return {slot: route.to_dict() for slot, route in (self._applied or {}).items()}
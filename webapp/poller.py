@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+"""
+Proxy Farm System - Multi-modem poller
+Queries every HiLink in the device registry in parallel
+"""
+
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from hilink import get_client, CONNECTION_STATUS, NETWORK_TYPES
+
+
+class ModemPoller:
+    """
+    Bounded thread pool sweep over all modems. Each modem gets its own socket
+    timeout; modems that keep failing are backed off exponentially so one dead
+    stick doesn't cost a timeout on every sweep.
+    """
+
+    def __init__(self, max_workers=32, timeout=1.5, backoff_base=5, max_backoff=300):
+        self.timeout = timeout
+        self.backoff_base = backoff_base
+        self.max_backoff = max_backoff
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='modem-poll')
+        self._failures = {}  # device_id -> consecutive failures
+        self._retry_at = {}  # device_id -> epoch of next attempt
+        self._last = {}  # device_id -> last result
+        self._lock = threading.Lock()
+
+    def _client(self, device):
+        return get_client(device['ip'], interface=device.get('interface'))
+
+    def _poll_one(self, device_id, device):
+        started = time.time()
+        try:
+            data = self._client(device).snapshot(self.timeout)
+            status = data['status']
+            signal = data['signal']
+            conn_status = status.get('ConnectionStatus', '')
+            result = {
+                'reachable': True,
+                'connected': conn_status == '901',
+                'connection_status': conn_status,
+                'status': CONNECTION_STATUS.get(conn_status, f'Unknown ({conn_status})'),
+                'wan_ip': status.get('WanIPAddress') or 'N/A',
+                'network': NETWORK_TYPES.get(status.get('CurrentNetworkType', ''), 'Unknown'),
+                'signal': signal.get('rssi') or 'N/A',
+                'rsrp': signal.get('rsrp') or 'N/A',
+                'sinr': signal.get('sinr') or 'N/A',
+                'traffic': data['traffic'],
+                'error': None
+            }
+            with self._lock:
+                self._failures.pop(device_id, None)
+                self._retry_at.pop(device_id, None)
+        except Exception as e:
+            # The client is shared with the health prober and reconnects; it already
+            # drops its own connection on transport errors, under its lock
+            with self._lock:
+                failures = self._failures.get(device_id, 0) + 1
+                self._failures[device_id] = failures
+                delay = min(self.max_backoff, self.backoff_base * 2 ** (failures - 1))
+                self._retry_at[device_id] = time.time() + delay * random.uniform(0.8, 1.2)
+            result = {
+                'reachable': False,
+                'connected': False,
+                'connection_status': None,
+                'status': 'Unreachable',
+                'wan_ip': 'N/A',
+                'network': 'N/A',
+                'signal': 'N/A',
+                'rsrp': 'N/A',
+                'sinr': 'N/A',
+                'traffic': {},
+                'error': str(e) or e.__class__.__name__
+            }
+        result['latency_ms'] = round((time.time() - started) * 1000, 1)
+        result['polled_at'] = time.time()
+        with self._lock:
+            self._last[device_id] = result
+        return result
+
+    def poll(self, devices):
+        """Sweep all devices and return {device_id: result}"""
+        now = time.time()
+        results = {}
+        futures = {}
+
+        for device_id, device in devices.items():
+            retry_at = self._retry_at.get(device_id)
+            if retry_at and now < retry_at:
+                # Still backing off - report the last known state
+                last = dict(self._last.get(device_id, {'reachable': False, 'connected': False,
+                                                       'status': 'Unreachable'}))
+                last['backoff_until'] = retry_at
+                last['failures'] = self._failures.get(device_id, 0)
+                results[device_id] = last
+                continue
+            futures[self._executor.submit(self._poll_one, device_id, device)] = device_id
+
+        # Socket timeouts bound each modem; the sweep deadline is a safety net
+        done, pending = wait(futures, timeout=self.timeout * 2 + 1)
+        for future in done:
+            results[futures[future]] = future.result()
+        for future in pending:
+            results[futures[future]] = {'reachable': False, 'connected': False,
+                                        'status': 'Timeout', 'error': 'sweep deadline exceeded'}
+        return results
+
+    def forget(self, device_id):
+        """Drop backoff state for a device (e.g. after it was replugged)"""
+        with self._lock:
+            self._failures.pop(device_id, None)
+            self._retry_at.pop(device_id, None)
+            self._last.pop(device_id, None)
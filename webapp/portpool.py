@@ -0,0 +1,381 @@
+#!/usr/bin/env python3
+"""
+Proxy Farm System - Port pool
+Hands out proxy ports to users: shared ports balanced by load, dedicated
+ports one user each
+"""
+
+import json
+import threading
+
+from proxyconf import STANDARD_PORTS, PORT_TYPES, Listener
+
+# Dedicated (one user per port) ranges used when there is no pool file
+DEFAULT_DEDICATED_RANGES = (
+    {'name': 'dedicated-http', 'start': 20000, 'end': 29999, 'port_types': ['http'], 'service': 'proxy'},
+    {'name': 'dedicated-socks5', 'start': 30000, 'end': 39999, 'port_types': ['socks5'], 'service': 'socks'},
+)
+POLICIES = ('least_loaded', 'sticky')
+
+
+class PoolExhausted(RuntimeError):
+    pass
+
+
+class PortRange:
+    """
+    Ports start..end serving `port_types` with one 3proxy `service`.
+    `capacity` is users per port: 1 makes the ports dedicated, None leaves
+    shared ports unbounded (they are balanced by load instead).
+    """
+
+    __slots__ = ('name', 'start', 'end', 'port_types', 'service', 'capacity', 'free', 'empty')
+
+    def __init__(self, name, start, end, port_types, service='proxy', capacity=1):
+        if not 0 < start <= end < 65536:
+            raise ValueError(f'Range {name}: invalid ports {start}-{end}')
+        self.name = name
+        self.start = start
+        self.end = end
+        self.port_types = tuple(port_types)
+        self.service = service
+        self.capacity = capacity
+        # Bit per port, set while the port has no users; `free` is a stack of
+        # such ports (entries whose bit was cleared since are skipped on pop)
+        self.empty = bytearray(b'\xff' * ((end - start) // 8 + 1))
+        self.free = list(range(end, start - 1, -1))
+
+    @property
+    def dedicated(self):
+        return self.capacity == 1
+
+    def __contains__(self, port):
+        return self.start <= port <= self.end
+
+    def is_empty(self, port):
+        i = port - self.start
+        return bool(self.empty[i >> 3] >> (i & 7) & 1)
+
+    def set_empty(self, port, empty):
+        i = port - self.start
+        if empty:
+            if not self.empty[i >> 3] >> (i & 7) & 1:
+                self.empty[i >> 3] |= 1 << (i & 7)
+                self.free.append(port)
+        else:
+            self.empty[i >> 3] &= ~(1 << (i & 7)) & 0xFF
+
+    def pop_empty(self):
+        """An empty port, or None - amortised O(1)"""
+        while self.free:
+            port = self.free.pop()
+            if self.is_empty(port):
+                return port
+        return None
+
+    def to_dict(self):
+        return {'name': self.name, 'start': self.start, 'end': self.end, 'port_types': list(self.port_types),
+                'service': self.service, 'capacity': self.capacity}
+
+
+def standard_ranges(capacity=None):
+    """The shared 3330-3339 ports, one range each, serving the types in PORT_TYPES"""
+    ranges = []
+    for port, (_, service, _) in sorted(STANDARD_PORTS.items()):
+        port_types = [port_type for port_type, ports in PORT_TYPES.items() if port in ports]
+        ranges.append(PortRange(f'shared-{port}', port, port, port_types, service, capacity))
+    return ranges
+
+
+def load_ranges(path):
+    """
+    Standard shared ranges plus the dedicated ranges from `path` (JSON
+    {"shared_capacity": N, "ranges": [{"name", "start", "end",
+    "port_types", "service", "capacity"}]}), or the defaults when it is missing
+    """
+    try:
+        with open(path, 'r') as f:
+            config = json.load(f)
+    except FileNotFoundError:
+        config = {'ranges': DEFAULT_DEDICATED_RANGES}
+    ranges = standard_ranges(config.get('shared_capacity'))
+    for entry in config.get('ranges', []):
+        ranges.append(PortRange(entry['name'], int(entry['start']), int(entry['end']), entry['port_types'],
+                                entry.get('service', 'proxy'), entry.get('capacity', 1)))
+    ordered = sorted(ranges, key=lambda r: r.start)
+    for previous, current in zip(ordered, ordered[1:]):
+        if current.start <= previous.end:
+            raise ValueError(f'Port ranges {previous.name} and {current.name} overlap')
+    return ranges
+
+
+class PortPool:
+    """
+    Port assignments per (username, port_type, dedicated), mirrored from
+    the store. A user keeps one port per type; released assignments are
+    remembered so `sticky` allocation can give the same port back.
+
+    Dedicated ports come off each range's empty-port stack, so allocating
+    and freeing are O(1) however large the range. Shared ports go to the
+    one with the fewest live connections plus assigned users.
+
+    Writes are optimistic: they carry the store version the choice was
+    made against, and if another worker wrote in between the pool reloads
+    and chooses again.
+    """
+
+    def __init__(self, store, ranges, load=None):
+        self.store = store
+        self.ranges = list(ranges)
+        self.load = load  # -> {port: live connections}
+        self._lock = threading.RLock()
+        self._version = None
+        self._reset()
+
+    def _reset(self):
+        self._active = {}  # (username, port_type, dedicated) -> port
+        self._released = {}  # same key -> last port
+        self._users = {}  # port -> {username}
+        for r in self.ranges:
+            r.empty = bytearray(b'\xff' * ((r.end - r.start) // 8 + 1))
+            r.free = list(range(r.end, r.start - 1, -1))
+
+    def _load(self):
+        version = self.store.version('ports')
+        self._reset()
+        for username, port_type, dedicated, port, released_at in self.store.scan_port_assignments():
+            key = (username, port_type, bool(dedicated))
+            if released_at is None:
+                self._take(key, port)
+            else:
+                self._released[key] = port
+        self._version = version
+
+    def sync(self):
+        with self._lock:
+            if self.store.version('ports') != self._version:
+                self._load()
+
+    def range_of(self, port):
+        for r in self.ranges:
+            if port in r:
+                return r
+        return None
+
+    # In-memory bookkeeping -------------------------------------------------------
+
+    def _take(self, key, port):
+        self._active[key] = port
+        self._released.pop(key, None)
+        users = self._users.setdefault(port, set())
+        users.add(key[0])
+        r = self.range_of(port)
+        if r:
+            r.set_empty(port, False)
+
+    def _drop(self, key):
+        port = self._active.pop(key, None)
+        if port is None:
+            return None
+        self._released[key] = port
+        users = self._users.get(port, set())
+        users.discard(key[0])
+        if not users:
+            self._users.pop(port, None)
+            r = self.range_of(port)
+            if r:
+                r.set_empty(port, True)
+        return port
+
+    def _has_room(self, r, port):
+        return r.capacity is None or len(self._users.get(port, ())) < r.capacity
+
+    def _choose(self, port_type, dedicated, previous, policy, live):
+        """A port for a new assignment (not yet taken)"""
+        ranges = [r for r in self.ranges if port_type in r.port_types and r.dedicated == dedicated]
+        if not ranges:
+            raise ValueError(f'No {"dedicated" if dedicated else "shared"} ports serve {port_type}')
+        if policy == 'sticky' and previous is not None:
+            r = self.range_of(previous)
+            if r in ranges and self._has_room(r, previous):
+                return previous
+        if dedicated:
+            for r in ranges:
+                port = r.pop_empty()
+                if port is not None:
+                    return port
+            raise PoolExhausted(f'No free dedicated {port_type} port')
+        best = None
+        for r in ranges:
+            for port in range(r.start, r.end + 1):
+                if self._has_room(r, port):
+                    score = (live.get(port, 0) + len(self._users.get(port, ())), port)
+                    if best is None or score < best:
+                        best = score
+        if best is None:
+            raise PoolExhausted(f'No shared {port_type} port has room')
+        return best[1]
+
+    # Allocation ------------------------------------------------------------------
+
+    def allocate_many(self, usernames, port_type='http', dedicated=False, policy='least_loaded'):
+        """{username: port}; users who already hold a port of this kind keep it"""
+        if policy not in POLICIES:
+            raise ValueError(f'policy must be one of {", ".join(POLICIES)}')
+        live = self.load() if self.load and not dedicated else {}
+        for _ in range(5):
+            with self._lock:
+                self.sync()
+                result, taken = {}, []
+                try:
+                    for username in usernames:
+                        key = (username, port_type, dedicated)
+                        if key in self._active:
+                            result[username] = self._active[key]
+                            continue
+                        port = self._choose(port_type, dedicated, self._released.get(key), policy, live)
+                        self._take(key, port)
+                        taken.append((key, port))
+                        result[username] = port
+                except Exception:
+                    self._load()  # undo the tentative in-memory takes
+                    raise
+                if not taken:
+                    return result
+                version = self.store.write_ports(assign=[key + (port,) for key, port in taken],
+                                                 expected_version=self._version)
+                if version is not None:
+                    self._version = version
+                    return result
+                self._load()  # another worker wrote first; choose again against its state
+        raise RuntimeError('Port pool is too busy, try again')
+
+    def allocate(self, username, port_type='http', dedicated=False, policy='least_loaded'):
+        return self.allocate_many([username], port_type, dedicated, policy)[username]
+
+    def least_loaded(self, port_type='http'):
+        """The shared port a new user of this type would get, without assigning it"""
+        live = self.load() if self.load else {}
+        with self._lock:
+            self.sync()
+            return self._choose(port_type, False, None, 'least_loaded', live)
+
+    def release(self, username, port_type='http', dedicated=False):
+        """Free a user's port; returns it (None if they had none)"""
+        for _ in range(5):
+            with self._lock:
+                self.sync()
+                key = (username, port_type, dedicated)
+                if key not in self._active:
+                    return None
+                version = self.store.write_ports(release=[key], expected_version=self._version)
+                if version is not None:
+                    port = self._drop(key)
+                    self._version = version
+                    return port
+                self._load()
+        raise RuntimeError('Port pool is too busy, try again')
+
+    def replace(self, assignments):
+        """
+        Set who is on each port given ({port: [usernames]}, e.g. from the
+        assignment UI). A user moved here gives up their previous port of
+        the same kind; users no longer listed on a given port are released.
+        """
+        with self._lock:
+            self.sync()
+            on_port = {}
+            for key, port in self._active.items():
+                on_port.setdefault(port, {})[key[0]] = key
+            assign, release, seen = [], [], set()
+            for port, usernames in assignments.items():
+                port = int(port)
+                r = self.range_of(port)
+                if r is None:
+                    raise ValueError(f'Port {port} is not in the pool')
+                usernames = list(dict.fromkeys(usernames))
+                if r.capacity is not None and len(usernames) > r.capacity:
+                    raise ValueError(f'Port {port} takes at most {r.capacity} user(s)')
+                current = on_port.get(port, {})
+                for username in usernames:
+                    key = current.get(username) or (username, r.port_types[0], r.dedicated)
+                    if key in seen:
+                        raise ValueError(f'{username} is listed on two {key[1]} ports')
+                    seen.add(key)
+                    if username not in current:
+                        assign.append(key + (port,))
+                release.extend(key for username, key in current.items() if username not in usernames)
+            release = [key for key in release if key not in seen]
+            if not assign and not release:
+                return {'assigned': 0, 'released': 0}
+            version = self.store.write_ports(assign=assign, release=release, expected_version=self._version)
+            if version is None:
+                self._load()
+                raise RuntimeError('Assignments changed meanwhile, reload and try again')
+            for key in release:
+                self._drop(key)
+            for username, port_type, dedicated, port in assign:
+                key = (username, port_type, dedicated)
+                self._drop(key)
+                self._take(key, port)
+            self._version = version
+            return {'assigned': len(assign), 'released': len(release)}
+
+    # Reading ------------------------------------------------------------------------
+
+    def port_of(self, username, port_type='http', dedicated=False):
+        self.sync()
+        return self._active.get((username, port_type, dedicated))
+
+    def dedicated_ports(self):
+        """{port: (range, sorted usernames)} for dedicated ports in use - the listeners to compile"""
+        self.sync()
+        with self._lock:
+            result = {}
+            for port, users in self._users.items():
+                r = self.range_of(port)
+                if r is not None and r.dedicated and users:
+                    result[port] = (r, sorted(users))
+            return result
+
+    def dedicated_ports_of(self, username):
+        """{port_type: port} of the user's dedicated ports"""
+        self.sync()
+        with self._lock:
+            return {key[1]: port for key, port in self._active.items() if key[0] == username and key[2]}
+
+    def listeners(self, usernames=None):
+        """proxyconf.Listener for each dedicated port in use, open to its users only (those in `usernames` if given)"""
+        listeners = []
+        for port, (port_range, users) in sorted(self.dedicated_ports().items()):
+            if usernames is not None:
+                users = [username for username in users if username in usernames]
+            if users:
+                listeners.append(Listener(port, port_range.service, 'strong', users=users, name=port_range.name))
+        return listeners
+
+    def assignments(self, include_dedicated=True):
+        """{port: sorted usernames}"""
+        self.sync()
+        with self._lock:
+            return {port: sorted(users) for port, users in sorted(self._users.items())
+                    if include_dedicated or not (self.range_of(port) and self.range_of(port).dedicated)}
+
+    def stats(self):
+        """Per shared port: users, capacity, live connections; per range: ports used/free"""
+        self.sync()
+        live = self.load() if self.load else {}
+        with self._lock:
+            ports = {}
+            ranges = []
+            for r in self.ranges:
+                used = sum(1 for port in self._users if port in r)
+                ranges.append({**r.to_dict(), 'ports': r.end - r.start + 1, 'used': used,
+                               'free': r.end - r.start + 1 - used})
+                if r.dedicated:
+                    continue
+                for port in range(r.start, r.end + 1):
+                    users = len(self._users.get(port, ()))
+                    ports[port] = {'users': users, 'capacity': r.capacity, 'connections': live.get(port, 0),
+                                   'load': round(100 * users / r.capacity) if r.capacity else None}
+            return {'ports': ports, 'ranges': ranges}
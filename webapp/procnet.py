@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+"""
+Proxy Farm System - Process and socket table
+Reads /proc directly instead of running pgrep/netstat
+"""
+
+import os
+import socket
+import struct
+import time
+from collections import Counter
+
+# /proc/net/tcp `st` column
+TCP_ESTABLISHED = 0x01
+TCP_LISTEN = 0x0A
+_ESTABLISHED = b'%02X' % TCP_ESTABLISHED
+_LISTEN = b'%02X' % TCP_LISTEN
+
+
+def find_pids(name, proc_root='/proc'):
+    """PIDs whose command name (/proc/<pid>/comm) is `name`"""
+    pids = []
+    for entry in os.listdir(proc_root):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'{proc_root}/{entry}/comm', 'rb') as f:
+                if f.read().rstrip(b'\n').decode(errors='replace') == name:
+                    pids.append(int(entry))
+        except OSError:
+            continue  # exited while we were looking
+    return sorted(pids)
+
+
+def socket_inodes(pid, proc_root='/proc'):
+    """Inodes of the sockets open in a process (empty if it is gone or not ours to read)"""
+    inodes = set()
+    fd_dir = f'{proc_root}/{pid}/fd'
+    try:
+        fds = os.listdir(fd_dir)
+    except OSError:
+        return inodes
+    for fd in fds:
+        try:
+            target = os.readlink(f'{fd_dir}/{fd}')
+        except OSError:
+            continue
+        if target.startswith('socket:['):
+            inodes.add(int(target[8:-1]))
+    return inodes
+
+
+def _ip(hex_ip):
+    """'0100007F' -> '127.0.0.1'; addresses are in host byte order words"""
+    raw = bytes.fromhex(hex_ip)
+    if len(raw) == 4:
+        return socket.inet_ntop(socket.AF_INET, struct.pack('<I', *struct.unpack('>I', raw)))
+    ip = socket.inet_ntop(socket.AF_INET6, struct.pack('<4I', *struct.unpack('>4I', raw)))
+    return ip[7:] if ip.startswith('::ffff:') else ip  # IPv4 clients on a dual-stack listener
+
+
+def read_tcp(proc_root='/proc'):
+    """
+    One pass over /proc/net/tcp and tcp6, keeping only what the proxy views
+    need: ({port: [listening inodes]}, [(local port hex, remote 'ADDR:PORT' hex)]
+    for established sockets, rows read). Established rows are only sliced here;
+    most belong to other processes and are dropped without being decoded.
+    """
+    listening, established, rows = {}, [], 0
+    for table, width in (('tcp', 8), ('tcp6', 32)):
+        try:
+            with open(f'{proc_root}/net/{table}', 'rb') as f:
+                lines = f.read().splitlines()[1:]  # header
+        except OSError:
+            continue
+        rows += len(lines)
+        # Fixed-width columns after "sl: ": local ADDR:PORT, remote ADDR:PORT, st
+        span = width + 5
+        for line in lines:
+            start = line.find(b':') + 2
+            state = line[start + 2 * span + 2:start + 2 * span + 4]
+            if state == _ESTABLISHED:
+                established.append((line[start + width + 1:start + span], line[start + span + 1:start + 2 * span + 1]))
+            elif state == _LISTEN:
+                listening.setdefault(int(line[start + width + 1:start + span], 16), []).append(int(line.split()[9]))
+    return listening, established, rows
+
+
+class ProxySockets:
+    """
+    A process's listening ports and the established client connections
+    accepted on them - matched on the exact local port, so 3330 never
+    counts connections on 33301. Remote addresses stay raw hex until
+    per-client counts are asked for.
+    """
+
+    __slots__ = ('pid', 'listeners', 'connections', 'scanned', 'elapsed_ms')
+
+    def __init__(self, pid, listeners, connections, scanned=0, elapsed_ms=0.0):
+        self.pid = pid
+        self.listeners = listeners  # port -> inode
+        self.connections = connections  # port -> [remote 'ADDR:PORT' hex]
+        self.scanned = scanned
+        self.elapsed_ms = elapsed_ms
+
+    @classmethod
+    def collect(cls, pid, inodes, tables, started):
+        listening, established, rows = tables
+        listeners = {}
+        for port, port_inodes in listening.items():
+            for inode in port_inodes:
+                if inode in inodes:
+                    listeners[port] = inode
+        wanted = {b'%04X' % port: port for port in listeners}
+        connections = {}
+        for port_hex, remote in established:
+            # The upstream leg of each tunnel has an ephemeral local port, so this is client legs only
+            port = wanted.get(port_hex)
+            if port is not None:
+                connections.setdefault(port, []).append(remote.decode())
+        return cls(pid, listeners, connections, rows, round((time.perf_counter() - started) * 1000, 2))
+
+    @property
+    def total(self):
+        return sum(len(remotes) for remotes in self.connections.values())
+
+    def per_listener(self):
+        """{listening port: established client connections}"""
+        return {port: len(self.connections.get(port, ())) for port in sorted(self.listeners)}
+
+    def per_client(self):
+        """{client ip: established connections}"""
+        counts = Counter()
+        for remotes in self.connections.values():
+            counts.update(remote.rsplit(':', 1)[0] for remote in remotes)
+        return {_ip(hex_ip): n for hex_ip, n in counts.items()}
+
+    def pairs(self):
+        """{(port, remote hex)} - one per client connection"""
+        return {(port, remote) for port, remotes in self.connections.items() for remote in remotes}
+
+    def connection_list(self):
+        """[(local port, client ip, client port)]"""
+        result = []
+        for port, remotes in sorted(self.connections.items()):
+            for remote in remotes:
+                host, remote_port = remote.rsplit(':', 1)
+                result.append((port, _ip(host), int(remote_port, 16)))
+        return result
+
+
+def process_sockets(pid, proc_root='/proc'):
+    """ProxySockets for a known pid"""
+    started = time.perf_counter()
+    return ProxySockets.collect(pid, socket_inodes(pid, proc_root), read_tcp(proc_root), started)
+
+
+class ProxyInspector:
+    """
+    Finds the proxy's sockets without pgrep/netstat. The PID is whichever
+    `process_name` process owns the listening sockets; it is remembered and
+    only looked up again (by /proc/<pid>/comm) once it no longer owns them.
+    """
+
+    def __init__(self, process_name='3proxy', proc_root='/proc'):
+        self.process_name = process_name
+        self.proc_root = proc_root
+        self._pid = None
+
+    def _owner(self, listen_inodes):
+        """(pid, its socket inodes), or (None, empty) if the process isn't running"""
+        if self._pid is not None:
+            inodes = socket_inodes(self._pid, self.proc_root)
+            if inodes & listen_inodes:
+                return self._pid, inodes
+        fallback = None
+        for pid in find_pids(self.process_name, self.proc_root):
+            inodes = socket_inodes(pid, self.proc_root)
+            if inodes & listen_inodes:
+                self._pid = pid
+                return pid, inodes
+            fallback = fallback or (pid, inodes)  # running but not listening (e.g. mid-reload)
+        self._pid = None
+        return fallback or (None, set())
+
+    def scan(self):
+        started = time.perf_counter()
+        tables = read_tcp(self.proc_root)
+        pid, inodes = self._owner({inode for port_inodes in tables[0].values() for inode in port_inodes})
+        return ProxySockets.collect(pid, inodes, tables, started)
@@ -0,0 +1,420 @@
+#!/usr/bin/env python3
+"""
+Proxy Farm System - 3proxy config compiler
+Builds 3proxy.cfg from a typed model, diffs it against the deployed file
+and deploys atomically
+
+    python3 proxyconf.py --db /home/proxy-farm-system/configs/proxyfarm.db --output 3proxy.cfg
+"""
+
+import argparse
+import difflib
+import fcntl
+import hashlib
+import hmac
+import os
+import shutil
+import sys
+from contextlib import contextmanager
+from datetime import datetime
+
+# Port -> (port type, 3proxy service, auth). ProxyManager hands these out by port type.
+STANDARD_PORTS = {
+    3330: ('multi', 'auto', 'strong'),  # HTTP and SOCKS on one port
+    3331: ('http', 'proxy', 'strong'),
+    3332: ('http', 'proxy', 'strong'),
+    3333: ('http', 'proxy', 'strong'),
+    3334: ('http', 'proxy', 'strong'),
+    3335: ('socks5', 'socks', 'strong'),
+    3336: ('socks5', 'socks', 'strong'),
+    3337: ('socks4', 'socks', 'strong'),
+    3338: ('no_auth', 'proxy', 'none'),
+    3339: ('no_auth', 'proxy', 'none')
+}
+
+# Port type -> ports that serve it
+PORT_TYPES = {
+    'http': [3330, 3331, 3332, 3333, 3334],
+    'socks5': [3330, 3335, 3336],
+    'socks4': [3337],
+    'no_auth': [3338, 3339]
+}
+
+# Destinations no customer may reach through the farm (the host itself, the LAN, the modems' web UIs)
+PRIVATE_TARGETS = ('127.0.0.0/8', '10.0.0.0/8', '172.16.0.0/12', '192.168.0.0/16', '169.254.0.0/16')
+
+# Internal users the health prober sends its HTTP probe through, one per modem.
+# Customers can't take names with this prefix; log stats leave them out.
+PROBE_USER_PREFIX = '__probe_'
+
+SERVICES = ('proxy', 'socks', 'auto')
+COUNTER_PERIODS = ('H', 'D', 'W', 'M', 'N')
+AUTH_TYPES = ('strong', 'none', 'iponly')
+USERS_PER_LINE = 100
+
+
+def _valid_credential(value):
+    return isinstance(value, str) and bool(value) and ':' not in value and not any(c.isspace() for c in value)
+
+
+def _chunks(items, size=USERS_PER_LINE):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+class Limits:
+    """Per-user limits: bandwidth caps in bits per second, new connections per minute"""
+
+    __slots__ = ('rate_in', 'rate_out', 'conn_rate')
+
+    def __init__(self, rate_in=None, rate_out=None, conn_rate=None):
+        self.rate_in = rate_in
+        self.rate_out = rate_out
+        self.conn_rate = conn_rate
+
+
+class Counter:
+    """A 3proxy traffic counter for one user: number N, reset period, limit in MB (0 = count only)"""
+
+    __slots__ = ('number', 'period', 'limit_mb')
+
+    def __init__(self, number, period='M', limit_mb=0):
+        self.number = int(number)
+        self.period = period
+        self.limit_mb = int(limit_mb)
+
+
+class UserSpec:
+    """
+    A user; `egress` is the local address their outgoing connections leave
+    from (their modem's), `counter` counts their downloaded traffic and cuts
+    them off at its limit
+    """
+
+    __slots__ = ('username', 'password', 'type', 'limits', 'egress', 'counter')
+
+    def __init__(self, username, password, type='CL', limits=None, egress=None, counter=None):
+        self.username = username
+        self.password = password
+        self.type = type
+        self.limits = limits or Limits()
+        self.egress = egress
+        self.counter = counter
+
+
+class Acl:
+    """One allow/deny rule; '*' matches anything"""
+
+    __slots__ = ('action', 'users', 'sources', 'targets', 'ports')
+
+    def __init__(self, action, users='*', sources='*', targets='*', ports='*'):
+        if action not in ('allow', 'deny'):
+            raise ValueError(f'ACL action must be allow or deny, not {action!r}')
+        self.action = action
+        self.users = users
+        self.sources = sources
+        self.targets = targets
+        self.ports = ports
+
+    def render(self):
+        fields = [self.users, self.sources, self.targets, self.ports]
+        while len(fields) > 1 and fields[-1] == '*':
+            fields.pop()  # trailing wildcards are implied
+        return f"{self.action} {' '.join(','.join(f) if isinstance(f, (list, tuple)) else f for f in fields)}"
+
+
+class Listener:
+    """
+    One 3proxy service on one port. `external` is the default source
+    address of its outgoing connections (users with their own `egress`
+    override it); `users` limits it to those users (None = every user);
+    `sources` limits which client addresses may use it.
+    """
+
+    __slots__ = ('port', 'service', 'auth', 'bind', 'external', 'users', 'sources', 'name')
+
+    def __init__(self, port, service='proxy', auth='strong', bind='0.0.0.0', external=None, users=None,
+                 sources='*', name=None):
+        self.port = int(port)
+        self.service = service
+        self.auth = auth
+        self.bind = bind
+        self.external = external
+        self.users = users
+        self.sources = sources
+        self.name = name
+
+
+class ProxyConfig:
+    """Everything that goes into 3proxy.cfg"""
+
+    def __init__(self, listeners, users=(), acls=None, users_file=None, log_file=None,
+                 nservers=('8.8.8.8', '8.8.4.4'), timeouts='1 5 30 60 180 1800 15 60', log_rotate=30,
+                 counter_file=None, maxconn=None, internal_users=()):
+        self.listeners = list(listeners)
+        self.users = list(users)
+        self.internal_users = list(internal_users)  # always listed inline, never limited or counted
+        # Checked before each listener's own rules; first match wins
+        self.acls = list(acls) if acls is not None else [Acl('deny', targets=list(PRIVATE_TARGETS))]
+        self.users_file = users_file  # include users from this file instead of listing them inline
+        self.log_file = log_file
+        self.nservers = nservers
+        self.timeouts = timeouts
+        self.log_rotate = log_rotate
+        self.counter_file = counter_file  # 3proxy keeps the users' traffic counters here
+        self.maxconn = maxconn  # concurrent connections per service
+
+    def validate(self):
+        ports = set()
+        usernames = set()
+        counters = set()
+        for user in self.users + self.internal_users:
+            if not _valid_credential(user.username) or not _valid_credential(user.password):
+                raise ValueError(f'Invalid credentials for user {user.username!r}')
+            if user.username in usernames:
+                raise ValueError(f'Duplicate user {user.username}')
+            usernames.add(user.username)
+            if user.counter:
+                if not self.counter_file:
+                    raise ValueError(f'User {user.username} has a traffic counter but there is no counter file')
+                if user.counter.number < 1 or user.counter.number in counters:
+                    raise ValueError(f'User {user.username}: counter number {user.counter.number} is invalid or taken')
+                if user.counter.period not in COUNTER_PERIODS:
+                    raise ValueError(f'User {user.username}: unknown counter period {user.counter.period!r}')
+                counters.add(user.counter.number)
+        for listener in self.listeners:
+            if listener.port in ports:
+                raise ValueError(f'Port {listener.port} is used by more than one listener')
+            ports.add(listener.port)
+            if listener.service not in SERVICES:
+                raise ValueError(f'Port {listener.port}: unknown service {listener.service!r}')
+            if listener.auth not in AUTH_TYPES:
+                raise ValueError(f'Port {listener.port}: unknown auth {listener.auth!r}')
+            if listener.users is not None and self.users:
+                unknown = set(listener.users) - usernames
+                if unknown:
+                    raise ValueError(f'Port {listener.port}: unknown users {", ".join(sorted(unknown))}')
+
+
+def render(config):
+    """3proxy.cfg text; the same model always gives byte-identical output"""
+    config.validate()
+    out = ['# 3proxy configuration - generated by the Proxy Farm webapp (proxyconf.py)',
+           '# Do not edit: changes are overwritten on the next deploy', '']
+    out += [f'nserver {server}' for server in config.nservers]
+    out += ['nscache 65536', f'timeouts {config.timeouts}']
+    if config.maxconn:
+        out.append(f'maxconn {int(config.maxconn)}')
+    out.append('')
+    if config.log_file:
+        out += [f'log {config.log_file} D',
+                'logformat "- +_L%t.%. %N.%p %E %U %C:%c %R:%r %O %I %h %T"',
+                f'rotate {config.log_rotate}', '']
+
+    out.append('# Users')
+    if config.users_file:
+        out.append(f'users ${config.users_file}')
+    else:
+        users = sorted(config.users, key=lambda u: u.username)
+        for chunk in _chunks(users):
+            out.append('users ' + ' '.join(f'{u.username}:{u.type}:{u.password}' for u in chunk))
+    for chunk in _chunks(sorted(config.internal_users, key=lambda u: u.username)):
+        out.append('users ' + ' '.join(f'{u.username}:{u.type}:{u.password}' for u in chunk))
+    out.append('')
+
+    # Bandwidth and connection-rate limits: one line per distinct rate, users grouped
+    by_rate = {}
+    for user in config.users:
+        for directive, rate in (('bandlimin', user.limits.rate_in), ('bandlimout', user.limits.rate_out),
+                                ('connlim', user.limits.conn_rate)):
+            if rate:
+                by_rate.setdefault((directive, int(rate)), []).append(user.username)
+    if by_rate:
+        out.append('# Per-user limits')
+        for (directive, rate), usernames in sorted(by_rate.items()):
+            period = ' 60' if directive == 'connlim' else ''  # connlim counts per 60 seconds
+            for chunk in _chunks(sorted(usernames)):
+                out.append(f"{directive} {rate}{period} {','.join(chunk)}")
+        out.append('')
+
+    # Traffic counters: 3proxy denies a user once their counter passes its limit
+    counted = sorted((user for user in config.users if user.counter), key=lambda u: u.counter.number)
+    if counted:
+        out += ['# Per-user traffic counters', f'counter {config.counter_file}']
+        for user in counted:
+            counter = user.counter
+            out.append(f'countin "{counter.number}/{user.username}" {counter.period} {counter.limit_mb} {user.username}')
+        out.append('')
+
+    # Users pinned to an egress address, grouped by address. An `extip`
+    # parent after an allow line sets the source address for connections
+    # matching that line, so each user leaves through their own modem
+    # whichever port they connect to.
+    egress_groups = {}
+    for user in config.users + config.internal_users:
+        if user.egress:
+            egress_groups.setdefault(user.egress, set()).add(user.username)
+
+    for listener in sorted(config.listeners, key=lambda l: l.port):
+        out.append(f'# Port {listener.port}' + (f' - {listener.name}' if listener.name else ''))
+        out.append(f'auth {listener.auth}')
+        out += [acl.render() for acl in config.acls]
+        if listener.auth == 'strong':
+            allowed = set(listener.users) if listener.users is not None else None
+            pinned = set()
+            for address, usernames in sorted(egress_groups.items()):
+                members = usernames if allowed is None else usernames & allowed
+                pinned |= members
+                for chunk in _chunks(sorted(members)):
+                    out.append(Acl('allow', users=chunk, sources=listener.sources).render())
+                    out.append(f'parent 1000 extip {address} 0')
+            if allowed is None:
+                out.append(Acl('allow', sources=listener.sources).render())
+            else:
+                for chunk in _chunks(sorted(allowed - pinned)):
+                    out.append(Acl('allow', users=chunk, sources=listener.sources).render())
+        else:
+            out.append(Acl('allow', sources=listener.sources).render())
+        out.append('deny *')
+        args = [listener.service, f'-p{listener.port}', f'-i{listener.bind}']
+        if listener.external:
+            args.append(f'-e{listener.external}')
+        out.append(' '.join(args))
+        out += ['flush', '']
+    return '\n'.join(out)
+
+
+def store_users(store):
+    """
+    UserSpec for every user in the store, pinned to the egress address of
+    their modem. The webapp and the CLI both compile from this, so they
+    deploy the same routing.
+    """
+    user_assignments, _ = store.load_assignments()
+    addresses = store.egress_addresses()
+    return [UserSpec(username, password, user_type, egress=addresses.get(user_assignments.get(username)))
+            for username, user_type, password, _ in store.scan_users()]
+
+
+def probe_users(store):
+    """
+    One internal user per modem with a known egress address, pinned to it like
+    its customers. They aren't in the store, so they have no quota and aren't
+    listed. Passwords are derived from a per-install secret so every process
+    compiles (and probes with) the same ones.
+    """
+    secret = store.secret('probe_users').encode()
+    return [UserSpec(f'{PROBE_USER_PREFIX}{dcom_id}',
+                     hmac.new(secret, dcom_id.encode(), hashlib.sha256).hexdigest()[:32], egress=address)
+            for dcom_id, address in sorted(store.egress_addresses().items())]
+
+
+def standard_listeners(no_auth_sources='127.0.0.1'):
+    """The 3330-3339 ports ProxyManager hands out; unauthenticated ports only answer `no_auth_sources`"""
+    listeners = []
+    for port, (port_type, service, auth) in STANDARD_PORTS.items():
+        listeners.append(Listener(port, service, 'iponly' if auth == 'none' else auth,
+                                  sources=no_auth_sources if auth == 'none' else '*', name=port_type))
+    return listeners
+
+
+class ConfigDeployer:
+    """
+    Diffs rendered output against the deployed file and replaces it only when
+    it changed. Writers in several processes hold `locked()` from reading their
+    inputs to the replace, so an older render never lands after a newer one.
+    """
+
+    def __init__(self, path, backup_dir=None, on_change=None, keep_backups=30):
+        self.path = path
+        self.backup_dir = backup_dir
+        self.on_change = on_change  # called after a changed file is in place (e.g. schedule a reload)
+        self.keep_backups = keep_backups
+
+    @contextmanager
+    def locked(self):
+        """Exclusive (flock) across processes deploying to the same path"""
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        with open(f'{self.path}.lock', 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            yield
+
+    def current(self):
+        try:
+            with open(self.path, 'r') as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def diff(self, text):
+        current = self.current()
+        if current == text:
+            return ''
+        return ''.join(difflib.unified_diff(
+            (current or '').splitlines(keepends=True), text.splitlines(keepends=True),
+            fromfile=f'{self.path} (deployed)', tofile=f'{self.path} (compiled)'
+        ))
+
+    def deploy(self, text, dry_run=False):
+        """{'changed', 'diff', 'backup', 'reload'} - nothing is written when the text is unchanged"""
+        diff = self.diff(text)
+        result = {'changed': bool(diff), 'diff': diff, 'backup': None, 'reload': None}
+        if not diff or dry_run:
+            return result
+        result['backup'] = self._backup()
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        tmp_file = f'{self.path}.{os.getpid()}.tmp'
+        with open(tmp_file, 'w') as f:
+            f.write(text)
+        # Holds user names (and passwords when listed inline)
+        os.chmod(tmp_file, 0o640)
+        os.replace(tmp_file, self.path)
+        if self.on_change:
+            result['reload'] = self.on_change()
+        return result
+
+    def _backup(self):
+        if not self.backup_dir or not os.path.exists(self.path):
+            return None
+        os.makedirs(self.backup_dir, exist_ok=True)
+        backup_file = f"{self.backup_dir}/3proxy.cfg.backup.{datetime.now().strftime('%Y%m%d_%H%M%S_%f')}"
+        shutil.copy2(self.path, backup_file)
+        backups = sorted(f for f in os.listdir(self.backup_dir) if f.startswith('3proxy.cfg.backup.'))
+        for name in backups[:-self.keep_backups]:
+            try:
+                os.remove(f'{self.backup_dir}/{name}')
+            except FileNotFoundError:
+                pass  # pruned by another writer
+        return backup_file
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compile 3proxy.cfg from the Proxy Farm store')
+    parser.add_argument('--db', required=True, help='proxyfarm.db')
+    parser.add_argument('--output', required=True, help='config file to write (only if it changed)')
+    parser.add_argument('--users-file', help='include users from this file instead of listing them inline')
+    parser.add_argument('--log-file')
+    parser.add_argument('--no-auth-sources', default='127.0.0.1')
+    parser.add_argument('--counter-file', help="3proxy counter file; users' quotas are compiled in when given")
+    parser.add_argument('--maxconn', type=int)
+    parser.add_argument('--port-pool', help='port_pool.json; dedicated ports in use get their listeners')
+    parser.add_argument('--dry-run', action='store_true', help='print the diff only')
+    args = parser.parse_args()
+
+    from store import Store
+    store = Store(args.db)
+    deployer = ConfigDeployer(args.output)
+    with deployer.locked():
+        users = store_users(store)
+        if args.counter_file:
+            from quota import QuotaBook
+            QuotaBook(store, args.counter_file).apply(users)
+        listeners = standard_listeners(args.no_auth_sources)
+        if args.port_pool:
+            from portpool import PortPool, load_ranges
+            listeners += PortPool(store, load_ranges(args.port_pool)).listeners({user.username for user in users})
+        config = ProxyConfig(listeners, users, users_file=args.users_file, log_file=args.log_file,
+                             counter_file=args.counter_file, maxconn=args.maxconn,
+                             internal_users=probe_users(store))
+        result = deployer.deploy(render(config), dry_run=args.dry_run)
+    sys.stdout.write(result['diff'] or 'No changes\n')
@@ -0,0 +1,275 @@
+#!/usr/bin/env python3
+"""
+Proxy Farm System - 3proxy log statistics
+Follows the 3proxy request log and keeps per-user, per-listener and
+per-destination traffic counters
+"""
+
+import glob
+import heapq
+import json
+import os
+import threading
+import time
+
+# Field order of the logformat in 3proxy.cfg:
+#   "- +_L%t.%. %N.%p %E %U %C:%c %R:%r %O %I %h %T"
+# The "- +_" prefix makes 3proxy write '_' for spaces inside values, so
+# fields never contain a space and the request (%T) is the only one that
+# can be empty.
+TS, LISTENER, ERROR, USER, CLIENT, REMOTE, BYTES_OUT, BYTES_IN, HOPS, REQUEST = range(10)
+FIELDS = 10
+
+# Counter row layout
+REQUESTS, OUT, IN, ERRORS, LAST_SEEN = range(5)
+
+COMPRESSED = ('.gz', '.bz2', '.xz', '.zst')
+
+
+def _row():
+    return [0, 0, 0, 0, 0.0]
+
+
+def _top(table, limit, key=lambda item: item[1][OUT] + item[1][IN]):
+    return heapq.nlargest(limit, table.items(), key=key)
+
+
+def _row_dict(name, row):
+    return {'name': name, 'requests': row[REQUESTS], 'bytes_out': row[OUT], 'bytes_in': row[IN],
+            'bytes': row[OUT] + row[IN], 'errors': row[ERRORS], 'last_seen': row[LAST_SEEN] or None}
+
+
+class ProxyLogStats:
+    """
+    Tails `<log_file>*` (the live log and its rotations) and folds every new
+    line into counters. Each file is followed by inode and offset, so a
+    rotated file is drained to its end before its successor is counted, a
+    truncated one is re-read from the start, and a partial last line is
+    left for the next poll. Lines are split once on spaces - no regex.
+
+    The offsets and counters are checkpointed to `state_file` so a restart
+    carries on where it stopped. Destinations are capped at
+    `max_destinations`; when the cap is hit the least-used half is dropped.
+    """
+
+    def __init__(self, log_file, state_file=None, online_window=300, max_destinations=50000,
+                 chunk_size=1 << 20, max_bytes_per_poll=64 << 20, checkpoint_interval=60, ignore_users=None):
+        self.log_file = log_file
+        self.ignore_users = ignore_users.encode() if ignore_users else None  # prefix of internal users
+        self.state_file = state_file
+        self.online_window = online_window
+        self.max_destinations = max_destinations
+        self.chunk_size = chunk_size
+        self.max_bytes_per_poll = max_bytes_per_poll
+        self.checkpoint_interval = checkpoint_interval
+        self._lock = threading.Lock()
+        self._offsets = None  # (dev, inode) -> bytes consumed; None until the first poll
+        self._checkpointed = 0.0
+        self.reset()
+        self._load()
+
+    def reset(self):
+        self.users = {}  # bytes username -> row
+        self.listeners = {}  # b'PROXY.3331' -> row
+        self.destinations = {}  # b'host' -> row
+        self.codes = {}  # b'00000' -> count
+        self.lines = 0
+        self.malformed = 0
+        self.destinations_pruned = 0
+        self.last_poll = {}
+
+    # Following the files ----------------------------------------------------
+
+    def _files(self):
+        """[(mtime, path, (dev, inode), size)] oldest first"""
+        files = []
+        for path in glob.glob(f'{glob.escape(self.log_file)}*'):
+            if path.endswith(COMPRESSED):
+                continue
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            files.append((st.st_mtime, path, (st.st_dev, st.st_ino), st.st_size))
+        files.sort()
+        return files
+
+    def poll(self):
+        """Read whatever was appended since the last poll; returns what this poll did"""
+        with self._lock:
+            started = time.perf_counter()
+            files = self._files()
+            if self._offsets is None:
+                # First run without a checkpoint: count the live log only, not the whole history
+                self._offsets = {key: size for _, _, key, size in files[:-1]}
+            budget = self.max_bytes_per_poll
+            lines = self.lines
+            for _, path, key, size in files:
+                offset = self._offsets.get(key, 0)
+                if size < offset:
+                    offset = 0  # truncated in place
+                if size > offset and budget > 0:
+                    offset, budget = self._read(path, offset, budget)
+                self._offsets[key] = offset
+            present = {key for _, _, key, _ in files}
+            for key in list(self._offsets):
+                if key not in present:
+                    del self._offsets[key]
+            elapsed = time.perf_counter() - started
+            self.last_poll = {
+                'ts': time.time(), 'lines': self.lines - lines, 'elapsed_ms': round(elapsed * 1000, 1),
+                'lines_per_sec': round((self.lines - lines) / elapsed) if elapsed > 0 else None,
+                'behind': budget <= 0
+            }
+            if self.state_file and time.time() - self._checkpointed >= self.checkpoint_interval:
+                self._save()
+            return dict(self.last_poll)
+
+    def _read(self, path, offset, budget):
+        try:
+            f = open(path, 'rb')
+        except OSError:
+            return offset, budget
+        with f:
+            f.seek(offset)
+            pending = b''
+            while budget > 0:
+                chunk = f.read(min(self.chunk_size, budget))
+                if not chunk:
+                    break
+                budget -= len(chunk)
+                data = pending + chunk
+                end = data.rfind(b'\n') + 1
+                if end:
+                    self._consume(data[:end])
+                    offset += end
+                pending = data[end:]
+        return offset, budget
+
+    # Counting ----------------------------------------------------------------
+
+    def _consume(self, data):
+        users, listeners, destinations, codes = self.users, self.listeners, self.destinations, self.codes
+        ignore = self.ignore_users
+        malformed = skipped = 0
+        lines = data.split(b'\n')
+        lines.pop()  # empty: data ends with a newline
+        for line in lines:
+            fields = line.split(b' ', FIELDS - 1)
+            if len(fields) < FIELDS - 1:
+                malformed += 1
+                continue
+            if ignore and fields[USER].startswith(ignore):
+                skipped += 1  # health probes aren't customer traffic
+                continue
+            try:
+                ts = float(fields[TS])
+                sent = int(fields[BYTES_OUT])
+                received = int(fields[BYTES_IN])
+            except ValueError:
+                malformed += 1
+                continue
+            code = fields[ERROR]
+            codes[code] = codes.get(code, 0) + 1
+            failed = code.strip(b'0') != b''
+            host = fields[REMOTE].rpartition(b':')[0]
+            for table, key in ((users, fields[USER]), (listeners, fields[LISTENER]), (destinations, host)):
+                row = table.get(key)
+                if row is None:
+                    row = table[key] = _row()
+                row[REQUESTS] += 1
+                row[OUT] += sent
+                row[IN] += received
+                if failed:
+                    row[ERRORS] += 1
+                if ts > row[LAST_SEEN]:
+                    row[LAST_SEEN] = ts
+        self.lines += len(lines) - malformed - skipped
+        self.malformed += malformed
+        if len(destinations) > self.max_destinations:
+            keep = dict(_top(destinations, self.max_destinations // 2))
+            self.destinations_pruned += len(destinations) - len(keep)
+            self.destinations = keep
+
+    # Reading the counters -----------------------------------------------------
+
+    def user(self, username):
+        """Counters for one user (None if they have no logged requests)"""
+        with self._lock:
+            row = self.users.get(username.encode())
+            return _row_dict(username, row) if row else None
+
+    def summary(self, limit=10, now=None):
+        """Totals, online users, error codes and the top users/listeners/destinations by bytes"""
+        now = now or time.time()
+        with self._lock:
+            active = [row for key, row in self.users.items() if key != b'-']
+            online = sum(1 for row in active if now - row[LAST_SEEN] <= self.online_window)
+            bytes_out = sum(row[OUT] for row in self.listeners.values())
+            bytes_in = sum(row[IN] for row in self.listeners.values())
+            return {
+                'lines': self.lines,
+                'malformed': self.malformed,
+                'requests': sum(row[REQUESTS] for row in self.listeners.values()),
+                'bytes_out': bytes_out,
+                'bytes_in': bytes_in,
+                'users_seen': len(active),
+                'online_users': online,
+                'online_window': self.online_window,
+                'average_bytes_per_user': (bytes_out + bytes_in) // len(active) if active else 0,
+                'errors': {code.decode(errors='replace'): n for code, n in sorted(self.codes.items())},
+                'top_users': [_row_dict(k.decode(errors='replace'), row)
+                              for k, row in _top(self.users, limit + 1) if k != b'-'][:limit],
+                'listeners': [_row_dict(k.decode(errors='replace'), row)
+                              for k, row in sorted(self.listeners.items())],
+                'top_destinations': [_row_dict(k.decode(errors='replace'), row)
+                                     for k, row in _top(self.destinations, limit)],
+                'destinations_tracked': len(self.destinations),
+                'destinations_pruned': self.destinations_pruned,
+                'last_poll': dict(self.last_poll)
+            }
+
+    # Checkpoint ----------------------------------------------------------------
+
+    def _save(self):
+        def encode(table):
+            return {key.decode(errors='replace'): row for key, row in table.items()}
+        state = {
+            'offsets': [[dev, ino, offset] for (dev, ino), offset in (self._offsets or {}).items()],
+            'users': encode(self.users), 'listeners': encode(self.listeners),
+            'destinations': encode(self.destinations), 'codes': encode(self.codes),
+            'lines': self.lines, 'malformed': self.malformed, 'destinations_pruned': self.destinations_pruned
+        }
+        tmp_file = f'{self.state_file}.tmp'
+        try:
+            with open(tmp_file, 'w') as f:
+                json.dump(state, f, separators=(',', ':'))
+            os.replace(tmp_file, self.state_file)
+            self._checkpointed = time.time()
+        except OSError as e:
+            print(f"Proxy log checkpoint error: {e}")
+
+    def _load(self):
+        if not self.state_file:
+            return
+        try:
+            with open(self.state_file, 'r') as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return
+        def decode(table):
+            return {key.encode(): value for key, value in table.items()}
+        self._offsets = {(dev, ino): offset for dev, ino, offset in state.get('offsets', [])}
+        self.users = decode(state.get('users', {}))
+        self.listeners = decode(state.get('listeners', {}))
+        self.destinations = decode(state.get('destinations', {}))
+        self.codes = decode(state.get('codes', {}))
+        self.lines = state.get('lines', 0)
+        self.malformed = state.get('malformed', 0)
+        self.destinations_pruned = state.get('destinations_pruned', 0)
+
+    def flush(self):
+        """Checkpoint now (e.g. on shutdown)"""
+        if self.state_file:
+            with self._lock:
+                self._save()
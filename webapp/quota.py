@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+"""
+Proxy Farm System - User quotas
+Per-user traffic budgets and speed limits, and their consumption as counted
+by 3proxy
+"""
+
+import os
+import struct
+import threading
+
+from proxyconf import Counter, Limits
+
+# 3proxy counter periods
+PERIODS = {'H': 'hourly', 'D': 'daily', 'W': 'weekly', 'M': 'monthly', 'N': 'never reset'}
+EXCEED_ACTIONS = ('cut', 'throttle')
+DEFAULT_THROTTLE_RATE = 128000  # bits per second once a throttled user is over budget
+
+MB = 1024 * 1024  # unit of 3proxy counter limits
+
+# 3proxy's counter file: a header, then one record per counter number
+# (number N at index N - 1), rewritten in place as traffic is counted
+COUNTER_HEADER = struct.Struct('<4s4xq')  # b'3CF\0', updated
+COUNTER_RECORD = struct.Struct('<Qqq')  # bytes, cleared, updated
+
+
+class Quota:
+    """A user's plan: bytes per period, speed caps (bits/s) and new connections per minute"""
+
+    __slots__ = ('username', 'counter', 'bytes_limit', 'period', 'rate_in', 'rate_out', 'conn_rate',
+                 'on_exceed', 'throttle_rate')
+
+    def __init__(self, username, counter=None, bytes_limit=None, period='M', rate_in=None, rate_out=None,
+                 conn_rate=None, on_exceed='cut', throttle_rate=None):
+        self.username = username
+        self.counter = counter  # 3proxy counter number, assigned by the store
+        self.bytes_limit = bytes_limit
+        self.period = period
+        self.rate_in = rate_in
+        self.rate_out = rate_out
+        self.conn_rate = conn_rate
+        self.on_exceed = on_exceed
+        self.throttle_rate = throttle_rate
+
+    @classmethod
+    def from_row(cls, row):
+        return cls(row['username'], row['counter'], row['bytes_limit'], row['period'], row['rate_in'],
+                   row['rate_out'], row['conn_rate'], row['on_exceed'], row['throttle_rate'])
+
+    @classmethod
+    def from_request(cls, username, data):
+        """Quota from API input; raises ValueError on anything invalid"""
+        def positive(name):
+            value = data.get(name)
+            if value in (None, '', 0):
+                return None
+            try:
+                value = int(value)
+            except (TypeError, ValueError):
+                raise ValueError(f'{name} must be a whole number')
+            if value < 0:
+                raise ValueError(f'{name} must not be negative')
+            return value
+
+        quota = cls(username, bytes_limit=positive('bytes_limit'), period=data.get('period') or 'M',
+                    rate_in=positive('rate_in'), rate_out=positive('rate_out'), conn_rate=positive('conn_rate'),
+                    on_exceed=data.get('on_exceed') or 'cut', throttle_rate=positive('throttle_rate'))
+        if quota.period not in PERIODS:
+            raise ValueError(f'period must be one of {", ".join(PERIODS)}')
+        if quota.on_exceed not in EXCEED_ACTIONS:
+            raise ValueError(f'on_exceed must be one of {", ".join(EXCEED_ACTIONS)}')
+        if quota.on_exceed == 'throttle' and quota.throttle_rate is None:
+            quota.throttle_rate = DEFAULT_THROTTLE_RATE
+        return quota
+
+    def values(self):
+        return {name: getattr(self, name) for name in self.__slots__[2:]}
+
+    @property
+    def limit_mb(self):
+        """3proxy counter limit: the budget rounded up to MB, 0 (count only) when 3proxy must not cut"""
+        if not self.bytes_limit or self.on_exceed == 'throttle':
+            return 0
+        return -(-self.bytes_limit // MB)
+
+    def to_dict(self):
+        return {'username': self.username, 'counter': self.counter, **self.values()}
+
+
+class CounterFile:
+    """
+    Reads 3proxy's counter file. It is only re-read when its size or mtime
+    changed, and then only the record range of the counters asked for.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._stamp = None
+        self._range = None
+        self._records = {}  # counter number -> (bytes, cleared, updated)
+        self._lock = threading.Lock()
+
+    def read(self, numbers):
+        """{counter number: (bytes, cleared, updated)} for the numbers present in the file"""
+        numbers = [n for n in numbers if n]
+        if not numbers:
+            return {}
+        wanted = (min(numbers), max(numbers))
+        with self._lock:
+            try:
+                st = os.stat(self.path)
+            except OSError:
+                return {}
+            stamp = (st.st_size, st.st_mtime_ns)
+            if stamp != self._stamp or self._range is None or \
+                    wanted[0] < self._range[0] or wanted[1] > self._range[1]:
+                self._load(wanted)
+                self._stamp = stamp
+            return {n: self._records[n] for n in numbers if n in self._records}
+
+    def _load(self, wanted):
+        first, last = wanted
+        records = {}
+        with open(self.path, 'rb') as f:
+            header = f.read(COUNTER_HEADER.size)
+            if len(header) < COUNTER_HEADER.size or not header.startswith(b'3CF'):
+                raise ValueError(f'{self.path}: not a 3proxy counter file')
+            f.seek(COUNTER_HEADER.size + (first - 1) * COUNTER_RECORD.size)
+            data = f.read((last - first + 1) * COUNTER_RECORD.size)
+        for i, record in enumerate(COUNTER_RECORD.iter_unpack(data[:len(data) - len(data) % COUNTER_RECORD.size])):
+            records[first + i] = record
+        self._records = records
+        self._range = wanted
+
+
+class QuotaBook:
+    """
+    In-memory copy of the quotas table, reloaded when the store's version
+    moves, joined with the counter file for consumption.
+    """
+
+    def __init__(self, store, counter_file):
+        self.store = store
+        self.counters = CounterFile(counter_file)
+        self._quotas = {}
+        self._version = None
+        self._lock = threading.Lock()
+
+    def sync(self):
+        version = self.store.version('quotas')
+        if version == self._version:
+            return
+        with self._lock:
+            self._quotas = {row['username']: Quota.from_row(row) for row in self.store.load_quotas()}
+            self._version = version
+
+    def get(self, username):
+        self.sync()
+        return self._quotas.get(username)
+
+    def all(self):
+        self.sync()
+        return list(self._quotas.values())
+
+    def set(self, quota):
+        """Store a quota (None if the user does not exist)"""
+        counter = self.store.set_quota(quota.username, quota.values())
+        if counter is None:
+            return None
+        quota.counter = counter
+        return quota
+
+    def remove(self, username):
+        return self.store.remove_quota(username)
+
+    def usage(self, quotas=None):
+        """{username: quota + used/remaining bytes} from the counter file"""
+        quotas = self.all() if quotas is None else quotas
+        try:
+            records = self.counters.read([q.counter for q in quotas if q.bytes_limit])
+        except (OSError, ValueError):
+            records = {}
+        result = {}
+        for quota in quotas:
+            entry = quota.to_dict()
+            used, cleared, updated = records.get(quota.counter, (None, None, None))
+            entry['used'] = used
+            entry['counted_since'] = cleared or None
+            entry['counted_at'] = updated or None
+            entry['remaining'] = None if not quota.bytes_limit or used is None else max(0, quota.bytes_limit - used)
+            entry['exceeded'] = bool(quota.bytes_limit and used is not None and used >= quota.bytes_limit)
+            entry['throttled'] = entry['exceeded'] and quota.on_exceed == 'throttle'
+            result[quota.username] = entry
+        return result
+
+    def throttled(self):
+        """Users past their budget whose plan slows them down instead of cutting them off"""
+        return {name for name, entry in self.usage().items() if entry['throttled']}
+
+    def apply(self, users):
+        """Set limits and counters on proxyconf.UserSpec objects; throttled users get their throttle rate"""
+        quotas = {quota.username: quota for quota in self.all()}
+        throttled = self.throttled()
+        for user in users:
+            quota = quotas.get(user.username)
+            if not quota:
+                continue
+            if user.username in throttled:
+                user.limits = Limits(quota.throttle_rate, quota.throttle_rate, quota.conn_rate)
+            else:
+                user.limits = Limits(quota.rate_in, quota.rate_out, quota.conn_rate)
+            if quota.bytes_limit:
+                user.counter = Counter(quota.counter, quota.period, quota.limit_mb)
+        return users
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+"""
+Proxy Farm System - User registry
+Per-process in-memory index of proxy users, kept in step with the store
+"""
+
+import threading
+from itertools import islice
+
+
+class UserRecord:
+    """One proxy user (compact - a registry may hold 100k of these)"""
+
+    __slots__ = ('username', 'type', 'password', 'created_at')
+
+    def __init__(self, username, type, password, created_at):
+        self.username = username
+        self.type = type
+        self.password = password
+        self.created_at = created_at
+
+    def to_dict(self):
+        """API form - long (hashed) passwords are hidden"""
+        return {
+            'username': self.username,
+            'type': self.type,
+            'password': self.password if len(self.password) < 20 else '***'
+        }
+
+
+class UserRegistry:
+    """
+    Users keyed by username. The whole table is read only when the store's
+    `users` version moves (another worker wrote, or a migration ran);
+    writes made through this registry are applied in place.
+    """
+
+    def __init__(self, store):
+        self.store = store
+        self._users = {}  # username -> UserRecord, in creation order
+        self._version = None
+        self._lock = threading.Lock()
+
+    def _load(self):
+        version = self.store.version('users')
+        self._users = {row[0]: UserRecord(*row) for row in self.store.scan_users()}
+        self._version = version
+
+    def sync(self):
+        """Reload if the users table changed since the last load"""
+        with self._lock:
+            if self.store.version('users') != self._version:
+                self._load()
+
+    def get(self, username):
+        self.sync()
+        return self._users.get(username)
+
+    def __contains__(self, username):
+        return self.get(username) is not None
+
+    def __len__(self):
+        self.sync()
+        return len(self._users)
+
+    def records(self, offset=0, limit=None):
+        """Users in creation order (a copy, safe to iterate while others write)"""
+        self.sync()
+        with self._lock:
+            return list(islice(self._users.values(), offset, offset + limit if limit is not None else None))
+
+    def usernames(self):
+        self.sync()
+        return set(self._users)
+
+    # Writes made by this process ------------------------------------------
+
+    def _applied(self, apply, version):
+        """
+        Apply a change we just committed as users version `version` (returned
+        by the store from inside the write). If it is the only write since the
+        last load it is exactly one past ours and the in-memory copy stays
+        valid; otherwise fall back to a reload.
+        """
+        with self._lock:
+            if self._version is not None and version == self._version + 1:
+                apply()
+                self._version = version
+            else:
+                self._load()
+
+    def added(self, users, user_type, created_at, version):
+        def apply():
+            for username, password in users:
+                self._users[username] = UserRecord(username, user_type, password, created_at)
+        self._applied(apply, version)
+
+    def removed(self, username, version):
+        self._applied(lambda: self._users.pop(username, None), version)
+
+    def password_changed(self, username, password, version):
+        def apply():
+            record = self._users.get(username)
+            if record:
+                record.password = password
+        self._applied(apply, version)
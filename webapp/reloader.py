@@ -0,0 +1,254 @@
+#!/usr/bin/env python3
+"""
+Proxy Farm System - 3proxy reloads
+Debounced SIGUSR1 reloads that keep established tunnels, with per-reload metrics
+"""
+
+import fcntl
+import json
+import os
+import signal
+import threading
+import time
+
+import procnet
+from latency import LatencyHistogram
+
+
+class ProxyReloader:
+    """
+    3proxy re-reads its config on SIGUSR1: the listeners are closed and
+    reopened, while client threads - and their tunnels - keep running.
+    Changes are debounced so a burst of edits costs one reload: a reload
+    runs `debounce` seconds after the last request, and never later than
+    `max_delay` after the first. Pending requests live in a file shared by
+    every gunicorn worker, so a burst spread over workers is still one
+    reload: whichever worker finds it due first claims and runs it. A file
+    lock serialises reloads and the history file is shared too.
+
+    Each reload records how long the listeners took to come back and how
+    many established client connections were gone `settle` seconds later
+    (normal client churn over that window counts too).
+    """
+
+    def __init__(self, history_file, process_name='3proxy', fallback=None, debounce=2.0, max_delay=10.0,
+                 settle=1.0, timeout=10.0, keep=200):
+        self.history_file = history_file
+        self.process_name = process_name
+        self.fallback = fallback  # called when we may not signal 3proxy ourselves (e.g. systemctl reload)
+        self.debounce = debounce
+        self.max_delay = max_delay
+        self.settle = settle
+        self.timeout = timeout
+        self.keep = keep
+        self.pending_file = f'{history_file}.pending'  # {'first', 'last', 'reasons'} shared by the workers
+        self._waiting = False  # this worker has asked for a reload it hasn't seen run yet
+        self._cond = threading.Condition()
+        self._thread = None
+        self._pid = None
+        os.makedirs(os.path.dirname(history_file), exist_ok=True)
+
+    # Scheduling -------------------------------------------------------------
+
+    def request(self, reason=None):
+        """Ask for a reload; returns at once with when it will run"""
+        self._start()
+        now = time.time()
+        with self._pending_lock():
+            pending = self._read_pending()
+            if not pending['reasons']:
+                pending['first'] = now
+            pending['reasons'].append(reason or 'change')
+            pending['last'] = now
+            self._write_pending(pending)
+        with self._cond:
+            self._waiting = True
+            self._cond.notify()
+        due = self._due(pending)
+        return {'scheduled': True, 'due_in': round(max(0.0, due - now), 2), 'pending': len(pending['reasons'])}
+
+    def _due(self, pending):
+        return min(pending['last'] + self.debounce, pending['first'] + self.max_delay)
+
+    def _pending_lock(self):
+        return _FileLock(f'{self.pending_file}.lock')
+
+    def _read_pending(self):
+        try:
+            with open(self.pending_file, 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {'first': None, 'last': None, 'reasons': []}
+
+    def _write_pending(self, pending):
+        tmp_file = f'{self.pending_file}.{os.getpid()}.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump(pending, f)
+        os.replace(tmp_file, self.pending_file)
+
+    def _claim(self):
+        """(reasons, None) if the shared reload is due and now ours, (None, due) if not yet, (None, None) if none"""
+        with self._pending_lock():
+            pending = self._read_pending()
+            if not pending['reasons']:
+                return None, None  # nothing asked, or another worker already ran it
+            due = self._due(pending)
+            if time.time() < due:
+                return None, due
+            self._write_pending({'first': None, 'last': None, 'reasons': []})
+            return pending['reasons'], None
+
+    def _start(self):
+        if self._pid == os.getpid() and self._thread and self._thread.is_alive():
+            return
+        self._pid = os.getpid()
+        self._thread = threading.Thread(target=self._loop, name='3proxy-reload', daemon=True)
+        self._thread.start()
+
+    def _loop(self):
+        while True:
+            with self._cond:
+                while not self._waiting:
+                    self._cond.wait()
+                self._waiting = False
+            try:
+                # Wait out the shared debounce; a request from any worker may push it back
+                while True:
+                    reasons, due = self._claim()
+                    if reasons:
+                        self.reload_now(reasons)
+                    if due is None:
+                        break
+                    with self._cond:
+                        self._cond.wait(timeout=max(0.0, due - time.time()))
+            except Exception as e:
+                print(f"3proxy reload error: {e}")
+                time.sleep(1.0)
+
+    # Reloading --------------------------------------------------------------
+
+    def _sockets(self, pid):
+        """({listening port: inode}, {client connections}) owned by pid"""
+        sockets = procnet.process_sockets(pid)
+        return sockets.listeners, sockets.pairs()
+
+    def reload_now(self, reasons=()):
+        """Reload 3proxy immediately and record the result"""
+        with open(f'{self.history_file}.lock', 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            record = self._reload(list(reasons))
+            self._append(record)
+        return record
+
+    def _reload(self, reasons):
+        record = {'ts': time.time(), 'reasons': sorted(set(reasons)), 'requests': len(reasons),
+                  'success': False, 'error': None}
+        pids = procnet.find_pids(self.process_name)
+        if not pids:
+            record['error'] = f'{self.process_name} is not running'
+            return record
+        pid = record['pid'] = pids[0]
+        listeners, established = self._sockets(pid)
+        record['listeners_before'] = sorted(listeners)
+        record['connections_before'] = len(established)
+
+        started = time.perf_counter()
+        try:
+            os.kill(pid, signal.SIGUSR1)
+            record['method'] = 'signal'
+        except PermissionError:
+            if not self.fallback:
+                record['error'] = f'Not allowed to signal {self.process_name} (pid {pid})'
+                return record
+            result = self.fallback()
+            record['method'] = 'fallback'
+            if not result.get('success'):
+                record['error'] = result.get('message')
+                return record
+        except ProcessLookupError:
+            record['error'] = f'{self.process_name} exited before the reload'
+            return record
+
+        # Done once none of the old listening sockets is left and the new set
+        # has stopped growing (3proxy picks up the signal on its next
+        # one-second tick; the config may have added or dropped ports)
+        old_inodes = set(listeners.values())
+        after, previous, changed_at = {}, None, started
+        while time.perf_counter() - started < self.timeout:
+            after, _ = self._sockets(pid)
+            if after != previous:
+                changed_at = time.perf_counter()
+            elif after and not old_inodes & set(after.values()):
+                break
+            previous = after
+            time.sleep(0.02)
+        else:
+            record['error'] = 'Listeners did not come back'
+        record['duration_ms'] = round((changed_at - started) * 1000, 1)
+        record['listeners_after'] = sorted(after)
+
+        time.sleep(self.settle)
+        _, established_after = self._sockets(pid)
+        record['connections_lost'] = len(established - established_after)
+        record['process_alive'] = pid in procnet.find_pids(self.process_name)
+        record['success'] = record['error'] is None and record['process_alive']
+        if not record['process_alive']:
+            record['error'] = f'{self.process_name} exited during the reload'
+        return record
+
+    # History ----------------------------------------------------------------
+
+    def _read(self):
+        try:
+            with open(self.history_file, 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return []
+
+    def _append(self, record):
+        history = (self._read() + [record])[-self.keep:]
+        tmp_file = f'{self.history_file}.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump(history, f)
+        os.replace(tmp_file, self.history_file)
+
+    def history(self, limit=20):
+        return self._read()[-limit:][::-1]
+
+    def summary(self):
+        """Reload count, failures, duration histogram and connections lost"""
+        history = self._read()
+        durations = LatencyHistogram()
+        for record in history:
+            if record.get('success'):
+                durations.add(record['duration_ms'])
+        pending = len(self._read_pending()['reasons'])
+        return {
+            'reloads': len(history),
+            'failures': sum(1 for r in history if not r.get('success')),
+            'requests_merged': sum(r.get('requests', 0) for r in history),
+            'connections_before': sum(r.get('connections_before', 0) for r in history),
+            'connections_lost': sum(r.get('connections_lost', 0) for r in history),
+            'duration': durations.to_dict(),
+            'pending': pending,
+            'last': history[-1] if history else None
+        }
+
+
+class _FileLock:
+    """Exclusive flock on a lock file for the duration of a with-block"""
+
+    __slots__ = ('path', '_file')
+
+    def __init__(self, path):
+        self.path = path
+        self._file = None
+
+    def __enter__(self):
+        self._file = open(self.path, 'w')
+        fcntl.flock(self._file, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._file.close()  # releases the lock
+        self._file = None
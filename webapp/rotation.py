@@ -0,0 +1,283 @@
+#!/usr/bin/env python3
+"""
+Proxy Farm System - IP rotation orchestrator
+Rotates many modems concurrently as background jobs, keeping capacity online
+"""
+
+import json
+import math
+import os
+import secrets
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+DRAIN_MODES = (None, 'drain', 'migrate')
+ACTIVE_STATES = ('draining', 'rotating', 'restoring')
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class RotationOrchestrator:
+    """
+    Each job rotates its modems through a shared thread pool. A modem only
+    starts when the job is below `max_offline` and taking it offline still
+    leaves `min_online_pct` of the active modems online, counting modems that
+    other jobs (in any worker) are rotating. Job state is written to one JSON
+    file per job so every gunicorn worker can report progress.
+    """
+
+    def __init__(self, jobs_dir, rotate, capacity, drain=None, restore=None, max_workers=16, keep_jobs=50):
+        self.jobs_dir = jobs_dir
+        self.rotate = rotate  # rotate(dcom_id, **options) -> result dict
+        self.capacity = capacity  # capacity() -> (set of online dcom ids, number of active modems)
+        self.drain = drain  # drain(dcom_id, exclude) -> [(username, moved_to)]
+        self.restore = restore  # restore(dcom_id, moved)
+        self.keep_jobs = keep_jobs
+        self.max_workers = max_workers
+        self._executor = None
+        self._pid = None
+        self._jobs = {}  # job id -> job dict (jobs run by this process)
+        self._lock = threading.RLock()
+        os.makedirs(jobs_dir, exist_ok=True)
+
+    def _pool(self):
+        # The pool must be created after the gunicorn fork
+        if self._pid != os.getpid():
+            self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='rotate')
+            self._pid = os.getpid()
+        return self._executor
+
+    # Jobs ----------------------------------------------------------------
+
+    def submit(self, dcom_ids, max_offline=4, min_online_pct=75, drain=None, options=None):
+        """Queue a rotation job and return its initial state"""
+        dcom_ids = list(dict.fromkeys(dcom_ids))
+        if not dcom_ids:
+            raise ValueError('No DCOM devices to rotate')
+        if drain not in DRAIN_MODES:
+            raise ValueError('drain must be one of: drain, migrate')
+        max_offline = max(1, int(max_offline))
+        min_online_pct = min(100.0, max(0.0, float(min_online_pct)))
+        online, total = self.capacity()
+        if total - 1 < math.ceil(total * min_online_pct / 100):
+            raise ValueError(f'Keeping {min_online_pct:g}% of {total} modems online leaves no room to rotate')
+
+        job = {
+            'id': f"{time.strftime('%Y%m%d%H%M%S')}-{secrets.token_hex(3)}",
+            'status': 'queued',
+            'created_at': time.time(),
+            'started_at': None,
+            'finished_at': None,
+            'pid': os.getpid(),
+            'max_offline': max_offline,
+            'min_online_pct': min_online_pct,
+            'drain': drain,
+            'options': options or {},
+            'waiting_for_capacity': False,
+            'modems': {dcom_id: {'state': 'queued'} for dcom_id in dcom_ids}
+        }
+        self._update_progress(job)
+        with self._lock:
+            self._jobs[job['id']] = job
+        self._save(job)
+        self._prune()
+        threading.Thread(target=self._run, args=(job,), name=f"rotation-{job['id']}", daemon=True).start()
+        return self._copy(job)
+
+    def get(self, job_id):
+        """Job state (from memory if this worker runs it, else from its file)"""
+        with self._lock:
+            if job_id in self._jobs:
+                return self._copy(self._jobs[job_id])
+        return self._load(job_id)
+
+    def list(self):
+        jobs = []
+        for filename in sorted(os.listdir(self.jobs_dir), reverse=True):
+            if filename.endswith('.json'):
+                job = self.get(filename[:-5])
+                if job:
+                    jobs.append({k: v for k, v in job.items() if k != 'modems'})
+        return jobs
+
+    def cancel(self, job_id):
+        """Stop starting new modems; modems already offline finish their rotation"""
+        job = self.get(job_id)
+        if job is None or job['status'] in ('done', 'failed', 'cancelled'):
+            return False
+        open(self._path(job_id) + '.cancel', 'w').close()  # seen by whichever worker runs it
+        return True
+
+    # Runner --------------------------------------------------------------
+
+    def _run(self, job):
+        pool = self._pool()
+        pending = deque(job['modems'])
+        inflight = {}  # future -> dcom_id
+        self._set(job, status='running', started_at=time.time())
+
+        while pending or inflight:
+            if pending and os.path.exists(self._path(job['id']) + '.cancel'):
+                for dcom_id in pending:
+                    self._set_modem(job, dcom_id, state='cancelled')
+                pending.clear()
+                job['status'] = 'cancelling'
+
+            blocked = False
+            while pending:
+                if len(inflight) >= job['max_offline'] or not self._may_go_offline(job):
+                    blocked = True
+                    break
+                dcom_id = pending.popleft()
+                self._set_modem(job, dcom_id, state='draining' if job['drain'] else 'rotating', started_at=time.time())
+                inflight[pool.submit(self._rotate_one, job, dcom_id, set(pending))] = dcom_id
+            if job['waiting_for_capacity'] != (blocked and not inflight):
+                self._set(job, waiting_for_capacity=blocked and not inflight)
+
+            if inflight:
+                done, _ = wait(inflight, timeout=1.0, return_when=FIRST_COMPLETED)
+                for future in done:
+                    inflight.pop(future)
+            else:
+                time.sleep(1.0)  # blocked on farm capacity - check again shortly
+
+        modems = job['modems'].values()
+        if job['status'] == 'cancelling':
+            status = 'cancelled'
+        elif all(m['state'] == 'failed' for m in modems):
+            status = 'failed'
+        else:
+            status = 'done'
+        self._set(job, status=status, finished_at=time.time(), waiting_for_capacity=False)
+        try:
+            os.unlink(self._path(job['id']) + '.cancel')
+        except OSError:
+            pass
+
+    def _rotate_one(self, job, dcom_id, not_yet_rotated):
+        moved = []
+        try:
+            if job['drain'] and self.drain:
+                # Don't move users onto a modem that is about to go offline too
+                with self._lock:
+                    busy = {d for d, m in job['modems'].items() if m['state'] in ACTIVE_STATES}
+                exclude = not_yet_rotated | busy | self._offline_elsewhere(job) | {dcom_id}
+                moved = self.drain(dcom_id, exclude)
+                self._set_modem(job, dcom_id, state='rotating', drained_users=len(moved))
+
+            result = self.rotate(dcom_id, **job['options'])
+
+            if job['drain'] == 'drain' and moved and self.restore:
+                self._set_modem(job, dcom_id, state='restoring')
+                self.restore(dcom_id, moved)
+            self._set_modem(
+                job, dcom_id,
+                state='done' if result.get('success') else 'failed',
+                old_ip=result.get('old_ip'),
+                new_ip=result.get('new_ip'),
+                fresh=result.get('fresh'),
+                attempts=len(result.get('attempts', [])),
+                error=None if result.get('success') else result.get('message'),
+                finished_at=time.time()
+            )
+        except Exception as e:
+            if job['drain'] == 'drain' and moved and self.restore:
+                try:
+                    self.restore(dcom_id, moved)
+                except Exception:
+                    pass
+            self._set_modem(job, dcom_id, state='failed', error=str(e), finished_at=time.time())
+
+    def _may_go_offline(self, job):
+        """Would one more modem offline still leave min_online_pct of the farm online?"""
+        online, total = self.capacity()
+        online = set(online) - self._offline_elsewhere(job) - {
+            dcom_id for dcom_id, m in job['modems'].items() if m['state'] in ACTIVE_STATES
+        }
+        return len(online) - 1 >= math.ceil(total * job['min_online_pct'] / 100)
+
+    def _offline_elsewhere(self, job):
+        """Modems that other live jobs currently have offline"""
+        offline = set()
+        for filename in os.listdir(self.jobs_dir):
+            if not filename.endswith('.json') or filename[:-5] == job['id']:
+                continue
+            other = self.get(filename[:-5])
+            if other and other['status'] in ('running', 'cancelling') and _pid_alive(other['pid']):
+                offline.update(d for d, m in other['modems'].items() if m['state'] in ACTIVE_STATES)
+        return offline
+
+    # State ---------------------------------------------------------------
+
+    def _update_progress(self, job):
+        counts = {}
+        for modem in job['modems'].values():
+            counts[modem['state']] = counts.get(modem['state'], 0) + 1
+        total = len(job['modems'])
+        finished = counts.get('done', 0) + counts.get('failed', 0) + counts.get('cancelled', 0)
+        job['progress'] = {
+            'total': total,
+            'finished': finished,
+            'percent': round(finished / total * 100, 1),
+            'states': counts
+        }
+
+    def _set(self, job, **fields):
+        with self._lock:
+            job.update(fields)
+            self._update_progress(job)
+        self._save(job)
+
+    def _set_modem(self, job, dcom_id, **fields):
+        with self._lock:
+            job['modems'][dcom_id].update(fields)
+            self._update_progress(job)
+        self._save(job)
+
+    def _copy(self, job):
+        with self._lock:
+            return json.loads(json.dumps(job))
+
+    def _path(self, job_id):
+        return f'{self.jobs_dir}/{os.path.basename(job_id)}.json'
+
+    def _save(self, job):
+        data = self._copy(job)
+        data['updated_at'] = time.time()
+        tmp_file = f"{self._path(job['id'])}.{threading.get_ident()}.tmp"
+        with open(tmp_file, 'w') as f:
+            json.dump(data, f, indent=2)
+        os.replace(tmp_file, self._path(job['id']))
+
+    def _load(self, job_id):
+        try:
+            with open(self._path(job_id), 'r') as f:
+                job = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if job['status'] in ('queued', 'running', 'cancelling') and not _pid_alive(job['pid']):
+            job['status'] = 'abandoned'  # the worker running it died
+        return job
+
+    def _prune(self):
+        """Keep only the newest `keep_jobs` finished job files"""
+        names = sorted((f for f in os.listdir(self.jobs_dir) if f.endswith('.json')), reverse=True)
+        for filename in names[self.keep_jobs:]:
+            job = self._load(filename[:-5])
+            if job and job['status'] not in ('queued', 'running', 'cancelling'):
+                try:
+                    os.unlink(f'{self.jobs_dir}/{filename}')
+                except OSError:
+                    pass
+                with self._lock:
+                    self._jobs.pop(filename[:-5], None)
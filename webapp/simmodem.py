@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+"""
+Proxy Farm System - Simulated HiLink modems
+Serves enough of the HiLink API to exercise polling and IP rotation offline
+
+    python3 simmodem.py --count 8 --devices-file /tmp/sim-devices.json
+    DCOM_DEVICES_FILE=/tmp/sim-devices.json EGRESS_PROBE_HOST=127.0.0.1 \\
+        EGRESS_PROBE_PORT=18000 python3 app.py
+"""
+
+import argparse
+import http.server
+import json
+import random
+import threading
+import time
+
+CARRIERS = (
+    ('Lebara FR', 'lebara', 'fr.lebara.mobi'),
+    ('Free Mobile', 'free', 'free'),
+    ('Orange F', 'orange', 'orange.fr')
+)
+
+
+class SimModem:
+    """State of one simulated stick; reconnects draw a new IP from a small CGNAT-like pool"""
+
+    def __init__(self, index, carrier=None, pool_size=32, disconnect_delay=(0.2, 1.0), reattach_delay=(2.0, 8.0)):
+        self.index = index
+        self.carrier = carrier or CARRIERS[index % len(CARRIERS)]
+        self.pool = [f'{81 + index % 100}.{index // 100}.{i // 250}.{i % 250 + 1}' for i in range(pool_size)]
+        self.disconnect_delay = disconnect_delay
+        self.reattach_delay = reattach_delay
+        self.conn_status = '901'
+        self.wan_ip = random.choice(self.pool)
+        self.connected_since = time.time()
+        self.download = 0
+        self.upload = 0
+        self._lock = threading.Lock()
+
+    def set_data_switch(self, enabled):
+        with self._lock:
+            if enabled:
+                self.conn_status = '905'
+                delay, status = random.uniform(*self.reattach_delay), '901'
+            else:
+                self.conn_status = '903'
+                delay, status = random.uniform(*self.disconnect_delay), '902'
+        threading.Timer(delay, self._settle, args=(status,)).start()
+
+    def _settle(self, status):
+        with self._lock:
+            if status == '901' and self.conn_status == '905':
+                self.wan_ip = random.choice(self.pool)
+                self.connected_since = time.time()
+                self.conn_status = status
+            elif status == '902' and self.conn_status == '903':
+                self.conn_status = status
+
+    def status_xml(self):
+        wan_ip = self.wan_ip if self.conn_status == '901' else ''
+        return (f'<response><ConnectionStatus>{self.conn_status}</ConnectionStatus>'
+                f'<WanIPAddress>{wan_ip}</WanIPAddress><CurrentNetworkType>19</CurrentNetworkType>'
+                f'<SignalIcon>{random.randint(2, 5)}</SignalIcon></response>')
+
+    def traffic_xml(self):
+        connected = self.conn_status == '901'
+        down_rate = random.randint(50_000, 2_000_000) if connected else 0
+        up_rate = down_rate // 8
+        self.download += down_rate
+        self.upload += up_rate
+        connect_time = int(time.time() - self.connected_since) if connected else 0
+        return (f'<response><CurrentConnectTime>{connect_time}</CurrentConnectTime>'
+                f'<CurrentDownload>{self.download}</CurrentDownload><CurrentUpload>{self.upload}</CurrentUpload>'
+                f'<CurrentDownloadRate>{down_rate}</CurrentDownloadRate><CurrentUploadRate>{up_rate}</CurrentUploadRate>'
+                f'<TotalDownload>{self.download}</TotalDownload><TotalUpload>{self.upload}</TotalUpload>'
+                f'<TotalConnectTime>{connect_time}</TotalConnectTime></response>')
+
+    def handler(self):
+        modem = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def _send(self, body):
+                data = f'<?xml version="1.0" encoding="UTF-8"?>{body}'.encode()
+                # One write - avoids Nagle/delayed-ACK stalls on keep-alive clients
+                self.wfile.write(b'HTTP/1.1 200 OK\r\nContent-Type: text/xml\r\n'
+                                 b'Content-Length: %d\r\n\r\n' % len(data) + data)
+
+            def do_GET(self):
+                name, short, apn = modem.carrier
+                replies = {
+                    '/api/webserver/SesTokInfo':
+                        '<response><SesInfo>SessionID=sim</SesInfo><TokInfo>simtoken</TokInfo></response>',
+                    '/api/monitoring/status': modem.status_xml(),
+                    '/api/device/signal':
+                        f'<response><rssi>{random.randint(-90, -55)}dBm</rssi><rsrp>{random.randint(-115, -80)}dBm'
+                        f'</rsrp><sinr>{random.randint(-2, 20)}dB</sinr></response>',
+                    '/api/monitoring/traffic-statistics': modem.traffic_xml(),
+                    '/api/net/current-plmn':
+                        f'<response><FullName>{name}</FullName><ShortName>{short}</ShortName>'
+                        f'<Numeric>208{modem.index % 30:02d}</Numeric></response>',
+                    '/api/dialup/profiles':
+                        f'<response><CurrentProfile>1</CurrentProfile><Profiles><Profile><Index>1</Index>'
+                        f'<Name>{short}</Name><ApnName>{apn}</ApnName><Username></Username></Profile>'
+                        f'</Profiles></response>'
+                }
+                self._send(replies.get(self.path, '<error><code>100002</code><message></message></error>'))
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0))).decode(errors='replace')
+                if self.path == '/api/dialup/mobile-dataswitch':
+                    modem.set_data_switch('<dataswitch>1</dataswitch>' in body)
+                    return self._send('<response>OK</response>')
+                self._send('<error><code>100002</code><message></message></error>')
+
+        return Handler
+
+
+def serve(count=4, host='127.0.0.1', port=18000, **modem_options):
+    """Start `count` simulated modems on consecutive ports; returns [(modem, server)]"""
+    running = []
+    for i in range(count):
+        modem = SimModem(i + 1, **modem_options)
+        server = http.server.ThreadingHTTPServer((host, port + i if port else 0), modem.handler())
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, name=f'simmodem-{i + 1}', daemon=True).start()
+        running.append((modem, server))
+    return running
+
+
+def device_list(running):
+    """Device entries in the DCOM_DEVICES_FILE format"""
+    return [{
+        'id': f'dcom{modem.index}',
+        'name': f'Simulated DCOM {modem.index} ({modem.carrier[0]})',
+        'ip': '%s:%d' % server.server_address[:2],
+        'interface': None
+    } for modem, server in running]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Simulated HiLink modems for offline testing')
+    parser.add_argument('--count', type=int, default=4)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=18000, help='first port (one per modem)')
+    parser.add_argument('--reattach', type=float, nargs=2, default=(2.0, 8.0), metavar=('MIN', 'MAX'),
+                        help='seconds from data switch on to 901')
+    parser.add_argument('--devices-file', help='write the device list here for DCOM_DEVICES_FILE')
+    args = parser.parse_args()
+
+    running = serve(args.count, args.host, args.port, reattach_delay=tuple(args.reattach))
+    devices = device_list(running)
+    if args.devices_file:
+        with open(args.devices_file, 'w') as f:
+            json.dump(devices, f, indent=2)
+    for device in devices:
+        print(f"{device['id']}: http://{device['ip']}/")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,436 @@
+#!/usr/bin/env python3
+"""
+Proxy Farm System - State store
+SQLite (WAL) source of truth for users, quotas, ports, DCOM assignments, egress and rotation timings
+"""
+
+import json
+import os
+import secrets
+import sqlite3
+import threading
+import time
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    username   TEXT PRIMARY KEY,
+    type       TEXT NOT NULL DEFAULT 'CL',
+    password   TEXT NOT NULL,
+    created_at REAL NOT NULL
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS assignments (
+    username    TEXT PRIMARY KEY,
+    dcom_id     TEXT NOT NULL,
+    assigned_at REAL NOT NULL
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS assignments_dcom ON assignments (dcom_id, username);
+
+CREATE TABLE IF NOT EXISTS ip_history (
+    id             INTEGER PRIMARY KEY,
+    dcom_id        TEXT NOT NULL,
+    ts             REAL NOT NULL,
+    old_ip         TEXT,
+    new_ip         TEXT,
+    affected_users TEXT NOT NULL DEFAULT '[]'
+);
+CREATE INDEX IF NOT EXISTS ip_history_dcom_ts ON ip_history (dcom_id, ts);
+CREATE INDEX IF NOT EXISTS ip_history_ts ON ip_history (ts);
+
+CREATE TABLE IF NOT EXISTS rotation_timings (
+    id           INTEGER PRIMARY KEY,
+    ts           REAL NOT NULL,
+    dcom_id      TEXT NOT NULL,
+    carrier      TEXT,
+    apn          TEXT,
+    failed_phase TEXT,
+    disconnect   REAL,
+    reattach     REAL,
+    route_ready  REAL,
+    first_egress REAL,
+    ip_confirmed REAL,
+    total        REAL
+);
+CREATE INDEX IF NOT EXISTS rotation_timings_ts ON rotation_timings (ts);
+
+CREATE TABLE IF NOT EXISTS quotas (
+    username      TEXT PRIMARY KEY,
+    counter       INTEGER NOT NULL UNIQUE,
+    bytes_limit   INTEGER,
+    period        TEXT NOT NULL DEFAULT 'M',
+    rate_in       INTEGER,
+    rate_out      INTEGER,
+    conn_rate     INTEGER,
+    on_exceed     TEXT NOT NULL DEFAULT 'cut',
+    throttle_rate INTEGER,
+    updated_at    REAL NOT NULL
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS port_assignments (
+    username    TEXT NOT NULL,
+    port_type   TEXT NOT NULL,
+    dedicated   INTEGER NOT NULL,
+    port        INTEGER NOT NULL,
+    assigned_at REAL NOT NULL,
+    released_at REAL,
+    PRIMARY KEY (username, port_type, dedicated)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS egress (
+    dcom_id    TEXT PRIMARY KEY,
+    address    TEXT NOT NULL,
+    updated_at REAL NOT NULL
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS meta (
+    key   TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+) WITHOUT ROWID;
+"""
+
+
+class Store:
+    """
+    Thin data-access layer. Connections are per thread and per process (they
+    must not cross the gunicorn fork); WAL lets every worker read while one
+    writes. Each write bumps a version counter so workers can tell when their
+    in-memory copies are out of date.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.connection().executescript(SCHEMA)
+
+    def connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None, check_same_thread=False)
+            conn.row_factory = sqlite3.Row
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute('PRAGMA busy_timeout=10000')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def transaction(self):
+        return _Transaction(self.connection())
+
+    # Versions -------------------------------------------------------------
+
+    def version(self, name):
+        row = self.connection().execute('SELECT value FROM meta WHERE key = ?', (f'version:{name}',)).fetchone()
+        return int(row['value']) if row else 0
+
+    def secret(self, name):
+        """Random per-install secret, created on first use and the same for every process"""
+        row = self.connection().execute('SELECT value FROM meta WHERE key = ?', (f'secret:{name}',)).fetchone()
+        if row:
+            return row['value']
+        with self.transaction() as db:
+            db.execute('INSERT OR IGNORE INTO meta (key, value) VALUES (?, ?)', (f'secret:{name}', secrets.token_hex(16)))
+            return db.execute('SELECT value FROM meta WHERE key = ?', (f'secret:{name}',)).fetchone()[0]
+
+    def _bump(self, db, name):
+        """Advance a version inside the write's transaction and return the new value"""
+        row = db.execute(
+            "INSERT INTO meta (key, value) VALUES (?, '1') "
+            "ON CONFLICT(key) DO UPDATE SET value = CAST(value AS INTEGER) + 1 RETURNING value",
+            (f'version:{name}',)
+        ).fetchone()
+        return int(row[0])
+
+    # Users ----------------------------------------------------------------
+
+    def get_user(self, username):
+        row = self.connection().execute(
+            'SELECT username, type, password FROM users WHERE username = ?', (username,)
+        ).fetchone()
+        return dict(row) if row else None
+
+    def list_users(self):
+        rows = self.connection().execute('SELECT username, type, password FROM users ORDER BY created_at, username')
+        return [dict(row) for row in rows]
+
+    def scan_users(self):
+        """(username, type, password, created_at) tuples in creation order, without per-row dicts"""
+        cursor = self.connection().cursor()
+        cursor.row_factory = None
+        return cursor.execute('SELECT username, type, password, created_at FROM users ORDER BY created_at, username')
+
+    def count_users(self):
+        return self.connection().execute('SELECT COUNT(*) FROM users').fetchone()[0]
+
+    def add_users(self, users, user_type='CL'):
+        """
+        Insert [(username, password)]; fails as a whole if any username exists.
+        Returns (created_at, users version written).
+        """
+        now = time.time()
+        with self.transaction() as db:
+            db.executemany(
+                'INSERT INTO users (username, type, password, created_at) VALUES (?, ?, ?, ?)',
+                [(username, user_type, password, now) for username, password in users]
+            )
+            version = self._bump(db, 'users')
+        return now, version
+
+    def remove_user(self, username):
+        """Delete a user and everything keyed by them; the users version written, None if there was no such user"""
+        with self.transaction() as db:
+            removed = db.execute('DELETE FROM users WHERE username = ?', (username,)).rowcount
+            version = self._bump(db, 'users') if removed else None
+            # Only tables that lost rows get a new version (and their caches a reload)
+            for table, name in (('assignments', 'assignments'), ('quotas', 'quotas'), ('port_assignments', 'ports')):
+                if db.execute(f'DELETE FROM {table} WHERE username = ?', (username,)).rowcount:
+                    self._bump(db, name)
+        return version
+
+    def set_password(self, username, password):
+        """The users version written, None if there was no such user"""
+        with self.transaction() as db:
+            updated = db.execute('UPDATE users SET password = ? WHERE username = ?', (password, username)).rowcount
+            return self._bump(db, 'users') if updated else None
+
+    def export_users_conf(self, path):
+        """Regenerate users.conf (username:TYPE:password) atomically"""
+        tmp_file = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'  # every worker exports
+        rows = self.connection().execute('SELECT username, type, password FROM users ORDER BY created_at, username')
+        with open(tmp_file, 'w') as f:
+            for row in rows:
+                f.write(f"{row['username']}:{row['type']}:{row['password']}\n")
+        os.chmod(tmp_file, 0o600)
+        os.replace(tmp_file, path)
+
+    # Quotas ---------------------------------------------------------------
+
+    def load_quotas(self):
+        return [dict(row) for row in self.connection().execute('SELECT * FROM quotas ORDER BY counter')]
+
+    def set_quota(self, username, values):
+        """
+        Upsert a user's quota. A new quota gets the next free 3proxy counter
+        number; an existing one keeps its number so 3proxy's count carries on.
+        """
+        columns = ('bytes_limit', 'period', 'rate_in', 'rate_out', 'conn_rate', 'on_exceed', 'throttle_rate')
+        with self.transaction() as db:
+            if not db.execute('SELECT 1 FROM users WHERE username = ?', (username,)).fetchone():
+                return None
+            row = db.execute('SELECT counter FROM quotas WHERE username = ?', (username,)).fetchone()
+            if row:
+                counter = row['counter']
+            else:
+                # Never reused: 3proxy keeps a removed counter's bytes in its file
+                self._bump(db, 'quota_counter')
+                counter = int(db.execute("SELECT value FROM meta WHERE key = 'version:quota_counter'").fetchone()[0])
+            db.execute(
+                f"INSERT OR REPLACE INTO quotas (username, counter, {', '.join(columns)}, updated_at) "
+                f"VALUES (?, ?, {', '.join('?' for _ in columns)}, ?)",
+                (username, counter, *(values[c] for c in columns), time.time())
+            )
+            self._bump(db, 'quotas')
+        return counter
+
+    def remove_quota(self, username):
+        with self.transaction() as db:
+            removed = db.execute('DELETE FROM quotas WHERE username = ?', (username,)).rowcount
+            self._bump(db, 'quotas')
+        return removed > 0
+
+    # Ports ----------------------------------------------------------------
+
+    def scan_port_assignments(self):
+        """(username, port_type, dedicated, port, released_at) tuples; released rows remember a user's last port"""
+        cursor = self.connection().cursor()
+        cursor.row_factory = None
+        return cursor.execute('SELECT username, port_type, dedicated, port, released_at FROM port_assignments')
+
+    def write_ports(self, assign=(), release=(), expected_version=None):
+        """
+        Apply port changes - assign [(username, port_type, dedicated, port)],
+        release [(username, port_type, dedicated)] - in one transaction.
+        With `expected_version`, nothing is written (and None returned) if
+        another writer got in first; otherwise returns the new version.
+        """
+        now = time.time()
+        with self.transaction() as db:
+            if expected_version is not None and self.version('ports') != expected_version:
+                return None
+            db.executemany(
+                'INSERT INTO port_assignments (username, port_type, dedicated, port, assigned_at) '
+                'VALUES (?, ?, ?, ?, ?) ON CONFLICT(username, port_type, dedicated) DO UPDATE SET '
+                'port = excluded.port, assigned_at = excluded.assigned_at, released_at = NULL',
+                [(username, port_type, int(dedicated), port, now) for username, port_type, dedicated, port in assign]
+            )
+            db.executemany(
+                'UPDATE port_assignments SET released_at = ? '
+                'WHERE username = ? AND port_type = ? AND dedicated = ? AND released_at IS NULL',
+                [(now, username, port_type, int(dedicated)) for username, port_type, dedicated in release]
+            )
+            self._bump(db, 'ports')
+            return self.version('ports')
+
+    # Assignments ----------------------------------------------------------
+
+    def get_assignment(self, username):
+        row = self.connection().execute('SELECT dcom_id FROM assignments WHERE username = ?', (username,)).fetchone()
+        return row['dcom_id'] if row else None
+
+    def load_assignments(self):
+        """(user -> dcom, dcom -> [users]) in assignment order"""
+        user_assignments = {}
+        dcom_assignments = {}
+        rows = self.connection().execute('SELECT username, dcom_id FROM assignments ORDER BY assigned_at, username')
+        for row in rows:
+            user_assignments[row['username']] = row['dcom_id']
+            dcom_assignments.setdefault(row['dcom_id'], []).append(row['username'])
+        return user_assignments, dcom_assignments
+
+    def assign_many(self, pairs):
+        """Upsert [(username, dcom_id)] in one transaction"""
+        now = time.time()
+        with self.transaction() as db:
+            db.executemany(
+                'INSERT INTO assignments (username, dcom_id, assigned_at) VALUES (?, ?, ?) '
+                'ON CONFLICT(username) DO UPDATE SET dcom_id = excluded.dcom_id, assigned_at = excluded.assigned_at '
+                'WHERE dcom_id != excluded.dcom_id',
+                [(username, dcom_id, now) for username, dcom_id in pairs]
+            )
+            self._bump(db, 'assignments')
+
+    def unassign(self, username):
+        with self.transaction() as db:
+            removed = db.execute('DELETE FROM assignments WHERE username = ?', (username,)).rowcount
+            self._bump(db, 'assignments')
+        return removed > 0
+
+    def egress_addresses(self):
+        """{dcom_id: local address} of the modems users' traffic is pinned to"""
+        rows = self.connection().execute('SELECT dcom_id, address FROM egress')
+        return {row['dcom_id']: row['address'] for row in rows}
+
+    def set_egress_addresses(self, addresses):
+        """Replace the egress addresses (written by the telemetry leader); True if they changed"""
+        with self.transaction() as db:
+            current = {row['dcom_id']: row['address'] for row in db.execute('SELECT dcom_id, address FROM egress')}
+            if current == addresses:
+                return False
+            db.execute('DELETE FROM egress')
+            db.executemany('INSERT INTO egress (dcom_id, address, updated_at) VALUES (?, ?, ?)',
+                           [(dcom_id, address, time.time()) for dcom_id, address in addresses.items()])
+            self._bump(db, 'egress')
+        return True
+
+    def dcom_user_counts(self):
+        rows = self.connection().execute('SELECT dcom_id, COUNT(*) AS n FROM assignments GROUP BY dcom_id')
+        return {row['dcom_id']: row['n'] for row in rows}
+
+    # IP history -----------------------------------------------------------
+
+    def take_ip_changes(self):
+        """
+        Hand over imported IP history rows [(ts, dcom_id, old_ip, new_ip, users)]
+        and delete them - the history lives in iphistory.IPHistoryLog.
+        """
+        with self.transaction() as db:
+            rows = db.execute(
+                'SELECT ts, dcom_id, old_ip, new_ip, affected_users FROM ip_history ORDER BY ts'
+            ).fetchall()
+            db.execute('DELETE FROM ip_history')
+        return [(row['ts'], row['dcom_id'], row['old_ip'], row['new_ip'], json.loads(row['affected_users']))
+                for row in rows]
+
+    # Rotation timings -----------------------------------------------------
+
+    def add_rotation_timing(self, dcom_id, carrier, apn, timings, ts=None):
+        """One reconnect's phase durations (ms) as produced by latency.PhaseTimer"""
+        with self.transaction() as db:
+            db.execute(
+                'INSERT INTO rotation_timings (ts, dcom_id, carrier, apn, failed_phase, disconnect, reattach, '
+                'route_ready, first_egress, ip_confirmed, total) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (ts or time.time(), dcom_id, carrier, apn, timings.get('failed_phase'), timings.get('disconnect'),
+                 timings.get('reattach'), timings.get('route_ready'), timings.get('first_egress'),
+                 timings.get('ip_confirmed'), timings.get('total'))
+            )
+
+    def rotation_timings(self, since, dcom_id=None):
+        if dcom_id:
+            rows = self.connection().execute(
+                'SELECT * FROM rotation_timings WHERE ts > ? AND dcom_id = ? ORDER BY ts', (since, dcom_id)
+            )
+        else:
+            rows = self.connection().execute('SELECT * FROM rotation_timings WHERE ts > ? ORDER BY ts', (since,))
+        return [dict(row) for row in rows]
+
+    # Migration ------------------------------------------------------------
+
+    def migrate(self, users_file=None, assignments_file=None, ip_history_file=None):
+        """One-shot import of users.conf / user_assignments.json / ip_history.json"""
+        conn = self.connection()
+        if conn.execute("SELECT 1 FROM meta WHERE key = 'migrated'").fetchone():
+            return False
+
+        now = time.time()
+        with self.transaction() as db:
+            # Re-check under the write lock - another worker may have won the race
+            if db.execute("SELECT 1 FROM meta WHERE key = 'migrated'").fetchone():
+                return False
+
+            if users_file and os.path.exists(users_file):
+                users = []
+                with open(users_file, 'r') as f:
+                    for i, line in enumerate(f):
+                        line = line.strip()
+                        if line and not line.startswith('#'):
+                            parts = line.split(':', 2)
+                            if len(parts) == 3:
+                                users.append((parts[0], parts[1], parts[2], now + i * 1e-6))
+                db.executemany(
+                    'INSERT OR IGNORE INTO users (username, type, password, created_at) VALUES (?, ?, ?, ?)', users
+                )
+
+            if assignments_file and os.path.exists(assignments_file):
+                with open(assignments_file, 'r') as f:
+                    data = json.load(f)
+                db.executemany(
+                    'INSERT OR IGNORE INTO assignments (username, dcom_id, assigned_at) VALUES (?, ?, ?)',
+                    [(username, dcom_id, now) for username, dcom_id in data.get('user_assignments', {}).items()]
+                )
+
+            if ip_history_file and os.path.exists(ip_history_file):
+                with open(ip_history_file, 'r') as f:
+                    history = json.load(f)
+                rows = []
+                for dcom_id, changes in history.items():
+                    for change in changes:
+                        ts = time.mktime(time.strptime(change['timestamp'][:19], '%Y-%m-%dT%H:%M:%S'))
+                        rows.append((dcom_id, ts, change.get('old_ip'), change.get('new_ip'),
+                                     json.dumps(change.get('affected_users', []))))
+                db.executemany(
+                    'INSERT INTO ip_history (dcom_id, ts, old_ip, new_ip, affected_users) VALUES (?, ?, ?, ?, ?)', rows
+                )
+
+            db.execute("INSERT INTO meta (key, value) VALUES ('migrated', ?)", (str(now),))
+            self._bump(db, 'users')
+            self._bump(db, 'assignments')
+        return True
+
+
+class _Transaction:
+    """BEGIN IMMEDIATE ... COMMIT/ROLLBACK around a block"""
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __enter__(self):
+        self.conn.execute('BEGIN IMMEDIATE')
+        return self.conn
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.conn.execute('COMMIT')
+        else:
+            self.conn.execute('ROLLBACK')
+        return False
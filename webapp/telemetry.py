@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+"""
+Proxy Farm System - Telemetry collector
+Samples modems and 3proxy in the background and publishes a cached snapshot
+"""
+
+import fcntl
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from types import MappingProxyType
+
+
+class Snapshot:
+    """Immutable view of the latest sample of every source"""
+
+    __slots__ = ('values', 'sampled_at', 'intervals', 'timestamp')
+
+    def __init__(self, values, sampled_at, intervals, timestamp):
+        self.values = MappingProxyType(values)
+        self.sampled_at = MappingProxyType(sampled_at)
+        self.intervals = MappingProxyType(intervals)
+        self.timestamp = timestamp
+
+    def get(self, name, default=None):
+        return self.values.get(name, default)
+
+    def age(self, name):
+        """Seconds since the source was last sampled (None if never)"""
+        sampled = self.sampled_at.get(name)
+        return None if sampled is None else max(0.0, time.time() - sampled)
+
+    def is_stale(self, name=None):
+        """A source is stale once it missed three sampling intervals"""
+        names = [name] if name else list(self.intervals)
+        for source in names:
+            age = self.age(source)
+            if age is None or age > self.intervals.get(source, 0) * 3:
+                return True
+        return False
+
+    def meta(self, name=None):
+        """Timestamp/staleness block for API responses"""
+        if name:
+            return {'sampled_at': self.sampled_at.get(name), 'age': self.age(name), 'stale': self.is_stale(name)}
+        if not self.timestamp:
+            return {'sampled_at': None, 'age': None, 'stale': True}
+        return {
+            'sampled_at': self.timestamp,
+            'age': max(0.0, time.time() - self.timestamp),
+            'stale': self.is_stale()
+        }
+
+    def to_dict(self):
+        return {
+            'values': dict(self.values),
+            'sampled_at': dict(self.sampled_at),
+            'intervals': dict(self.intervals),
+            'timestamp': self.timestamp
+        }
+
+
+class TelemetryCollector:
+    """
+    One collector per host: sources are sampled on their own interval and the
+    result is swapped in as a new Snapshot. When a snapshot file is given the
+    gunicorn workers elect a single leader through a file lock; the others
+    just follow the file.
+    """
+
+    def __init__(self, snapshot_file=None, tick=0.5, max_workers=4):
+        self.snapshot_file = snapshot_file
+        self.tick = tick
+        self.sources = {}  # name -> (func, interval)
+        self._snapshot = Snapshot({}, {}, {}, 0.0)
+        self._publish_lock = threading.Lock()
+        self._running = set()
+        self._due = {}
+        self._pid = None
+        self._thread = None
+        self._stop = threading.Event()
+        self._executor = None
+        self._lock_fd = None
+        self._file_mtime = None
+        self.max_workers = max_workers
+
+    def register(self, name, func, interval):
+        """Add a source sampled every `interval` seconds"""
+        self.sources[name] = (func, interval)
+        self._due[name] = 0.0
+
+    def snapshot(self):
+        return self._snapshot
+
+    def start(self):
+        """Start the loop once per process (safe to call on every request)"""
+        if self._pid == os.getpid() and self._thread and self._thread.is_alive():
+            return
+        self._pid = os.getpid()
+        self._stop.clear()
+        self._running = set()
+        self._lock_fd = None
+        self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='telemetry')
+        self._thread = threading.Thread(target=self._loop, name='telemetry', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._executor:
+            self._executor.shutdown(wait=False)
+        if self._lock_fd is not None:
+            os.close(self._lock_fd)
+            self._lock_fd = None
+
+    def sample_now(self, name):
+        """Force an immediate sample of one source (e.g. right after a change)"""
+        self._due[name] = 0.0
+
+    def _is_leader(self):
+        if not self.snapshot_file:
+            return True
+        if self._lock_fd is not None:
+            return True
+        fd = os.open(f'{self.snapshot_file}.lock', os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            os.close(fd)
+            return False
+        self._lock_fd = fd
+        return True
+
+    def _loop(self):
+        while not self._stop.is_set():
+            try:
+                if self._is_leader():
+                    self._run_due()
+                else:
+                    self._follow()
+            except Exception as e:
+                print(f"Telemetry loop error: {e}")
+            self._stop.wait(self.tick)
+
+    def _run_due(self):
+        now = time.time()
+        for name, (func, interval) in self.sources.items():
+            if name in self._running or now < self._due.get(name, 0.0):
+                continue
+            self._running.add(name)
+            self._due[name] = now + interval
+            self._executor.submit(self._sample, name, func)
+
+    def _sample(self, name, func):
+        try:
+            value = func()
+        except Exception as e:
+            print(f"Telemetry source {name} failed: {e}")
+            return
+        finally:
+            self._running.discard(name)
+        self._publish({name: value}, time.time())
+
+    def _publish(self, values, sampled_at):
+        with self._publish_lock:
+            current = self._snapshot
+            new_values = dict(current.values)
+            new_sampled = dict(current.sampled_at)
+            new_values.update(values)
+            for name in values:
+                new_sampled[name] = sampled_at
+            intervals = {name: interval for name, (_, interval) in self.sources.items()}
+            self._snapshot = Snapshot(new_values, new_sampled, intervals, sampled_at)
+            if self.snapshot_file and self._lock_fd is not None:
+                self._write_file(self._snapshot)
+
+    def _write_file(self, snapshot):
+        tmp_file = f'{self.snapshot_file}.{os.getpid()}.tmp'
+        try:
+            with open(tmp_file, 'w') as f:
+                json.dump(snapshot.to_dict(), f)
+            os.replace(tmp_file, self.snapshot_file)
+        except Exception as e:
+            print(f"Error writing telemetry snapshot: {e}")
+
+    def _follow(self):
+        """Reload the leader's snapshot when the file changes"""
+        try:
+            mtime = os.stat(self.snapshot_file).st_mtime_ns
+        except OSError:
+            return
+        if mtime == self._file_mtime:
+            return
+        with open(self.snapshot_file, 'r') as f:
+            data = json.load(f)
+        self._file_mtime = mtime
+        self._snapshot = Snapshot(data['values'], data['sampled_at'], data['intervals'], data['timestamp'])
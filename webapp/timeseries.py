@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+"""
+Proxy Farm System - Metric history
+Fixed-size, memory-mapped ring buffers per series with 5s/1m/1h/1d rollups
+"""
+
+import mmap
+import os
+import re
+import struct
+import threading
+import time
+
+MAGIC = b'PFTS'
+VERSION = 1
+
+# (bucket seconds, slots): 1h of 5s points, 1 day of minutes, 30 days of hours, 2 years of days
+RESOLUTIONS = ((5, 720), (60, 1440), (3600, 720), (86400, 730))
+
+HEADER = struct.Struct('<4sHH')  # magic, version, number of resolutions
+LEVEL = struct.Struct('<II')  # bucket seconds, slots
+HEADER_SIZE = 64
+
+# Per slot, stored as separate columns: bucket start (u32), count (u32), sum/min/max (f64)
+SLOT_SIZE = 4 + 4 + 8 + 8 + 8
+
+
+def _file_size(resolutions):
+    return HEADER_SIZE + sum(slots * SLOT_SIZE for _, slots in resolutions)
+
+
+def safe_name(name):
+    return re.sub(r'[^A-Za-z0-9_.-]', '_', name)
+
+
+class _Level:
+    """Column views into the mapped file for one resolution"""
+
+    __slots__ = ('step', 'slots', 'ts', 'count', 'sum', 'min', 'max')
+
+    def __init__(self, buf, offset, step, slots):
+        self.step = step
+        self.slots = slots
+        columns = []
+        for code, size in (('I', 4), ('I', 4), ('d', 8), ('d', 8), ('d', 8)):
+            columns.append(buf[offset:offset + slots * size].cast(code))
+            offset += slots * size
+        self.ts, self.count, self.sum, self.min, self.max = columns
+
+    def add(self, ts, value):
+        bucket = ts - ts % self.step
+        slot = bucket // self.step % self.slots
+        if self.ts[slot] != bucket:
+            # Slot still holds a bucket from one full ring ago - recycle it
+            self.ts[slot] = bucket
+            self.count[slot] = 1
+            self.sum[slot] = self.min[slot] = self.max[slot] = value
+        else:
+            self.count[slot] += 1
+            self.sum[slot] += value
+            if value < self.min[slot]:
+                self.min[slot] = value
+            if value > self.max[slot]:
+                self.max[slot] = value
+
+    def covers(self, start, now):
+        return start >= now - self.step * self.slots
+
+    def points(self, start, end):
+        """[(bucket, avg, min, max)] for buckets in [start, end]"""
+        step, slots = self.step, self.slots
+        ts, count, total, low, high = self.ts, self.count, self.sum, self.min, self.max
+        out = []
+        bucket = start - start % step
+        while bucket <= end:
+            slot = bucket // step % slots
+            if ts[slot] == bucket and count[slot]:
+                n = count[slot]
+                out.append((bucket, total[slot] / n, low[slot], high[slot]))
+            bucket += step
+        return out
+
+
+class Series:
+    """One metric: a file of fixed size, so memory per series is bounded"""
+
+    def __init__(self, path, writable=False, resolutions=RESOLUTIONS):
+        self.path = path
+        size = _file_size(resolutions)
+        if writable and (not os.path.exists(path) or os.path.getsize(path) != size):
+            self._create(path, resolutions, size)
+        self._fd = os.open(path, os.O_RDWR if writable else os.O_RDONLY)
+        self._map = mmap.mmap(self._fd, size, access=mmap.ACCESS_WRITE if writable else mmap.ACCESS_READ)
+        magic, version, count = HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC or version != VERSION:
+            self.close()
+            raise ValueError(f'{path}: not a metric series file')
+        self._buf = buf = memoryview(self._map)
+        self.levels = []
+        offset = HEADER_SIZE
+        for i in range(count):
+            step, slots = LEVEL.unpack_from(self._map, HEADER.size + i * LEVEL.size)
+            self.levels.append(_Level(buf, offset, step, slots))
+            offset += slots * SLOT_SIZE
+
+    @staticmethod
+    def _create(path, resolutions, size):
+        tmp_file = f'{path}.tmp'
+        with open(tmp_file, 'wb') as f:
+            header = bytearray(HEADER_SIZE)
+            HEADER.pack_into(header, 0, MAGIC, VERSION, len(resolutions))
+            for i, (step, slots) in enumerate(resolutions):
+                LEVEL.pack_into(header, HEADER.size + i * LEVEL.size, step, slots)
+            f.write(header)
+            f.truncate(size)  # zero-filled - bucket 0 never matches a real timestamp
+        os.replace(tmp_file, path)
+
+    def add(self, value, ts=None):
+        ts = int(ts or time.time())
+        for level in self.levels:
+            level.add(ts, value)
+
+    def query(self, start, end=None, max_points=500):
+        """
+        Points over [start, end] from the finest resolution that still holds
+        `start` and gives at most `max_points` buckets
+        """
+        now = time.time()
+        end = int(end or now)
+        start = int(start)
+        for level in self.levels:
+            if level.covers(start, now) and (end - start) / level.step <= max_points:
+                return level.step, level.points(start, end)
+        level = self.levels[-1]
+        return level.step, level.points(max(start, int(now) - level.step * level.slots), end)
+
+    def close(self):
+        for level in getattr(self, 'levels', []):
+            for column in (level.ts, level.count, level.sum, level.min, level.max):
+                column.release()
+        self.levels = []
+        if getattr(self, '_buf', None) is not None:
+            self._buf.release()
+            self._buf = None
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        os.close(self._fd)
+
+
+class TimeSeriesStore:
+    """
+    Directory of series files. The writer (the telemetry leader) maps them
+    read-write; other workers map them read-only and see new points at once
+    through the shared page cache. Nothing is loaded on restart - the files
+    are simply mapped again.
+    """
+
+    def __init__(self, directory, max_series=2000):
+        self.directory = directory
+        self.max_series = max_series
+        self._series = {}  # name -> (Series, writable)
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, name):
+        return f'{self.directory}/{safe_name(name)}.ts'
+
+    def _get(self, name, writable):
+        with self._lock:
+            entry = self._series.get(name)
+            if entry and (entry[1] or not writable):
+                return entry[0]
+            path = self._path(name)
+            if not writable and not os.path.exists(path):
+                return None
+            if writable and entry is None and not os.path.exists(path) and len(self.names()) >= self.max_series:
+                raise RuntimeError(f'Metric series limit ({self.max_series}) reached')
+            if entry:
+                entry[0].close()
+            series = Series(path, writable=writable)
+            self._series[name] = (series, writable)
+            return series
+
+    def record(self, values, ts=None):
+        """Add one point to each series in {name: value}; None values are skipped"""
+        ts = int(ts or time.time())
+        for name, value in values.items():
+            if value is not None:
+                self._get(name, writable=True).add(float(value), ts)
+
+    def query(self, name, start, end=None, max_points=500):
+        series = self._get(name, writable=False)
+        if series is None:
+            return {'series': name, 'step': None, 'points': []}
+        step, points = series.query(start, end, max_points)
+        return {'series': name, 'step': step, 'points': [[t, round(a, 3), round(lo, 3), round(hi, 3)]
+                                                         for t, a, lo, hi in points]}
+
+    def names(self, prefix=''):
+        return sorted(f[:-3] for f in os.listdir(self.directory) if f.endswith('.ts') and f.startswith(prefix))
+
+    def close(self):
+        with self._lock:
+            for series, _ in self._series.values():
+                series.close()
+            self._series = {}
@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+"""
+Proxy Farm System - Traffic rates
+Byte/packet rates per modem from HiLink traffic counters and interface statistics
+"""
+
+import os
+import threading
+import time
+from collections import deque
+
+# HiLink counters (from the poller's traffic-statistics sample) -> rate name
+HILINK_COUNTERS = {
+    'TotalDownload': 'modem_rx_bps',
+    'TotalUpload': 'modem_tx_bps'
+}
+
+# /sys/class/net/<iface>/statistics files -> rate name
+SYSFS_COUNTERS = {
+    'rx_bytes': 'rx_bps',
+    'tx_bytes': 'tx_bps',
+    'rx_packets': 'rx_pps',
+    'tx_packets': 'tx_pps',
+    'rx_dropped': 'rx_drop_pps',
+    'tx_dropped': 'tx_drop_pps'
+}
+
+WRAP_32 = 1 << 32
+WRAP_64 = 1 << 64
+
+
+class CounterRate:
+    """
+    Rate of one monotonically increasing counter. A counter that goes
+    backwards either wrapped (it was near the top of its 32/64-bit range)
+    or was reset (reconnect, driver reload, modem reboot); a reset yields
+    no rate for that interval rather than a huge bogus one.
+    """
+
+    __slots__ = ('value', 'at', 'rate')
+
+    def __init__(self):
+        self.value = None
+        self.at = None
+        self.rate = None
+
+    def update(self, value, at):
+        previous, previous_at = self.value, self.at
+        self.value, self.at = value, at
+        if previous is None or at <= previous_at:
+            return None
+        delta = value - previous
+        if delta < 0:
+            width = WRAP_32 if previous < WRAP_32 else WRAP_64
+            if previous > width * 0.75 and value < width * 0.25:
+                delta += width
+            else:
+                self.rate = None  # reset
+                return None
+        self.rate = delta / (at - previous_at)
+        return self.rate
+
+
+class SysfsStatistics:
+    """Reads interface counters with pread on descriptors kept open between samples"""
+
+    def __init__(self, sysfs_root='/sys'):
+        self.sysfs_root = sysfs_root.rstrip('/')
+        self._fds = {}  # (interface, counter) -> fd
+
+    def read(self, interface):
+        values = {}
+        for counter in SYSFS_COUNTERS:
+            key = (interface, counter)
+            fd = self._fds.get(key)
+            try:
+                if fd is None:
+                    fd = os.open(f'{self.sysfs_root}/class/net/{interface}/statistics/{counter}', os.O_RDONLY)
+                    self._fds[key] = fd
+                values[counter] = int(os.pread(fd, 32, 0))
+            except (OSError, ValueError):
+                # Interface gone (unplugged/renamed) - reopen on the next sample
+                self.close(interface)
+                return {}
+        return values
+
+    def close(self, interface=None):
+        for key in [k for k in self._fds if interface is None or k[0] == interface]:
+            try:
+                os.close(self._fds.pop(key))
+            except OSError:
+                pass
+
+
+class TrafficCollector:
+    """
+    Turns counter samples into rates. Fed with the poller's results, so the
+    modem side costs no extra HiLink requests; interface counters are a few
+    pread() calls per modem.
+    """
+
+    def __init__(self, sysfs_root='/sys', window=60):
+        self.window = window
+        self.sysfs = SysfsStatistics(sysfs_root)
+        self._rates = {}  # dcom_id -> {counter: CounterRate}
+        self._history = {}  # dcom_id -> deque of (ts, rx_bps, tx_bps) within `window`
+        self._interfaces = {}  # dcom_id -> interface
+        self._lock = threading.Lock()
+
+    def update(self, devices, results, now=None):
+        """Sample every device; returns {dcom_id: rates} and leaves them on each result"""
+        now = now or time.time()
+        rates = {}
+        with self._lock:
+            for dcom_id in list(self._rates):
+                if dcom_id not in devices:
+                    self._forget(dcom_id)
+            for dcom_id, device in devices.items():
+                result = results.get(dcom_id) or {}
+                interface = device.get('interface')
+                if self._interfaces.get(dcom_id) != interface:
+                    # Re-enumerated stick - counters belong to a new interface
+                    self._forget(dcom_id)
+                    self._interfaces[dcom_id] = interface
+                counters = self._rates.setdefault(dcom_id, {})
+
+                values = {}  # rate name -> (counter value, sampled at)
+                traffic = result.get('traffic') or {}
+                if result.get('reachable') and 'backoff_until' not in result:
+                    for counter, name in HILINK_COUNTERS.items():
+                        if str(traffic.get(counter, '')).isdigit():
+                            values[name] = (int(traffic[counter]) * 8, result.get('polled_at', now))
+                if interface:
+                    for counter, value in self.sysfs.read(interface).items():
+                        name = SYSFS_COUNTERS[counter]
+                        values[name] = (value * 8 if counter.endswith('_bytes') else value, now)
+
+                device_rates = {}
+                for name, (value, at) in values.items():
+                    rate = counters.setdefault(name, CounterRate()).update(value, at)
+                    if rate is not None:
+                        device_rates[name] = round(rate, 1)
+
+                # Prefer the kernel's view of the link; fall back to the modem's counters
+                rx = device_rates.get('rx_bps', device_rates.get('modem_rx_bps'))
+                tx = device_rates.get('tx_bps', device_rates.get('modem_tx_bps'))
+                history = self._history.setdefault(dcom_id, deque())
+                if rx is not None or tx is not None:
+                    history.append((now, rx or 0.0, tx or 0.0))
+                while history and history[0][0] < now - self.window:
+                    history.popleft()
+                if history:
+                    device_rates['avg_rx_bps'] = round(sum(h[1] for h in history) / len(history), 1)
+                    device_rates['avg_tx_bps'] = round(sum(h[2] for h in history) / len(history), 1)
+                    device_rates['peak_rx_bps'] = max(h[1] for h in history)
+                    device_rates['peak_tx_bps'] = max(h[2] for h in history)
+                device_rates['rx_bps'] = rx
+                device_rates['tx_bps'] = tx
+                device_rates['sampled_at'] = now
+                rates[dcom_id] = device_rates
+                if dcom_id in results:
+                    results[dcom_id]['rates'] = device_rates
+        return rates
+
+    def _forget(self, dcom_id):
+        self._rates.pop(dcom_id, None)
+        self._history.pop(dcom_id, None)
+        interface = self._interfaces.pop(dcom_id, None)
+        if interface:
+            self.sysfs.close(interface)
@@ -0,0 +1,525 @@
+#!/usr/bin/env python3
+"""
+Proxy Farm System - Fleet verifier
+Checks every user through every listener they may use, concurrently: TCP
+connect, proxy auth, tunnel, first byte from an echo target, and whether
+the IP the target saw is their modem's
+
+    python3 verifier.py echo --port 8089
+    python3 verifier.py probe --port 3331 --user alice --password secret --target http://203.0.113.7:8089/
+"""
+
+import argparse
+import asyncio
+import base64
+import ipaddress
+import json
+import os
+import re
+import secrets
+import struct
+import sys
+import threading
+import time
+from urllib.parse import urlsplit
+
+from latency import PhaseTimer, LatencyHistogram
+from rotation import _pid_alive
+
+PROTOCOLS = ('http', 'socks5')
+# Phases in order, each timed from the end of the previous one. HTTP CONNECT
+# authenticates and opens the tunnel in one round trip, timed as 'auth'.
+PHASES = ('connect', 'auth', 'tunnel', 'first_byte')
+ACTIVE_STATES = ('queued', 'running', 'cancelling')
+
+SOCKS_REPLIES = {1: 'general failure', 2: 'not allowed by ruleset', 3: 'network unreachable',
+                 4: 'host unreachable', 5: 'connection refused', 6: 'TTL expired',
+                 7: 'command not supported', 8: 'address type not supported'}
+
+MAX_RESPONSE = 64 * 1024
+_IPV4 = re.compile(rb'(?<![\d.])\d{1,3}(?:\.\d{1,3}){3}(?![\d.])')
+
+
+class ProbeFailed(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+class EchoTarget:
+    """The URL probes fetch through the proxy; its response body must name the caller's IP"""
+
+    __slots__ = ('host', 'port', 'path', 'url')
+
+    def __init__(self, url):
+        parts = urlsplit(url if '://' in url else f'http://{url}')
+        if parts.scheme != 'http' or not parts.hostname:
+            raise ValueError(f'Echo target must be a plain http:// URL, not {url!r}')
+        self.host = parts.hostname
+        self.port = parts.port or 80
+        self.path = parts.path or '/'
+        if parts.query:
+            self.path += f'?{parts.query}'
+        self.url = f'http://{self.host}:{self.port}{self.path}'
+
+    def request(self):
+        return (f'GET {self.path} HTTP/1.1\r\nHost: {self.host}\r\nUser-Agent: proxyfarm-verifier\r\n'
+                f'Accept: */*\r\nConnection: close\r\n\r\n').encode()
+
+
+def parse_echo(response):
+    """The caller IP from an echo response: JSON {"origin"|"ip": ...} (httpbin, ipify) or the first IPv4 in the body"""
+    head, _, body = response.partition(b'\r\n\r\n')
+    if not head.startswith(b'HTTP/'):
+        raise ProbeFailed('protocol_error', 'Echo target did not answer HTTP')
+    status = head.split(b' ', 2)[1:2]
+    if status != [b'200']:
+        raise ProbeFailed('tunnel_failed', f'Echo target answered {head.splitlines()[0].decode(errors="replace")}')
+    try:
+        data = json.loads(body)
+        value = data.get('origin') or data.get('ip') if isinstance(data, dict) else data
+        return str(ipaddress.ip_address(str(value).split(',')[0].strip()))
+    except (ValueError, TypeError):
+        pass
+    match = _IPV4.search(body)
+    if match:
+        try:
+            return str(ipaddress.ip_address(match.group().decode()))
+        except ValueError:
+            pass
+    raise ProbeFailed('protocol_error', 'No IP address in the echo response')
+
+
+async def _http_connect(reader, writer, target, username, password):
+    lines = [f'CONNECT {target.host}:{target.port} HTTP/1.1', f'Host: {target.host}:{target.port}']
+    if username:
+        token = base64.b64encode(f'{username}:{password}'.encode()).decode()
+        lines.append(f'Proxy-Authorization: Basic {token}')
+    writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode())
+    try:
+        head = await reader.readuntil(b'\r\n\r\n')
+    except asyncio.IncompleteReadError:
+        raise ProbeFailed('protocol_error', 'Proxy closed the connection during CONNECT')
+    status_line = head.split(b'\r\n', 1)[0].decode(errors='replace')
+    parts = status_line.split(' ', 2)
+    if len(parts) < 2 or not parts[0].startswith('HTTP/'):
+        raise ProbeFailed('protocol_error', f'Bad CONNECT reply: {status_line[:80]}')
+    if parts[1] == '407':
+        raise ProbeFailed('auth_failed', f'Proxy refused the credentials ({status_line})')
+    if parts[1] != '200':
+        raise ProbeFailed('tunnel_failed', f'CONNECT failed: {status_line}')
+
+
+async def _socks5_auth(reader, writer, username, password):
+    if username:
+        writer.write(b'\x05\x01\x02')
+    else:
+        writer.write(b'\x05\x01\x00')
+    version, method = await reader.readexactly(2)
+    if version != 5:
+        raise ProbeFailed('protocol_error', f'Not a SOCKS5 server (version {version})')
+    if method == 0xFF:
+        raise ProbeFailed('auth_failed', 'Proxy accepts none of the offered auth methods')
+    if method == 0x02:
+        user, secret = (username or '').encode(), (password or '').encode()
+        if len(user) > 255 or len(secret) > 255:
+            raise ProbeFailed('auth_failed', 'Credentials too long for SOCKS5')
+        writer.write(bytes((1, len(user))) + user + bytes((len(secret),)) + secret)
+        _, status = await reader.readexactly(2)
+        if status != 0:
+            raise ProbeFailed('auth_failed', 'Proxy refused the credentials')
+    elif method != 0x00:
+        raise ProbeFailed('protocol_error', f'Proxy chose unsupported auth method {method}')
+
+
+async def _socks5_connect(reader, writer, target):
+    try:
+        address = b'\x01' + ipaddress.IPv4Address(target.host).packed
+    except ValueError:
+        host = target.host.encode('idna')
+        address = b'\x03' + bytes((len(host),)) + host
+    writer.write(b'\x05\x01\x00' + address + struct.pack('>H', target.port))
+    _, reply, _, address_type = await reader.readexactly(4)
+    if reply != 0:
+        raise ProbeFailed('tunnel_failed', f'SOCKS5 connect failed: {SOCKS_REPLIES.get(reply, reply)}')
+    if address_type == 1:
+        await reader.readexactly(4 + 2)
+    elif address_type == 4:
+        await reader.readexactly(16 + 2)
+    elif address_type == 3:
+        length = (await reader.readexactly(1))[0]
+        await reader.readexactly(length + 2)
+    else:
+        raise ProbeFailed('protocol_error', f'Bad SOCKS5 address type {address_type}')
+
+
+async def probe(host, port, protocol, target, username=None, password=None, timeout=10.0):
+    """
+    One check through one listener: {status, observed_ip, error, connect_ms,
+    auth_ms, tunnel_ms, first_byte_ms, total_ms, failed_phase}. Never raises.
+    """
+    timer = PhaseTimer()
+    state = {'phase': 'connect', 'writer': None}
+
+    async def exchange():
+        reader, writer = await asyncio.open_connection(host, port)
+        state['writer'] = writer
+        timer.mark('connect')
+        state['phase'] = 'auth'
+        if protocol == 'http':
+            await _http_connect(reader, writer, target, username, password)
+            timer.mark('auth')
+        else:
+            await _socks5_auth(reader, writer, username, password)
+            timer.mark('auth')
+            state['phase'] = 'tunnel'
+            await _socks5_connect(reader, writer, target)
+            timer.mark('tunnel')
+        state['phase'] = 'first_byte'
+        writer.write(target.request())
+        response = await reader.read(MAX_RESPONSE)
+        if not response:
+            raise ProbeFailed('protocol_error', 'Tunnel closed before the echo target answered')
+        timer.mark('first_byte')
+        while len(response) < MAX_RESPONSE:
+            chunk = await reader.read(MAX_RESPONSE - len(response))
+            if not chunk:
+                break
+            response += chunk
+        return parse_echo(response)
+
+    result = {'status': 'ok', 'observed_ip': None, 'error': None}
+    try:
+        result['observed_ip'] = await asyncio.wait_for(exchange(), timeout)
+    except ProbeFailed as e:
+        result.update(status=e.status, error=str(e))
+        timer.fail(state['phase'])
+    except asyncio.TimeoutError:
+        result.update(status='timeout', error=f"No answer within {timeout:g}s ({state['phase']})")
+        timer.fail(state['phase'])
+    except asyncio.IncompleteReadError:
+        result.update(status='protocol_error', error=f"Connection closed during {state['phase']}")
+        timer.fail(state['phase'])
+    except OSError as e:
+        status = 'connect_failed' if state['phase'] == 'connect' else 'protocol_error'
+        result.update(status=status, error=e.strerror or str(e))
+        timer.fail(state['phase'])
+    finally:
+        if state['writer'] is not None:
+            state['writer'].close()
+    timings = timer.to_dict()
+    for phase in PHASES:
+        result[f'{phase}_ms'] = timings.get(phase)
+    result['total_ms'] = timings['total']
+    result['failed_phase'] = timings['failed_phase']
+    return result
+
+
+def protocols_for(service):
+    """What the verifier speaks to a 3proxy service ('socks' answers SOCKS4 and 5)"""
+    return {'proxy': ('http',), 'socks': ('socks5',), 'auto': PROTOCOLS}.get(service, ())
+
+
+class FleetVerifier:
+    """
+    Runs verification jobs in a background thread with their own event
+    loop. A job is a list of cases - {username, password, port, protocol,
+    dcom_id, expected: [ips]} - probed at most `parallelism` at a time.
+
+    Each result is appended to `<job>.ndjson` as it completes and the
+    job's summary (counts, per-phase latency histograms, per-port and
+    per-modem status) is rewritten to `<job>.json` every second, so any
+    gunicorn worker can report or stream a job another worker runs.
+    """
+
+    def __init__(self, jobs_dir, max_parallelism=1000, keep_jobs=20):
+        self.jobs_dir = jobs_dir
+        self.max_parallelism = max_parallelism
+        self.keep_jobs = keep_jobs
+        self._jobs = {}  # job id -> job dict (jobs run by this process)
+        self._lock = threading.RLock()
+        os.makedirs(jobs_dir, exist_ok=True)
+
+    # Jobs ----------------------------------------------------------------
+
+    def submit(self, cases, target, modems=None, proxy_host='127.0.0.1', parallelism=100, timeout=10.0):
+        """
+        Queue a job and return its initial state. `modems` ({dcom_id: [ips]})
+        names the modem behind an unexpected egress IP.
+        """
+        cases = list(cases)
+        if not cases:
+            raise ValueError('Nothing to verify')
+        for case in cases:
+            if case['protocol'] not in PROTOCOLS:
+                raise ValueError(f"Unknown protocol {case['protocol']!r}")
+        target = EchoTarget(target)
+        parallelism = max(1, min(int(parallelism), self.max_parallelism))
+        timeout = max(0.5, float(timeout))
+        job = {
+            'id': f"{time.strftime('%Y%m%d%H%M%S')}-{secrets.token_hex(3)}",
+            'status': 'queued',
+            'created_at': time.time(),
+            'started_at': None,
+            'finished_at': None,
+            'pid': os.getpid(),
+            'target': target.url,
+            'proxy_host': proxy_host,
+            'parallelism': parallelism,
+            'timeout': timeout,
+            'progress': {'total': len(cases), 'finished': 0, 'percent': 0.0, 'probes_per_sec': None},
+            'statuses': {},
+            'latency': {},
+            'ports': {},
+            'modems': {}
+        }
+        with self._lock:
+            self._jobs[job['id']] = job
+        self._save(job)
+        self._prune()
+        threading.Thread(target=self._run, args=(job, cases, target, modems or {}),
+                         name=f"verify-{job['id']}", daemon=True).start()
+        return self._copy(job)
+
+    def get(self, job_id):
+        """Job summary (from memory if this worker runs it, else from its file)"""
+        with self._lock:
+            if job_id in self._jobs:
+                return self._copy(self._jobs[job_id])
+        return self._load(job_id)
+
+    def list(self):
+        jobs = []
+        for filename in sorted(os.listdir(self.jobs_dir), reverse=True):
+            if filename.endswith('.json'):
+                job = self.get(filename[:-5])
+                if job:
+                    jobs.append({k: v for k, v in job.items() if k not in ('latency', 'ports', 'modems')})
+        return jobs
+
+    def cancel(self, job_id):
+        """Stop starting probes; those in flight finish"""
+        job = self.get(job_id)
+        if job is None or job['status'] not in ACTIVE_STATES:
+            return False
+        open(self._path(job_id, '.cancel'), 'w').close()  # seen by whichever worker runs it
+        return True
+
+    def results(self, job_id, offset=0, follow=False, failed_only=False, poll=0.25):
+        """
+        Yield result lines (JSON text) from line `offset` on. With `follow`,
+        keep waiting for new lines until the job is over.
+        """
+        path = self._path(job_id, '.ndjson')
+        skip = max(0, int(offset))
+        position = 0
+        while True:
+            # Read the job state first: once it is over, everything is already in the file
+            over = not follow or (self.get(job_id) or {}).get('status') not in ACTIVE_STATES
+            try:
+                with open(path, 'rb') as f:
+                    f.seek(position)
+                    data = f.read()
+            except FileNotFoundError:
+                data = b''
+            data = data[:data.rfind(b'\n') + 1]  # a partly written last line waits for the next read
+            position += len(data)
+            for line in data.splitlines():
+                if skip:
+                    skip -= 1
+                elif not failed_only or json.loads(line)['status'] != 'ok':
+                    yield line.decode()
+            if over:
+                return
+            if not data:
+                time.sleep(poll)
+
+    # Runner --------------------------------------------------------------
+
+    def _run(self, job, cases, target, modems):
+        try:
+            asyncio.run(self._verify(job, cases, target, modems))
+        except Exception as e:
+            self._set(job, status='failed', error=str(e), finished_at=time.time())
+        try:
+            os.unlink(self._path(job['id'], '.cancel'))
+        except OSError:
+            pass
+
+    async def _verify(self, job, cases, target, modems):
+        owner = {ip: dcom_id for dcom_id, ips in modems.items() for ip in ips}
+        histograms = {phase: LatencyHistogram() for phase in PHASES + ('total',)}
+        cancel_file = self._path(job['id'], '.cancel')
+        pending = iter(cases)
+        stop = asyncio.Event()
+        self._set(job, status='running', started_at=time.time())
+
+        with open(self._path(job['id'], '.ndjson'), 'a') as out:
+            def record(case, result):
+                result = self._judge(case, result, owner)
+                out.write(json.dumps(result) + '\n')
+                with self._lock:
+                    statuses = job['statuses']
+                    statuses[result['status']] = statuses.get(result['status'], 0) + 1
+                    for table, key in ((job['ports'], str(case['port'])), (job['modems'], case.get('dcom_id') or '-')):
+                        counts = table.setdefault(key, {})
+                        counts[result['status']] = counts.get(result['status'], 0) + 1
+                    job['progress']['finished'] += 1
+                    for phase, histogram in histograms.items():
+                        value = result.get(f'{phase}_ms')
+                        if value is not None:
+                            histogram.add(value)
+
+            async def worker():
+                for case in pending:
+                    if stop.is_set():
+                        return
+                    result = await probe(job['proxy_host'], case['port'], case['protocol'], target,
+                                         case.get('username'), case.get('password'), job['timeout'])
+                    record(case, result)
+
+            def report():
+                out.flush()
+                with self._lock:
+                    job['latency'] = {phase: h.to_dict() for phase, h in histograms.items() if h.count}
+                    progress = job['progress']
+                    progress['percent'] = round(progress['finished'] / progress['total'] * 100, 1)
+                    elapsed = time.time() - job['started_at']
+                    progress['probes_per_sec'] = round(progress['finished'] / elapsed, 1) if elapsed > 0 else None
+                self._save(job)
+
+            workers = [asyncio.ensure_future(worker()) for _ in range(min(job['parallelism'], len(cases)))]
+            running = asyncio.gather(*workers)
+            while not running.done():
+                await asyncio.wait([running], timeout=1.0)
+                if not stop.is_set() and os.path.exists(cancel_file):
+                    stop.set()
+                    self._set(job, status='cancelling')
+                report()
+            running.result()
+
+        finished = job['progress']['finished']
+        if job['status'] == 'cancelling':
+            status = 'cancelled'
+        else:
+            status = 'done'
+        self._set(job, status=status, finished_at=time.time(),
+                  passed=job['statuses'].get('ok', 0), failed=finished - job['statuses'].get('ok', 0))
+
+    def _judge(self, case, result, owner):
+        """Result line for a case: the probe's outcome, checked against the user's modem"""
+        observed = result['observed_ip']
+        expected = case.get('expected') or []
+        line = {'username': case.get('username'), 'port': case['port'], 'protocol': case['protocol'],
+                'dcom_id': case.get('dcom_id'), 'expected_ip': expected[0] if expected else None}
+        line.update(result)
+        line['observed_dcom'] = owner.get(observed) if observed else None
+        if result['status'] != 'ok' or not case.get('dcom_id'):
+            return line
+        if not expected:
+            # The modem's IP isn't known yet, so there is nothing to check against
+            line['status'] = 'unknown_egress'
+            line['error'] = f"Left through {observed}; {case['dcom_id']} has no known IP to compare"
+        elif observed not in expected:
+            line['status'] = 'wrong_egress'
+            seen = line['observed_dcom'] or 'no known modem'
+            line['error'] = f"Left through {observed} ({seen}), expected {case['dcom_id']}"
+        return line
+
+    # State ---------------------------------------------------------------
+
+    def _set(self, job, **fields):
+        with self._lock:
+            job.update(fields)
+        self._save(job)
+
+    def _copy(self, job):
+        with self._lock:
+            return json.loads(json.dumps(job))
+
+    def _path(self, job_id, suffix='.json'):
+        return f'{self.jobs_dir}/{os.path.basename(job_id)}{suffix}'
+
+    def _save(self, job):
+        data = self._copy(job)
+        data['updated_at'] = time.time()
+        tmp_file = f"{self._path(job['id'])}.{threading.get_ident()}.tmp"
+        with open(tmp_file, 'w') as f:
+            json.dump(data, f, indent=2)
+        os.replace(tmp_file, self._path(job['id']))
+
+    def _load(self, job_id):
+        try:
+            with open(self._path(job_id), 'r') as f:
+                job = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if job['status'] in ACTIVE_STATES and not _pid_alive(job['pid']):
+            job['status'] = 'abandoned'  # the worker running it died
+        return job
+
+    def _prune(self):
+        """Keep only the newest `keep_jobs` finished jobs (summary and results)"""
+        names = sorted((f for f in os.listdir(self.jobs_dir) if f.endswith('.json')), reverse=True)
+        for filename in names[self.keep_jobs:]:
+            job_id = filename[:-5]
+            job = self._load(job_id)
+            if job and job['status'] not in ACTIVE_STATES:
+                for suffix in ('.json', '.ndjson'):
+                    try:
+                        os.unlink(self._path(job_id, suffix))
+                    except OSError:
+                        pass
+                with self._lock:
+                    self._jobs.pop(job_id, None)
+
+
+# Echo target -------------------------------------------------------------
+
+async def _echo(reader, writer):
+    try:
+        await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), 10)
+        body = json.dumps({'origin': writer.get_extra_info('peername')[0]}).encode()
+        writer.write(b'HTTP/1.1 200 OK\r\nContent-Type: application/json\r\n'
+                     b'Content-Length: %d\r\nConnection: close\r\n\r\n%s' % (len(body), body))
+        await writer.drain()
+    except (asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, OSError):
+        pass
+    finally:
+        writer.close()
+
+
+async def serve_echo(host='0.0.0.0', port=8089):
+    """Answer any HTTP request with the caller's address, httpbin /ip style"""
+    server = await asyncio.start_server(_echo, host, port, backlog=1024)
+    async with server:
+        await server.serve_forever()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Proxy Farm fleet verifier')
+    commands = parser.add_subparsers(dest='command', required=True)
+    echo = commands.add_parser('echo', help='run an echo target that reports the caller IP')
+    echo.add_argument('--bind', default='0.0.0.0')
+    echo.add_argument('--port', type=int, default=8089)
+    check = commands.add_parser('probe', help='check one listener with one credential pair')
+    check.add_argument('--host', default='127.0.0.1')
+    check.add_argument('--port', type=int, required=True)
+    check.add_argument('--protocol', choices=PROTOCOLS, default='http')
+    check.add_argument('--user')
+    check.add_argument('--password')
+    check.add_argument('--target', default='http://httpbin.org/ip')
+    check.add_argument('--timeout', type=float, default=10.0)
+    args = parser.parse_args()
+
+    if args.command == 'echo':
+        print(f'Echo target on {args.bind}:{args.port}')
+        try:
+            asyncio.run(serve_echo(args.bind, args.port))
+        except KeyboardInterrupt:
+            pass
+    else:
+        result = asyncio.run(probe(args.host, args.port, args.protocol, EchoTarget(args.target),
+                                   args.user, args.password, args.timeout))
+        print(json.dumps(result, indent=2))
+        sys.exit(0 if result['status'] == 'ok' else 1)